@@ -59,6 +59,22 @@ CONF.import_opt('extensions_whitelist', 'nova.api.openstack',
 LOG = logging.getLogger(__name__)
 authorize = extensions.os_compute_authorizer(ALIAS)
 
+# Added by YuanruiFan. The light-snapshot actions of lightSnapshotBulk, and
+# the policy checked for each server.
+LIGHT_SNAPSHOT_BULK_ACTIONS = {
+    'createSnapshot': 'create_snapshot',
+    'commitSnapshot': 'commit_snapshot',
+    'recoverInstance': 'recover_instance',
+    'enableSnapshot': 'enable_light_snapshot',
+    'dailySnapshot': 'enable_daily_snapshot',
+    'storeSnapshot': 'enable_store_snapshot',
+}
+
+# Added by YuanruiFan. The boolean light-snapshot states servers can be
+# filtered on.
+LIGHT_SNAPSHOT_FILTERS = ('light_snapshot_enable', 'snapshot_daily',
+                          'snapshot_store', 'snapshot_committed')
+
 
 class ServersController(wsgi.Controller):
     """The Server API base controller class for the OpenStack API."""
@@ -332,10 +348,24 @@ class ServersController(wsgi.Controller):
             search_opts['deleted'] = strutils.bool_from_string(
                 search_opts['deleted'], default=False)
 
-        # Added by YuanruiFan. So that we can list the servers that
-        # use light-snapshot system.
-        if 'light_snapshot_enable' in search_opts:
-            search_opts['light_snapshot_enable'] = 1
+        # Added by YuanruiFan. So that we can list the servers according
+        # to their light-snapshot state. The light-snapshot state is not a
+        # column of the instances, it is joined in their query.
+        light_snapshot_filters = {}
+        for key in LIGHT_SNAPSHOT_FILTERS:
+            if key in search_opts:
+                light_snapshot_filters[key] = strutils.bool_from_string(
+                    search_opts.pop(key), default=True)
+        if 'snapshot_older_than' in search_opts:
+            try:
+                light_snapshot_filters['snapshot_older_than'] = (
+                    timeutils.parse_isotime(
+                        search_opts.pop('snapshot_older_than')))
+            except ValueError:
+                msg = _('Invalid snapshot_older_than value')
+                raise exc.HTTPBadRequest(explanation=msg)
+        if light_snapshot_filters:
+            search_opts['light_snapshot'] = light_snapshot_filters
 
         if search_opts.get("vm_state") == ['deleted']:
             if context.is_admin:
@@ -1164,7 +1194,7 @@ class ServersController(wsgi.Controller):
 
     # Added by YuanruiFan. To create a light snapshot for instance
     @wsgi.response(202)
-    @extensions.expected_errors((400, 403, 404, 409))
+    @extensions.expected_errors((400, 403, 404, 409, 429))
     @wsgi.action('createSnapshot')
     def _light_snapshot_instance(self, req, id, body):
         """take a external snapshot for an instance.
@@ -1179,6 +1209,10 @@ class ServersController(wsgi.Controller):
             raise exc.HTTPBadRequest(explanation=_('The instance does not enable light-snapshot, cannot snapshot instance.'))
         try:
             self.compute_api.light_snapshot(context, instance)
+        except exception.LightSnapshotHostBusy as e:
+            raise webob.exc.HTTPTooManyRequests(
+                explanation=e.format_message(),
+                headers={'Retry-After': e.kwargs['retry_after']})
         except exception.InstanceNotReady as e:
             raise webob.exc.HTTPConflict(explanation=e.format_message())
         except exception.InstanceUnknownCell as e:
@@ -1193,7 +1227,7 @@ class ServersController(wsgi.Controller):
     # Added by YuanruiFan. To make the instance recover from the 
     # external snapshot we created.
     @wsgi.response(202)
-    @extensions.expected_errors((400, 403, 404, 409))
+    @extensions.expected_errors((400, 403, 404, 409, 429))
     @wsgi.action('recoverInstance')
     def _light_recover_instance(self, req, id, body):
         """ recover the instance from its snapshot"""
@@ -1215,6 +1249,10 @@ class ServersController(wsgi.Controller):
         try:
             self.compute_api.light_recover(context, instance, 
                                            use_root=use_root, snap_index=snap_index)
+        except exception.LightSnapshotHostBusy as e:
+            raise webob.exc.HTTPTooManyRequests(
+                explanation=e.format_message(),
+                headers={'Retry-After': e.kwargs['retry_after']})
         except exception.InstanceNotReady as e:
             raise webob.exc.HTTPConflict(explanation=e.format_message())
         except exception.InstanceUnknownCell as e:
@@ -1228,7 +1266,7 @@ class ServersController(wsgi.Controller):
 
     # Added by YuanruiFan. To commit the snapshot to the root disk
     @wsgi.response(202)
-    @extensions.expected_errors((400, 403, 404, 409))
+    @extensions.expected_errors((400, 403, 404, 409, 429))
     @wsgi.action('commitSnapshot')
     def _light_commit_snapshot(self, req, id, body):
         """Commit the snapshot of an instance."""
@@ -1238,6 +1276,10 @@ class ServersController(wsgi.Controller):
         LOG.debug('commit the snapshot of the instance', instance=instance)
         try:
             self.compute_api.commit_snapshot(context, instance)
+        except exception.LightSnapshotHostBusy as e:
+            raise webob.exc.HTTPTooManyRequests(
+                explanation=e.format_message(),
+                headers={'Retry-After': e.kwargs['retry_after']})
         except exception.InstanceNotReady as e:
             raise webob.exc.HTTPConflict(explanation=e.format_message())
         except exception.InstanceUnknownCell as e:
@@ -1249,6 +1291,63 @@ class ServersController(wsgi.Controller):
             raise exc.HTTPBadRequest(explanation=err.format_message())
 
 
+    # Added by YuanruiFan. To get the execute profile of the last
+    # light-snapshot operation of an instance.
+    @extensions.expected_errors((404, 409))
+    @wsgi.action('snapshotProfile')
+    def _light_snapshot_profile(self, req, id, body):
+        """Get the execute profile of the last light-snapshot operation."""
+        context = req.environ['nova.context']
+        instance = self._get_instance(context, id)
+        authorize(context, instance, 'snapshot_profile')
+        try:
+            profile = self.compute_api.get_light_snapshot_profile(context,
+                                                                  instance)
+        except exception.InstanceNotReady as e:
+            raise webob.exc.HTTPConflict(explanation=e.format_message())
+        except exception.InstanceUnknownCell as e:
+            raise exc.HTTPNotFound(explanation=e.format_message())
+        return {'profile': profile}
+
+
+    # Added by YuanruiFan. To pre-stage the light-snapshot layers of an
+    # instance on the host it is going to be migrated to.
+    @wsgi.response(202)
+    @extensions.expected_errors((400, 403, 404, 409))
+    @wsgi.action('prestageSnapshot')
+    def _light_prestage_snapshot(self, req, id, body):
+        """Pre-stage the light-snapshot layers of an instance on a host.
+
+           A host of None cancels the pre-stage.
+        """
+        context = req.environ['nova.context']
+        instance = self._get_instance(context, id)
+        authorize(context, instance, 'prestage_snapshot')
+
+        entity = body["prestageSnapshot"] or {}
+        host = entity.get("host")
+
+        if not instance.light_snapshot_enable:
+            raise exc.HTTPBadRequest(explanation=_('The instance does not enable light-snapshot, cannot pre-stage its snapshots.'))
+
+        LOG.debug('pre-stage the light snapshots of the instance',
+                  instance=instance)
+        try:
+            self.compute_api.prestage_light_snapshot(context, instance,
+                                                     host=host)
+        except exception.ComputeHostNotFound as e:
+            raise exc.HTTPBadRequest(explanation=e.format_message())
+        except exception.InstanceNotReady as e:
+            raise webob.exc.HTTPConflict(explanation=e.format_message())
+        except exception.InstanceUnknownCell as e:
+            raise exc.HTTPNotFound(explanation=e.format_message())
+        except exception.InstanceInvalidState as state_error:
+            common.raise_http_conflict_for_instance_invalid_state(state_error,
+                'pre-stage the light snapshots', id)
+        except exception.Invalid as err:
+            raise exc.HTTPBadRequest(explanation=err.format_message())
+
+
     # Added by YuanruiFan. we want to light snapshot all the instances 
     # that enable light-snapshot system.
     @wsgi.response(202)
@@ -1272,6 +1371,140 @@ class ServersController(wsgi.Controller):
             self.compute_api.light_snapshot_all(context, host, daily=daily)
 
 
+    # Added by YuanruiFan. we want to commit the light snapshots of all
+    # the stopped instances, which is done offline on each host.
+    @wsgi.response(202)
+    @extensions.expected_errors((400, 403, 404, 409))
+    @wsgi.action('commitStopped')
+    def _light_commit_stopped(self, req, id, body):
+        """
+           With this function, you can commit the snapshots of all
+           the stopped instances that enable light snapshot.
+        """
+        context = req.environ['nova.context']
+        authorize(context, action='light_commit_stopped')
+        LOG.debug('Commit the light snapshots of all the stopped instances.')
+
+        host_api = compute.HostAPI()
+        compute_nodes = host_api.compute_node_get_all(context)
+        for node in compute_nodes:
+            host = node.hypervisor_hostname
+            self.compute_api.light_commit_stopped(context, host)
+
+
+    # Added by YuanruiFan. Run a light-snapshot action on a list of
+    # servers, loaded with one query and sent with one message per host.
+    # It is a collection action, POST /servers/light_snapshot_bulk.
+    @wsgi.response(202)
+    @extensions.expected_errors(400)
+    def light_snapshot_bulk(self, req, body):
+        """Run a light-snapshot action on a list of servers.
+
+           The body holds the action, one of LIGHT_SNAPSHOT_BULK_ACTIONS,
+           the ids of the servers and the options of the action. Every
+           server is accepted or rejected on its own.
+        """
+        context = req.environ['nova.context']
+        if not self.is_valid_body(body, 'lightSnapshotBulk'):
+            raise exc.HTTPBadRequest(
+                explanation=_('lightSnapshotBulk not specified.'))
+        entity = body['lightSnapshotBulk'] or {}
+        action = entity.get('action')
+        server_ids = entity.get('servers')
+        options = entity.get('options') or {}
+        if action not in LIGHT_SNAPSHOT_BULK_ACTIONS:
+            raise exc.HTTPBadRequest(
+                explanation=_('Invalid light-snapshot action %s.') % action)
+        if not server_ids or not isinstance(server_ids, list):
+            raise exc.HTTPBadRequest(
+                explanation=_('servers must be a non-empty list.'))
+        if (action == 'recoverInstance' and options.get('use_root') and
+                options.get('snap_index') is not None):
+            raise exc.HTTPBadRequest(explanation=_('recover command cannot have both use-root and snapshot-index arguments.'))
+        LOG.debug('Run %(action)s on %(count)d servers.',
+                  {'action': action, 'count': len(server_ids)})
+
+        errors = {}
+        uuids = [server_id for server_id in server_ids
+                 if uuidutils.is_uuid_like(server_id)]
+        instances = []
+        if uuids:
+            instances = objects.InstanceList.get_by_filters(
+                context, {'uuid': uuids, 'deleted': False},
+                expected_attrs=['light_snapshot'])
+
+        checked = []
+        for instance in instances:
+            try:
+                authorize(context, instance,
+                          LIGHT_SNAPSHOT_BULK_ACTIONS[action])
+            except exception.Forbidden as e:
+                errors[instance.uuid] = e.format_message()
+                continue
+            if (action in ('createSnapshot', 'recoverInstance') and
+                    not instance.light_snapshot_enable):
+                errors[instance.uuid] = _('The instance does not enable '
+                                          'light-snapshot.')
+                continue
+            checked.append(instance)
+
+        if action == 'createSnapshot':
+            errors.update(self.compute_api.light_snapshot_bulk(
+                context, checked, 'create_snapshot',
+                kwargs={'skip_empty': bool(options.get('skip_empty'))}))
+        elif action == 'commitSnapshot':
+            errors.update(self.compute_api.light_snapshot_bulk(
+                context, checked, 'commit_snapshot'))
+        elif action == 'recoverInstance':
+            errors.update(self.compute_api.light_snapshot_bulk(
+                context, checked, 'recover',
+                kwargs={'use_root': bool(options.get('use_root')),
+                        'snap_index': options.get('snap_index')}))
+        elif action == 'enableSnapshot':
+            errors.update(self.compute_api.light_snapshot_bulk(
+                context,
+                [instance for instance in checked
+                 if not instance.light_snapshot_enable],
+                'enable'))
+        else:
+            enable = bool(options.get('enable', True))
+            if action == 'dailySnapshot':
+                values = {'snapshot_daily': enable}
+            else:
+                values = {'snapshot_store': enable}
+            # The states of the servers are written with a single update.
+            updated = set(objects.InstanceLightSnapshotList.
+                          update_by_instance_uuids(
+                              context,
+                              [instance.uuid for instance in checked],
+                              values))
+            for instance in checked:
+                if instance.uuid not in updated:
+                    errors[instance.uuid] = exception.InstanceNotFound(
+                        instance_id=instance.uuid).format_message()
+            if action == 'storeSnapshot' and enable:
+                errors.update(self.compute_api.light_snapshot_bulk(
+                    context,
+                    [instance for instance in checked
+                     if instance.uuid in updated and
+                     instance.light_snapshot_enable],
+                    'store_init'))
+
+        found = set(instance.uuid for instance in instances)
+        results = []
+        for server_id in server_ids:
+            if server_id not in found:
+                results.append({'id': server_id, 'accepted': False,
+                                'reason': _('Instance %s could not be '
+                                            'found.') % server_id})
+            elif server_id in errors:
+                results.append({'id': server_id, 'accepted': False,
+                                'reason': errors[server_id]})
+            else:
+                results.append({'id': server_id, 'accepted': True})
+        return {'servers': results}
+
+
     @wsgi.response(202)
     @extensions.expected_errors((400, 403, 404, 409))
     @wsgi.action('createImage')
@@ -1414,7 +1647,9 @@ class Servers(extensions.V21APIExtensionBase):
 
     def get_resources(self):
         member_actions = {'action': 'POST'}
-        collection_actions = {'detail': 'GET'}
+        # Added by YuanruiFan. light_snapshot_bulk acts on a list of
+        # servers.
+        collection_actions = {'detail': 'GET', 'light_snapshot_bulk': 'POST'}
         resources = [
             extensions.ResourceExtension(
                 ALIAS,
@@ -53,7 +53,8 @@ class ViewBuilder(common.ViewBuilder):
     # These are the lazy-loadable instance attributes required for showing
     # details about an instance. Add to this list as new things need to be
     # shown.
-    _show_expected_attrs = ['flavor', 'info_cache', 'metadata']
+    _show_expected_attrs = ['flavor', 'info_cache', 'metadata',
+                            'light_snapshot']
 
     def __init__(self):
         """Initialize view builder."""
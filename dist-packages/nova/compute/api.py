@@ -20,6 +20,7 @@
 networking and storage of VMs, and compute hosts on which they run)."""
 
 import base64
+import collections
 import copy
 import functools
 import re
@@ -127,6 +128,23 @@ compute_opts = [
                     'that images will be automatically converted to volumes '
                     'and boot instances from volumes - it just means that all '
                     'requests that attempt to create a local disk will fail.'),
+    cfg.IntOpt('light_snapshot_coalesce_window',
+               default=0,
+               help='Number of seconds during which a light snapshot or '
+                    'commit request for an instance whose same operation '
+                    'is still pending is attached to that operation instead '
+                    'of being rejected. Set to 0 to disable'),
+    cfg.IntOpt('light_snapshot_max_in_flight_per_host',
+               default=0,
+               help='Maximum number of light snapshot, commit and recover '
+                    'operations in flight on a compute host. The requests '
+                    'over it are rejected until the host catches up. Set '
+                    'to 0 for no limit'),
+    cfg.IntOpt('light_snapshot_retry_after',
+               default=30,
+               help='Number of seconds a client is asked to wait before '
+                    'retrying a light-snapshot request rejected because the '
+                    'host of the instance is busy'),
 ]
 
 ephemeral_storage_encryption_group = cfg.OptGroup(
@@ -168,6 +186,51 @@ AGGREGATE_ACTION_UPDATE_META = 'UpdateMeta'
 AGGREGATE_ACTION_DELETE = 'Delete'
 AGGREGATE_ACTION_ADD = 'Add'
 
+_LIGHT_SNAPSHOT_VM_STATES = [vm_states.ACTIVE, vm_states.STOPPED,
+                             vm_states.PAUSED, vm_states.SUSPENDED]
+
+# Added by YuanruiFan. The light-snapshot operations which can be run on a
+# list of instances: the policy checked, the vm_states accepted, the
+# task_state the instances are put in before the cast, and the method of
+# the compute manager running the operation.
+LIGHT_SNAPSHOT_BULK_OPERATIONS = {
+    'create_snapshot': ('light_snapshot', [vm_states.ACTIVE],
+                        snapshot_task_states.VM_SNAPSHOT_PENDING,
+                        'light_snapshot_instance'),
+    'commit_snapshot': ('commit_snapshot', _LIGHT_SNAPSHOT_VM_STATES,
+                        snapshot_task_states.VM_COMMIT_START,
+                        'light_commit_snapshot'),
+    'recover': ('light_recover', _LIGHT_SNAPSHOT_VM_STATES,
+                snapshot_task_states.VM_RECOVER_START,
+                'light_recover_instance'),
+    'enable': ('enable_light_snapshot', _LIGHT_SNAPSHOT_VM_STATES, None,
+               'enable_light_snapshot'),
+    'store_init': ('store_snapshot_init', _LIGHT_SNAPSHOT_VM_STATES, None,
+                   'store_snapshot_init'),
+}
+
+# Added by YuanruiFan. The task_states of the light-snapshot operations
+# counted against light_snapshot_max_in_flight_per_host.
+LIGHT_SNAPSHOT_IN_FLIGHT_TASK_STATES = [
+    snapshot_task_states.VM_SNAPSHOT_PENDING,
+    snapshot_task_states.VM_SNAPSHOT,
+    snapshot_task_states.VM_SNAPSHOT_COMMIT,
+    snapshot_task_states.VM_COMMIT_START,
+    snapshot_task_states.VM_COMMITING,
+    snapshot_task_states.VM_RECOVER_START,
+    snapshot_task_states.VM_RECOVER_FROM_SNAPSHOT,
+]
+
+# Added by YuanruiFan. The task_states during which a new request for a
+# light-snapshot operation is attached to the same operation in flight.
+# A snapshot is only joined before the compute host takes it, so that it
+# covers the data written before the new request.
+LIGHT_SNAPSHOT_COALESCE_TASK_STATES = {
+    'create_snapshot': [snapshot_task_states.VM_SNAPSHOT_PENDING],
+    'commit_snapshot': [snapshot_task_states.VM_COMMIT_START,
+                        snapshot_task_states.VM_COMMITING],
+}
+
 
 def check_instance_state(vm_state=None, task_state=(None,),
                          must_have_launched=True):
@@ -210,6 +273,44 @@ def check_instance_state(vm_state=None, task_state=(None,),
     return outer
 
 
+def _light_snapshot_in_flight(instance, operation):
+    """Whether a new request for the light-snapshot operation can be
+    attached to the same operation in flight on instance.
+    """
+    window = CONF.light_snapshot_coalesce_window
+    if (window <= 0 or instance.task_state not in
+            LIGHT_SNAPSHOT_COALESCE_TASK_STATES.get(operation, [])):
+        return False
+    # updated_at is the last step of the operation in flight, at the latest.
+    return (instance.updated_at is not None and
+            not timeutils.is_older_than(instance.updated_at, window))
+
+
+def coalesce_light_snapshot(operation):
+    """Decorator attaching a light-snapshot request to the same operation
+    in flight on the instance, instead of failing it on its task_state.
+    """
+    def outer(f):
+        @functools.wraps(f)
+        def inner(self, context, instance, *args, **kw):
+            if _light_snapshot_in_flight(instance, operation):
+                LOG.debug('Attach the request to the %s in flight.',
+                          operation, instance=instance)
+                return
+            try:
+                return f(self, context, instance, *args, **kw)
+            except exception.UnexpectedTaskStateError:
+                # A concurrent request may have started the operation.
+                with excutils.save_and_reraise_exception() as ctxt:
+                    instance.refresh()
+                    if _light_snapshot_in_flight(instance, operation):
+                        LOG.debug('Attach the request to the %s in flight.',
+                                  operation, instance=instance)
+                        ctxt.reraise = False
+        return inner
+    return outer
+
+
 def check_instance_host(function):
     @functools.wraps(function)
     def wrapped(self, context, instance, *args, **kwargs):
@@ -2286,6 +2387,7 @@ class API(base.Base):
     @wrap_check_policy
     @check_instance_host
     @check_instance_cell
+    @coalesce_light_snapshot('create_snapshot')
     @check_instance_state(vm_state=[vm_states.ACTIVE])
     def light_snapshot(self, context, instance):
         """Take an external(light) snapshot for the given instance.
@@ -2293,11 +2395,174 @@ class API(base.Base):
         :param instance: nova.objects.instance.Instance object
         """
 
+        self._check_light_snapshot_admission(context, instance)
+
         instance.task_state = snapshot_task_states.VM_SNAPSHOT_PENDING 
         instance.save(expected_task_state=[None])
 
         self.compute_rpcapi.light_snapshot_instance(context, instance)
 
+    # Added by YuanruiFan. Take light snapshots of a list of instances, with
+    # one message for all the instances of a host.
+    def light_snapshot_instances(self, context, instances, options=None):
+        """Take an external(light) snapshot for each of the given instances.
+
+        :param instances: list of nova.objects.instance.Instance objects
+        :param options: dict of options of the snapshots, see
+                        ComputeManager.light_snapshot_instances
+        :returns: dict of the uuids of the instances which cannot be
+                  snapshotted to the reason
+        """
+        return self.light_snapshot_bulk(context, instances,
+                                        'create_snapshot', kwargs=options)
+
+    def _light_snapshot_admission(self, context, hosts):
+        """Return the number of light-snapshot operations each of hosts may
+        still take, or None if light_snapshot_max_in_flight_per_host is not
+        set.
+        """
+        limit = CONF.light_snapshot_max_in_flight_per_host
+        if limit <= 0:
+            return None
+        counts = objects.InstanceList.count_by_hosts_and_task_states(
+            context, list(hosts), LIGHT_SNAPSHOT_IN_FLIGHT_TASK_STATES)
+        return dict((host, max(limit - counts.get(host, 0), 0))
+                    for host in hosts)
+
+    def _light_snapshot_host_busy(self, instance):
+        return exception.LightSnapshotHostBusy(
+            instance_uuid=instance.uuid,
+            count=CONF.light_snapshot_max_in_flight_per_host,
+            retry_after=CONF.light_snapshot_retry_after)
+
+    def _check_light_snapshot_admission(self, context, instance):
+        """Reject a light-snapshot operation if the host of instance already
+        runs light_snapshot_max_in_flight_per_host of them.
+        """
+        free = self._light_snapshot_admission(context, [instance.host])
+        if free is not None and not free[instance.host]:
+            raise self._light_snapshot_host_busy(instance)
+
+    def _check_light_snapshot_bulk(self, context, instance, operation):
+        """Run the checks of the decorators of a light-snapshot operation
+        on one instance of a bulk request.
+
+        :returns: True if the request is attached to the same operation in
+                  flight on the instance
+        """
+        policy, vm_state, task_state, method = (
+            LIGHT_SNAPSHOT_BULK_OPERATIONS[operation])
+        if not self.skip_policy_check:
+            check_policy(context, policy, instance)
+        if not instance.host:
+            raise exception.InstanceNotReady(instance_id=instance.uuid)
+        self._validate_cell(instance, policy)
+        if _light_snapshot_in_flight(instance, operation):
+            return True
+        for attr, allowed in (('vm_state', vm_state),
+                              ('task_state', [None])):
+            if getattr(instance, attr) not in allowed:
+                raise exception.InstanceInvalidState(
+                    attr=attr,
+                    instance_uuid=instance.uuid,
+                    state=getattr(instance, attr),
+                    method=policy)
+        if not instance.launched_at:
+            raise exception.InstanceInvalidState(
+                attr='launched_at',
+                instance_uuid=instance.uuid,
+                state=instance.launched_at,
+                method=policy)
+        return False
+
+    # Added by YuanruiFan. Run a light-snapshot operation on a list of
+    # instances, with one database update of their task_state and one
+    # message for all the instances of a host.
+    def light_snapshot_bulk(self, context, instances, operation,
+                            kwargs=None):
+        """Run a light-snapshot operation on each of the given instances.
+
+        :param instances: list of nova.objects.instance.Instance objects
+        :param operation: one of LIGHT_SNAPSHOT_BULK_OPERATIONS
+        :param kwargs: dict of the arguments of the operation
+        :returns: dict of the uuids of the instances rejected to the reason
+        """
+        policy, vm_state, task_state, method = (
+            LIGHT_SNAPSHOT_BULK_OPERATIONS[operation])
+        errors = {}
+        accepted = []
+        for instance in instances:
+            try:
+                if self._check_light_snapshot_bulk(context, instance,
+                                                   operation):
+                    # Accepted, the operation in flight serves it.
+                    continue
+            except (exception.Forbidden,
+                    exception.InstanceInvalidState,
+                    exception.InstanceNotReady,
+                    exception.InstanceUnknownCell) as e:
+                errors[instance.uuid] = e.format_message()
+                continue
+            accepted.append(instance)
+
+        if task_state is not None and accepted:
+            free = self._light_snapshot_admission(
+                context, set(instance.host for instance in accepted))
+            if free is not None:
+                admitted = []
+                for instance in accepted:
+                    if not free[instance.host]:
+                        errors[instance.uuid] = self._light_snapshot_host_busy(
+                            instance).format_message()
+                        continue
+                    free[instance.host] -= 1
+                    admitted.append(instance)
+                accepted = admitted
+
+        if task_state is not None and accepted:
+            updated = set(objects.InstanceList.set_task_state(
+                context, [instance.uuid for instance in accepted],
+                task_state, expected_task_state=None))
+            joined = set()
+            missed = [instance.uuid for instance in accepted
+                      if instance.uuid not in updated]
+            if missed and CONF.light_snapshot_coalesce_window > 0:
+                # Concurrent requests may have started the operation.
+                joined = set(
+                    instance.uuid for instance in
+                    objects.InstanceList.get_by_filters(
+                        context, {'uuid': missed, 'deleted': False},
+                        expected_attrs=[])
+                    if _light_snapshot_in_flight(instance, operation))
+            marked = []
+            for instance in accepted:
+                if instance.uuid in joined:
+                    continue
+                if instance.uuid not in updated:
+                    # Another request changed the task_state, or the
+                    # instance has been deleted, since it was loaded.
+                    errors[instance.uuid] = (
+                        _('The instance %s is busy or has been deleted.') %
+                        instance.uuid)
+                    continue
+                instance.task_state = task_state
+                instance.obj_reset_changes(['task_state'])
+                marked.append(instance)
+            accepted = marked
+
+        instances_by_host = collections.defaultdict(list)
+        for instance in accepted:
+            instances_by_host[instance.host].append(instance)
+
+        for host, host_instances in instances_by_host.items():
+            if operation == 'create_snapshot':
+                self.compute_rpcapi.light_snapshot_instances(
+                    context, host, host_instances, options=kwargs)
+            else:
+                self.compute_rpcapi.light_snapshot_bulk(
+                    context, host, method, host_instances, kwargs=kwargs)
+        return errors
+
     @wrap_check_policy
     def light_snapshot_all(self, context, host, daily=False):
         """Take an external(light) snapshot for the given instance.
@@ -2306,6 +2571,13 @@ class API(base.Base):
         """
         self.compute_rpcapi.light_snapshot_all(context, host, daily=daily)
 
+    # Added by YuanruiFan. Commit the light snapshots of all the stopped
+    # instances of a host.
+    @wrap_check_policy
+    def light_commit_stopped(self, context, host):
+        """Commit the light snapshots of the stopped instances of host."""
+        self.compute_rpcapi.light_commit_stopped(context, host)
+
     
     # Added by YuanruiFan. To recover the instance from its snapshot.
     # We do not check instance lock for snapshot because lock is
@@ -2321,6 +2593,8 @@ class API(base.Base):
         :param instance: nova.objects.instance.Instance object
         """
 
+        self._check_light_snapshot_admission(context, instance)
+
         instance.task_state = snapshot_task_states.VM_RECOVER_START
         instance.save(expected_task_state=[None])
 
@@ -2334,6 +2608,7 @@ class API(base.Base):
     @wrap_check_policy
     @check_instance_host
     @check_instance_cell
+    @coalesce_light_snapshot('commit_snapshot')
     @check_instance_state(vm_state=[vm_states.ACTIVE, vm_states.STOPPED,
                                     vm_states.PAUSED, vm_states.SUSPENDED])
     def commit_snapshot(self, context, instance):
@@ -2342,10 +2617,46 @@ class API(base.Base):
         :param instance: nova.objects.instance.Instance object
         """
 
+        self._check_light_snapshot_admission(context, instance)
+
         instance.task_state = snapshot_task_states.VM_COMMIT_START
         instance.save(expected_task_state=[None])
 
         self.compute_rpcapi.light_commit_snapshot(context, instance)    
+
+    # Added by YuanruiFan. Get the execute profile of the last
+    # light-snapshot operation of the instance.
+    @wrap_check_policy
+    @check_instance_host
+    def get_light_snapshot_profile(self, context, instance):
+        """Get the execute profile of the last light-snapshot operation.
+
+        :param instance: nova.objects.instance.Instance object
+        """
+        return self.compute_rpcapi.get_light_snapshot_profile(context,
+                                                              instance)
+
+    # Added by YuanruiFan. Pre-stage the read-only light-snapshot layers
+    # of the instance on the host it is going to be migrated to.
+    @wrap_check_policy
+    @check_instance_host
+    @check_instance_cell
+    @check_instance_state(vm_state=[vm_states.ACTIVE, vm_states.STOPPED,
+                                    vm_states.PAUSED, vm_states.SUSPENDED])
+    def prestage_light_snapshot(self, context, instance, host=None):
+        """Pre-stage the light-snapshot layers of the instance on host.
+
+        :param instance: nova.objects.instance.Instance object
+        :param host: destination host, or None to cancel the pre-stage
+        """
+        if host:
+            if host == instance.host:
+                raise exception.Invalid(
+                    _('The instance is already on host %s.') % host)
+            # Make sure the host exists before we ask the source to copy.
+            objects.Service.get_by_compute_host(context.elevated(), host)
+
+        self.compute_rpcapi.prestage_light_snapshot(context, instance, host)
     
     # NOTE(melwitt): We don't check instance lock for snapshot because lock is
     #                intended to prevent accidental change/delete of instances
@@ -0,0 +1,174 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Intent journal of the multi-step light-snapshot operations.
+
+   An operation such as post_commit or a recover from a snapshot index is
+   a sequence of steps (rebase, mv, rm, database update) which leaves a
+   broken chain when it is interrupted halfway. The whole sequence is
+   written to the instance directory before the first step runs, and the
+   number of finished steps is recorded after each of them. When a step
+   fails before the commit point, the operation is rolled back at once.
+   An unfinished journal left by a failure past the commit point, or by a
+   restart of the compute service, is rolled back if it stopped before its
+   commit point, and replayed otherwise.
+
+   The steps are run by handlers given by the driver, which must be
+   idempotent since the last step may be run twice.
+"""
+
+import json
+import os
+
+from oslo_log import log as logging
+from oslo_utils import excutils
+
+from nova import exception
+from nova.i18n import _
+from nova.i18n import _LE
+from nova.i18n import _LI
+from nova.i18n import _LW
+
+
+LOG = logging.getLogger(__name__)
+
+JOURNAL_FILENAME = 'light_snapshot.journal'
+
+
+class Journal(object):
+    """Write-ahead record of one light-snapshot operation."""
+
+    def __init__(self, path, operation, steps, done=0, commit_point=0,
+                 rollback=None):
+        self.path = path
+        self.operation = operation
+        self.steps = steps
+        self.done = done
+        self.commit_point = commit_point
+        self.rollback = rollback or []
+
+    @classmethod
+    def begin(cls, instance_path, operation, steps, commit_point=0,
+              rollback=None):
+        """Record a new operation before any of its steps runs.
+
+           :param steps: list of [name, arg, ...] steps
+           :param commit_point: number of steps after which the operation
+                                is replayed instead of rolled back
+           :param rollback: steps undoing the steps before commit_point
+        """
+        path = os.path.join(instance_path, JOURNAL_FILENAME)
+        if os.path.exists(path):
+            msg = (_('An unfinished light-snapshot operation is recorded '
+                     'in %s.') % path)
+            raise exception.NovaException(msg)
+
+        journal = cls(path, operation, steps, commit_point=commit_point,
+                      rollback=rollback)
+        journal._write()
+        return journal
+
+    @classmethod
+    def load(cls, instance_path):
+        """Return the unfinished journal of an instance, or None."""
+        path = os.path.join(instance_path, JOURNAL_FILENAME)
+        if not os.path.exists(path):
+            return None
+
+        with open(path) as f:
+            data = json.load(f)
+        return cls(path, data['operation'], data['steps'],
+                   done=data['done'], commit_point=data['commit_point'],
+                   rollback=data['rollback'])
+
+    def run(self, handlers):
+        """Run the steps which have not finished yet, then forget the
+           operation.
+
+           A failed step before the commit point rolls the operation back.
+           Past it the journal is kept, to be replayed by recover.
+        """
+        try:
+            while self.done < len(self.steps):
+                self._run_step(handlers, self.steps[self.done])
+                self.done += 1
+                self._write()
+        except Exception:
+            with excutils.save_and_reraise_exception():
+                if self.done < self.commit_point:
+                    LOG.warning(_LW('Light-snapshot %(operation)s failed at '
+                                    'step %(done)d, rolling it back'),
+                                {'operation': self.operation,
+                                 'done': self.done})
+                    try:
+                        self._roll_back(handlers)
+                    except Exception:
+                        LOG.exception(_LE('Failed to roll back the '
+                                          'light-snapshot %(operation)s, '
+                                          'it is left in %(path)s'),
+                                      {'operation': self.operation,
+                                       'path': self.path})
+        self.finish()
+
+    def recover(self, handlers):
+        """Roll back or replay an unfinished operation."""
+        if self.done < self.commit_point:
+            LOG.info(_LI('Rolling back the interrupted light-snapshot '
+                         '%(operation)s after %(done)d steps'),
+                     {'operation': self.operation, 'done': self.done})
+            self._roll_back(handlers)
+        else:
+            LOG.info(_LI('Replaying the interrupted light-snapshot '
+                         '%(operation)s from step %(done)d of %(count)d'),
+                     {'operation': self.operation, 'done': self.done,
+                      'count': len(self.steps)})
+            self.run(handlers)
+
+    def _roll_back(self, handlers):
+        for step in self.rollback:
+            self._run_step(handlers, step)
+        self.finish()
+
+    def finish(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+            self._sync_dir()
+
+    def _run_step(self, handlers, step):
+        name, args = step[0], step[1:]
+        if name not in handlers:
+            msg = (_('Unknown light-snapshot journal step %s.') % name)
+            raise exception.NovaException(msg)
+        LOG.debug('Light-snapshot %(operation)s step %(step)s',
+                  {'operation': self.operation, 'step': step})
+        handlers[name](*args)
+
+    def _write(self):
+        data = {'operation': self.operation,
+                'steps': self.steps,
+                'done': self.done,
+                'commit_point': self.commit_point,
+                'rollback': self.rollback}
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(data, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp_path, self.path)
+        self._sync_dir()
+
+    def _sync_dir(self):
+        fd = os.open(os.path.dirname(self.path), os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
@@ -0,0 +1,156 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Run the blocking libvirt calls of light-snapshot operations in native
+   threads, and watch the eventlet hub while the operations run.
+
+   snapshotCreateXML, blockCommit or blockJobAbort may wait on QEMU for a
+   long time. Called from a greenthread, they would block every other
+   greenthread of nova-compute, so they are run in the eventlet thread
+   pool, a bounded number of them at a time.
+"""
+
+import sys
+import time
+import traceback
+
+import eventlet
+from eventlet import patcher
+from eventlet import tpool
+from oslo_config import cfg
+from oslo_log import log as logging
+
+from nova.compute.light_snapshot import profiler as light_profiler
+from nova.i18n import _LW
+
+
+native_opts = [
+    cfg.IntOpt('light_snapshot_native_threads',
+               default=4,
+               help='Maximum number of libvirt calls of light-snapshot '
+                    'operations running at the same time in native '
+                    'threads'),
+    cfg.FloatOpt('light_snapshot_hub_stall_threshold',
+                 default=1.0,
+                 help='Number of seconds the eventlet hub may be blocked '
+                      'during a light-snapshot operation before the '
+                      'greenthread blocking it is reported. Set to 0 to '
+                      'disable'),
+    ]
+
+CONF = cfg.CONF
+CONF.register_opts(native_opts)
+
+LOG = logging.getLogger(__name__)
+
+_native_threading = patcher.original('threading')
+_native_time = patcher.original('time')
+
+_semaphore = None
+_detector = None
+
+
+def _get_semaphore():
+    global _semaphore
+    if _semaphore is None:
+        _semaphore = eventlet.semaphore.Semaphore(
+            max(CONF.light_snapshot_native_threads, 1))
+    return _semaphore
+
+
+def call(name, func, *args, **kwargs):
+    """Run func in a native thread and account its duration."""
+    with _get_semaphore():
+        start = time.time()
+        with light_profiler.timed((name,)):
+            try:
+                return tpool.execute(func, *args, **kwargs)
+            finally:
+                LOG.debug('%(name)s took %(time).3fs',
+                          {'name': name, 'time': time.time() - start})
+
+
+class NativeProxy(object):
+    """Run the methods of a libvirt object through call()."""
+
+    def __init__(self, obj, prefix='virDomain'):
+        self._obj = obj
+        self._prefix = prefix
+
+    def __getattr__(self, name):
+        attr = getattr(self._obj, name)
+        if not callable(attr):
+            return attr
+
+        def _call(*args, **kwargs):
+            return call('%s.%s' % (self._prefix, name), attr, *args,
+                        **kwargs)
+        return _call
+
+
+class HubStallDetector(object):
+    """Report the greenthreads blocking the eventlet hub.
+
+       A greenthread updates a heartbeat, and a native thread checks that
+       it keeps being updated while light-snapshot operations run. The
+       stack of the blocking greenthread is taken by the native thread and
+       logged once the hub runs again, since logging from a native thread
+       could wait on a green lock.
+    """
+
+    def __init__(self, threshold):
+        self.threshold = threshold
+        self.heartbeat = time.time()
+        self.hub_thread_id = _native_threading.current_thread().ident
+        self.stall = None
+
+    def start(self):
+        eventlet.spawn_n(self._beat)
+        thread = _native_threading.Thread(target=self._watch)
+        thread.daemon = True
+        thread.start()
+
+    def _beat(self):
+        while True:
+            now = time.time()
+            stall, self.stall = self.stall, None
+            if stall is not None:
+                LOG.warning(_LW('The eventlet hub was blocked for %(time).1fs '
+                                'during a light-snapshot operation by:\n'
+                                '%(stack)s'),
+                            {'time': now - self.heartbeat,
+                             'stack': stall})
+            self.heartbeat = now
+            eventlet.sleep(self.threshold / 4)
+
+    def _watch(self):
+        heartbeat = None
+        while True:
+            _native_time.sleep(self.threshold / 4)
+            if (light_profiler.active_operations() == 0 or
+                    heartbeat == self.heartbeat or
+                    time.time() - self.heartbeat < self.threshold):
+                continue
+
+            heartbeat = self.heartbeat
+            frame = sys._current_frames().get(self.hub_thread_id)
+            if frame is not None:
+                self.stall = ''.join(traceback.format_stack(frame))
+
+
+def start_stall_detector():
+    """Start watching the hub if a threshold is configured."""
+    global _detector
+    if _detector is not None or CONF.light_snapshot_hub_stall_threshold <= 0:
+        return
+    _detector = HubStallDetector(CONF.light_snapshot_hub_stall_threshold)
+    _detector.start()
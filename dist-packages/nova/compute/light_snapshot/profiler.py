@@ -0,0 +1,222 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Accounting of the external commands run by light-snapshot operations.
+
+   Most of the cost of a light-snapshot operation is spent in spawning
+   processes (qemu-img, mv, rm, chmod, often through rootwrap). When
+   profiling is enabled, every command executed inside a profile() block
+   is counted and timed, and tagged with the function that issued it.
+"""
+
+import collections
+import contextlib
+import sys
+import threading
+import time
+
+from oslo_config import cfg
+from oslo_log import log as logging
+
+
+profiler_opts = [
+    cfg.BoolOpt('light_snapshot_profile_execute',
+                default=False,
+                help='Count and time every external command executed during '
+                     'a light-snapshot operation and add the results to '
+                     'the notification sent at the end of the operation'),
+    cfg.IntOpt('light_snapshot_profile_history',
+               default=256,
+               help='Number of instances whose last light-snapshot execute '
+                    'profile is kept in memory by the compute service'),
+    ]
+
+CONF = cfg.CONF
+CONF.register_opts(profiler_opts)
+
+LOG = logging.getLogger(__name__)
+
+# Modules whose frames are skipped when looking for the function that
+# issued a command.
+_WRAPPER_MODULES = (__name__, 'nova.utils', 'nova.virt.images',
+                    'nova.virt.libvirt.utils', 'oslo_concurrency.processutils',
+                    'nova.compute.light_snapshot.native', 'contextlib')
+
+# NOTE: nova-compute monkey patches threading, so this is local to the
+# greenthread that runs the operation.
+_local = threading.local()
+
+_last_profiles = collections.OrderedDict()
+
+# Number of light-snapshot operations running, profiled or not.
+_active = {'count': 0}
+
+
+class ExecuteProfile(object):
+    """Execute accounting of one light-snapshot operation."""
+
+    def __init__(self, instance_uuid, operation):
+        self.instance_uuid = instance_uuid
+        self.operation = operation
+        self.started_at = time.time()
+        self.finished_at = None
+        self.count = 0
+        self.total_time = 0.0
+        self.root_count = 0
+        self.failed_count = 0
+        self.commands = {}
+        self.callers = {}
+
+    def record(self, command, caller, duration, as_root=False, failed=False):
+        self.count += 1
+        self.total_time += duration
+        if as_root:
+            self.root_count += 1
+        if failed:
+            self.failed_count += 1
+
+        for stats, key in ((self.commands, command), (self.callers, caller)):
+            entry = stats.setdefault(key, {'count': 0, 'time': 0.0})
+            entry['count'] += 1
+            entry['time'] += duration
+
+    def finish(self):
+        self.finished_at = time.time()
+
+    def to_dict(self):
+        end = self.finished_at or time.time()
+
+        def _rounded(stats):
+            return dict((key, {'count': value['count'],
+                               'time': round(value['time'], 3)})
+                        for key, value in stats.items())
+
+        return {'instance_uuid': self.instance_uuid,
+                'operation': self.operation,
+                'wall_time': round(end - self.started_at, 3),
+                'execute_count': self.count,
+                'execute_time': round(self.total_time, 3),
+                'root_count': self.root_count,
+                'failed_count': self.failed_count,
+                'commands': _rounded(self.commands),
+                'callers': _rounded(self.callers)}
+
+
+def current():
+    """Return the profile of the running operation, or None."""
+    return getattr(_local, 'profile', None)
+
+
+@contextlib.contextmanager
+def profile(instance_uuid, operation):
+    """Profile the commands executed by a light-snapshot operation.
+
+       Yields None when profiling is disabled. Nested operations are
+       accounted to the outermost profile.
+    """
+    _active['count'] += 1
+    try:
+        with _profile(instance_uuid, operation) as prof:
+            yield prof
+    finally:
+        _active['count'] -= 1
+
+
+def active_operations():
+    """Return the number of light-snapshot operations running."""
+    return _active['count']
+
+
+@contextlib.contextmanager
+def _profile(instance_uuid, operation):
+    if not CONF.light_snapshot_profile_execute:
+        yield None
+        return
+
+    parent = current()
+    if parent is not None:
+        yield parent
+        return
+
+    prof = ExecuteProfile(instance_uuid, operation)
+    _local.profile = prof
+    try:
+        yield prof
+    finally:
+        _local.profile = None
+        prof.finish()
+        _remember(prof)
+        LOG.debug('Light-snapshot %(operation)s ran %(count)d commands '
+                  'in %(time).3fs', {'operation': operation,
+                                     'count': prof.count,
+                                     'time': prof.total_time})
+
+
+def _remember(prof):
+    _last_profiles.pop(prof.instance_uuid, None)
+    _last_profiles[prof.instance_uuid] = prof
+    while len(_last_profiles) > max(CONF.light_snapshot_profile_history, 0):
+        _last_profiles.popitem(last=False)
+
+
+def get_last_profile(instance_uuid):
+    """Return the last recorded profile of an instance as a dict."""
+    prof = _last_profiles.get(instance_uuid)
+    if prof is None:
+        return None
+    return prof.to_dict()
+
+
+def usage_info(prof):
+    """Extra notification payload for a finished profile."""
+    if prof is None:
+        return {}
+    return {'execute_profile': prof.to_dict()}
+
+
+def _command_name(cmd):
+    if not cmd:
+        return 'unknown'
+    name = str(cmd[0])
+    if name == 'qemu-img' and len(cmd) > 1:
+        name = '%s %s' % (name, cmd[1])
+    return name
+
+
+def _caller():
+    frame = sys._getframe(1)
+    while frame is not None:
+        if frame.f_globals.get('__name__') not in _WRAPPER_MODULES:
+            return frame.f_code.co_name
+        frame = frame.f_back
+    return 'unknown'
+
+
+@contextlib.contextmanager
+def timed(cmd, as_root=False):
+    """Account the command run inside the block to the current profile."""
+    prof = current()
+    if prof is None:
+        yield
+        return
+
+    caller = _caller()
+    start = time.time()
+    failed = False
+    try:
+        yield
+    except Exception:
+        failed = True
+        raise
+    finally:
+        prof.record(_command_name(cmd), caller, time.time() - start,
+                    as_root=as_root, failed=failed)
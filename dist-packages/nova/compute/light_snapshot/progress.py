@@ -0,0 +1,85 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Propagate the progress of light-snapshot operations to the instance.
+
+   Block jobs and qemu-img report their position very often, so the
+   updates written to instance.progress are rate limited.
+"""
+
+import time
+
+from oslo_config import cfg
+from oslo_log import log as logging
+
+from nova import exception
+
+
+progress_opts = [
+    cfg.IntOpt('light_snapshot_progress_interval',
+               default=5,
+               help='Minimum number of seconds between two instance progress '
+                    'updates written during a light-snapshot commit or '
+                    'recover'),
+    cfg.IntOpt('light_snapshot_progress_step',
+               default=5,
+               help='Minimum change of the progress, in percent, before it '
+                    'is written to the instance'),
+    ]
+
+CONF = cfg.CONF
+CONF.register_opts(progress_opts)
+
+LOG = logging.getLogger(__name__)
+
+
+class InstanceProgress(object):
+    """Rate limited writer of instance.progress."""
+
+    def __init__(self, instance):
+        self.instance = instance
+        self.last_percent = None
+        self.last_update = 0
+
+    def update(self, cur, end):
+        """Report that the operation has reached position cur of end."""
+        if not end:
+            return
+        percent = max(0, min(100, int(cur * 100 / end)))
+
+        if self.last_percent is not None:
+            if percent == self.last_percent:
+                return
+            if percent < 100:
+                if (abs(percent - self.last_percent) <
+                        CONF.light_snapshot_progress_step):
+                    return
+                if (time.time() - self.last_update <
+                        CONF.light_snapshot_progress_interval):
+                    return
+
+        self._write(percent)
+
+    def finish(self):
+        """Report that the operation has completed."""
+        if self.last_percent != 100:
+            self._write(100)
+
+    def _write(self, percent):
+        self.last_percent = percent
+        self.last_update = time.time()
+        self.instance.progress = percent
+        try:
+            self.instance.save()
+        except exception.InstanceNotFound:
+            LOG.debug('Instance disappeared while updating progress',
+                      instance=self.instance)
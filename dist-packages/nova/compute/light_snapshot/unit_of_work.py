@@ -0,0 +1,86 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Coalesce the instance saves of a light-snapshot operation.
+
+   A light snapshot changes snapshot_index, snapshot_committed, root_index
+   and task_state at different points, and every instance.save() is a
+   round trip to the conductor. Inside a unit of work, the saves issued
+   through save() only leave the fields changed on the instance object,
+   and they are all written by the next real save: a checkpoint of the
+   operation, such as a task_state change, or the end of the unit.
+
+   Saves whose result has to be on the database before the next step runs,
+   such as the steps of the journal, and saves recording the state of the
+   disk chain right after a pivot or a commit, which a crash must not leave
+   behind the disks, must call instance.save() directly.
+"""
+
+import contextlib
+import threading
+
+
+# NOTE: nova-compute monkey patches threading, so this is local to the
+# greenthread that runs the operation.
+_local = threading.local()
+
+
+class UnitOfWork(object):
+    """Deferred saves of one instance."""
+
+    def __init__(self, instance):
+        self.instance = instance
+        self.deferred = 0
+
+    def flush(self, **kwargs):
+        """Write the pending changes, with the arguments of save()."""
+        self.deferred = 0
+        self.instance.save(**kwargs)
+
+
+def _units():
+    if not hasattr(_local, 'units'):
+        _local.units = {}
+    return _local.units
+
+
+@contextlib.contextmanager
+def unit_of_work(instance):
+    """Defer the saves of instance made through save() inside the block.
+
+       The pending changes are written when the block exits, unless they
+       have been flushed already. Nested units share the outermost one.
+    """
+    units = _units()
+    parent = units.get(instance.uuid)
+    if parent is not None:
+        yield parent
+        return
+
+    unit = UnitOfWork(instance)
+    units[instance.uuid] = unit
+    try:
+        yield unit
+    finally:
+        del units[instance.uuid]
+        # A real save made inside the block may have written them.
+        if unit.deferred and instance.obj_what_changed():
+            unit.flush()
+
+
+def save(instance):
+    """Save instance, or defer it to the unit of work of the instance."""
+    unit = _units().get(instance.uuid)
+    if unit is None:
+        instance.save()
+    else:
+        unit.deferred += 1
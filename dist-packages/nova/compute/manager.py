@@ -49,6 +49,7 @@ from oslo_service import periodic_task
 from oslo_utils import excutils
 from oslo_utils import strutils
 from oslo_utils import timeutils
+from oslo_utils import units
 import six
 from six.moves import range
 
@@ -64,7 +65,10 @@ from nova.compute import rpcapi as compute_rpcapi
 from nova.compute import task_states
 from nova.compute import utils as compute_utils
 from nova.compute import vm_states
+from nova.compute.light_snapshot import native as light_native
+from nova.compute.light_snapshot import profiler as light_profiler
 from nova.compute.light_snapshot import snapshot_task_states
+from nova.compute.light_snapshot import unit_of_work as light_uow
 from nova import conductor
 from nova import consoleauth
 import nova.context
@@ -149,7 +153,41 @@ compute_opts = [
     cfg.BoolOpt('light_snapshot_enabled',
                 default=True,
                 help='Whether to use our light_snapshot system '
-                     'for the cloud platform')
+                     'for the cloud platform'),
+    cfg.StrOpt('light_snapshot_migrate_mode',
+               default='commit',
+               choices=('commit', 'chain'),
+               help='How the light-snapshot chain of an instance is handled '
+                    'by a resize or cold migration. "commit" commits all '
+                    'the snapshots into the root disk first, "chain" '
+                    'carries the chain to the destination as it is when '
+                    'the root disk is not resized. Block live migrations '
+                    'always carry the chain'),
+    cfg.BoolOpt('light_snapshot_skip_empty',
+                default=True,
+                help='Skip the instances whose current light-snapshot '
+                     'overlay has not been written to when snapshotting '
+                     'all the instances of a host'),
+    cfg.IntOpt('light_snapshot_overlay_max_mb',
+               default=1024,
+               help='Size in MB of the current light-snapshot overlay above '
+                    'which the adaptive schedule snapshots an instance'),
+    cfg.IntOpt('light_snapshot_rpo',
+               default=86400,
+               help='Maximum number of seconds the adaptive schedule lets '
+                    'pass between two light snapshots of an instance that '
+                    'has been written to'),
+    cfg.IntOpt('light_snapshot_init_workers',
+               default=8,
+               help='Maximum number of instances whose light-snapshot chain '
+                    'is checked or initialized at the same time when the '
+                    'compute service starts'),
+    cfg.IntOpt('light_snapshot_all_workers',
+               default=4,
+               help='Maximum number of instances snapshotted at the same '
+                    'time when snapshotting all the instances of a host, '
+                    'a list of instances sent together, or the instances '
+                    'due by the adaptive schedule'),
     ]
 
 interval_opts = [
@@ -207,6 +245,20 @@ interval_opts = [
                     'at the default periodic interval. Setting it to any '
                     'positive value will cause it to run at approximately '
                     'that number of seconds.'),
+    # Added by YuanruiFan.
+    cfg.IntOpt('light_snapshot_adaptive_interval',
+               default=-1,
+               help='Interval in seconds for sampling the disk writes of the '
+                    'light-snapshot instances and snapshotting those whose '
+                    'overlay is too big or whose last snapshot is older than '
+                    'light_snapshot_rpo. Set to -1 to disable. '
+                    'Setting this to 0 will run at the default rate.'),
+    cfg.IntOpt('light_snapshot_prestage_interval',
+               default=600,
+               help='Interval in seconds for bringing the light-snapshot '
+                    'layers pre-staged on a migration destination up to '
+                    'date. Set to -1 to disable. '
+                    'Setting this to 0 will run at the default rate.'),
 ]
 
 timeout_opts = [
@@ -281,6 +333,16 @@ CONF.import_opt('scheduler_tracks_instance_changes',
 
 LOG = logging.getLogger(__name__)
 
+# Added by YuanruiFan. System metadata key holding the host the
+# light-snapshot layers of an instance are pre-staged on.
+LIGHT_SNAPSHOT_PRESTAGE_HOST = 'light_snapshot_prestage_host'
+
+# Added by YuanruiFan. The operations light_snapshot_bulk may run.
+LIGHT_SNAPSHOT_BULK_METHODS = ('light_commit_snapshot',
+                               'light_recover_instance',
+                               'enable_light_snapshot',
+                               'store_snapshot_init')
+
 get_notifier = functools.partial(rpc.get_notifier, service='compute')
 wrap_exception = functools.partial(exception.wrap_exception,
                                    get_notifier=get_notifier)
@@ -705,6 +767,12 @@ class ComputeManager(manager.Manager):
         self.instance_events = InstanceEvents()
         self._sync_power_pool = eventlet.GreenPool()
         self._syncs_in_progress = {}
+        # Added by YuanruiFan. Snapshot index and written bytes of the last
+        # light snapshot seen by the adaptive schedule, and the pool its
+        # snapshots run in.
+        self._light_snapshot_write_marks = {}
+        self._light_snapshot_adaptive_pool = eventlet.GreenPool(
+            max(CONF.light_snapshot_all_workers, 1))
         self.send_instance_updates = CONF.scheduler_tracks_instance_changes
         if CONF.max_concurrent_builds != 0:
             self._build_semaphore = eventlet.semaphore.Semaphore(
@@ -1044,6 +1112,37 @@ class ComputeManager(manager.Manager):
                 self._set_instance_obj_error_state(context, instance)
             return
 
+        # Added by YuanruiFan. Roll back or finish the light-snapshot
+        # operation interrupted by the restart, from the journal kept in
+        # the instance directory.
+        if instance.light_snapshot_enable:
+            try:
+                recovered = self.driver.recover_light_snapshot_journal(
+                    context, instance)
+            except Exception:
+                # we don't want that an exception blocks the init_host
+                recovered = False
+                LOG.exception(_LE('Failed to recover the light-snapshot '
+                                  'journal'), instance=instance)
+            if (recovered and instance.task_state ==
+                    snapshot_task_states.VM_RECOVER_FROM_SNAPSHOT):
+                instance.task_state = None
+                instance.save()
+
+        # Added by YuanruiFan. The blockCommit of a light-snapshot commit
+        # interrupted by the restart keeps running in QEMU. It is attached
+        # to again in the background, so that a long commit does not hold
+        # up the start of the service.
+        if (instance.vm_state != vm_states.ERROR and
+            instance.task_state in [snapshot_task_states.VM_SNAPSHOT_COMMIT,
+                                    snapshot_task_states.VM_COMMITING]):
+            LOG.info(_LI('Service started committing the light snapshots of '
+                         'the instance during the previous run, but did not '
+                         'finish. Resuming the commit now.'),
+                     instance=instance)
+            utils.spawn_n(self._resume_light_snapshot_commit, context,
+                          instance)
+
         try_reboot, reboot_type = self._retry_reboot(context, instance)
         current_power_state = self._get_power_state(context, instance)
 
@@ -1303,9 +1402,13 @@ class ComputeManager(manager.Manager):
     def init_host(self):
         """Initialization for a standalone compute service."""
         self.driver.init_host(host=self.host)
+        # Added by YuanruiFan. Report the greenthreads blocking the hub
+        # during light-snapshot operations.
+        light_native.start_stall_detector()
         context = nova.context.get_admin_context()
         instances = objects.InstanceList.get_by_host(
-            context, self.host, expected_attrs=['info_cache', 'metadata'])
+            context, self.host,
+            expected_attrs=['info_cache', 'metadata', 'light_snapshot'])
 
         if CONF.defer_iptables_apply:
             self.driver.filter_defer_apply_on()
@@ -1315,13 +1418,108 @@ class ComputeManager(manager.Manager):
         try:
             # checking that instance was not already evacuated to other host
             self._destroy_evacuated_instances(context)
-            for instance in instances:
-                self._init_instance(context, instance)
+            # Added by YuanruiFan. The light-snapshot chains of the
+            # instances started again are initialized in the background by
+            # _reconcile_light_snapshot_chains.
+            with self._deferred_light_snapshot_init():
+                for instance in instances:
+                    self._init_instance(context, instance)
+            self._reconcile_light_snapshot_chains(context, instances)
         finally:
             if CONF.defer_iptables_apply:
                 self.driver.filter_defer_apply_off()
             self._update_scheduler_instance_info(context, instances)
 
+    # Added by YuanruiFan. See LibvirtDriver.deferred_light_snapshot_init.
+    @contextlib.contextmanager
+    def _deferred_light_snapshot_init(self):
+        if not CONF.light_snapshot_enabled:
+            yield
+            return
+        with self.driver.deferred_light_snapshot_init():
+            yield
+
+    # Added by YuanruiFan. Check the light-snapshot chain of every instance
+    # of the host against the database. The checks only read image headers
+    # and run in parallel. The chains which have to be initialized again
+    # are queued and initialized in the background, so that the start of
+    # the service does not wait for them.
+    def _reconcile_light_snapshot_chains(self, context, instances):
+        if not CONF.light_snapshot_enabled:
+            return
+
+        workers = max(CONF.light_snapshot_init_workers, 1)
+        pool = eventlet.GreenPool(workers)
+        queue = []
+        for instance in instances:
+            if (instance.host != self.host or
+                    not instance.light_snapshot_enable or
+                    instance.task_state is not None or
+                    instance.vm_state in (vm_states.ERROR,
+                                          vm_states.DELETED,
+                                          vm_states.SOFT_DELETED)):
+                continue
+            pool.spawn_n(self._check_light_snapshot_chain, context,
+                         instance, queue)
+        pool.waitall()
+
+        if queue:
+            LOG.info(_LI('Initializing the light-snapshot chain of %d '
+                         'instances in the background'), len(queue))
+            utils.spawn_n(self._init_light_snapshot_chains, context, queue,
+                          workers)
+
+    def _check_light_snapshot_chain(self, context, instance, queue):
+        try:
+            updates = self.driver.check_light_snapshot_chain(instance)
+        except Exception:
+            LOG.exception(_LE('Failed to check the light-snapshot chain'),
+                          instance=instance)
+            return
+
+        if updates:
+            LOG.warning(_LW('The light-snapshot chain does not match the '
+                            'database, updating %s'), updates,
+                        instance=instance)
+            for field, value in updates.items():
+                setattr(instance, field, value)
+            instance.save()
+
+        if (instance.snapshot_committed and
+                self._get_power_state(context, instance) ==
+                power_state.RUNNING):
+            queue.append(instance)
+
+    def _init_light_snapshot_chains(self, context, instances, workers):
+        pool = eventlet.GreenPool(workers)
+        for instance in instances:
+            pool.spawn_n(self._init_light_snapshot_chain, context, instance)
+        pool.waitall()
+
+    def _init_light_snapshot_chain(self, context, instance):
+        try:
+            instance.task_state = snapshot_task_states.VM_SNAPSHOT
+            instance.save(expected_task_state=[None])
+        except (exception.InstanceNotFound,
+                exception.UnexpectedTaskStateError):
+            return
+
+        try:
+            self.driver.light_snapshot_init(context, instance)
+            instance.snapshot_committed = False
+            instance.save()
+            if instance.snapshot_store:
+                self.driver.store_snapshot_init(context, instance)
+        except Exception:
+            LOG.exception(_LE('Failed to initialize the light-snapshot '
+                              'chain'), instance=instance)
+
+        instance.task_state = None
+        try:
+            instance.save()
+        except exception.InstanceNotFound:
+            pass
+
     def cleanup_host(self):
         self.driver.register_event_listener(None)
         self.instance_events.cancel_all_events()
@@ -3061,20 +3259,23 @@ class ComputeManager(manager.Manager):
                 context, instance, "enable_light_snapshot.start")
 
 
-            self.driver.light_snapshot_init(context, instance)
+            with light_profiler.profile(instance.uuid,
+                                        'enable_light_snapshot') as profile:
+                self.driver.light_snapshot_init(context, instance)
 
-            instance.light_snapshot_enable = True
-            instance.snapshot_committed = False
-            instance.save()
+                instance.light_snapshot_enable = True
+                instance.snapshot_committed = False
+                instance.save()
 
-            if instance.snapshot_store:
-                self.driver.store_snapshot_init(context, instance)
+                if instance.snapshot_store:
+                    self.driver.store_snapshot_init(context, instance)
 
             instance.task_state = None
             instance.save(expected_task_state=snapshot_task_states.ENABLE_SNAPSHOT)
 
             self._notify_about_instance_usage(context, instance,
-                                              "enable_light_snapshot.end")
+                                              "enable_light_snapshot.end",
+                    extra_usage_info=light_profiler.usage_info(profile))
         except (exception.InstanceNotFound,
                 exception.UnexpectedDeletingTaskStateError):
             # the instance got deleted during the snapshot
@@ -3112,13 +3313,16 @@ class ComputeManager(manager.Manager):
                 context, instance, "store_snapshot_init.start")
 
 
-            self.driver.store_snapshot_init(context, instance)
+            with light_profiler.profile(instance.uuid,
+                                        'store_snapshot_init') as profile:
+                self.driver.store_snapshot_init(context, instance)
 
             instance.task_state = None
             instance.save(expected_task_state=snapshot_task_states.ENABLE_STORE)
 
             self._notify_about_instance_usage(context, instance,
-                                              "store_snapshot_init.end")
+                                              "store_snapshot_init.end",
+                    extra_usage_info=light_profiler.usage_info(profile))
         except (exception.InstanceNotFound,
                 exception.UnexpectedDeletingTaskStateError):
             # the instance got deleted during the snapshot
@@ -3172,13 +3376,16 @@ class ComputeManager(manager.Manager):
             self._notify_about_instance_usage(
                 context, instance, "disable_light_snapshot.start")
 
-            self.driver.disable_light_snapshot(context, instance)  
+            with light_profiler.profile(instance.uuid,
+                                        'disable_light_snapshot') as profile:
+                self.driver.disable_light_snapshot(context, instance)
         
             instance.task_state = None
             instance.save(expected_task_state=expected_task_state)
 
             self._notify_about_instance_usage(context, instance,
-                                              "disable_light_snapshot.end")
+                                              "disable_light_snapshot.end",
+                    extra_usage_info=light_profiler.usage_info(profile))
         except (exception.InstanceNotFound,
                 exception.UnexpectedDeletingTaskStateError):
             # the instance got deleted during the snapshot
@@ -3213,6 +3420,89 @@ class ComputeManager(manager.Manager):
 
         self._light_snapshot_instance(context, instance, snapshot_task_states.VM_SNAPSHOT)
 
+    # Added by YuanruiFan. Light snapshot the instances of this host sent
+    # together by the API, a bounded number of them at a time.
+    @wrap_exception()
+    def light_snapshot_instances(self, context, instances, options=None):
+        """Take a light-snapshot for each of the instances.
+
+           :param options: dict which may contain skip_empty, to skip the
+                           instances which have not been written to since
+                           their last snapshot
+        """
+        options = options or {}
+        pool = eventlet.GreenPool(max(CONF.light_snapshot_all_workers, 1))
+        for instance in instances:
+            pool.spawn_n(self._light_snapshot_batch_instance, context,
+                         instance, options)
+        pool.waitall()
+
+    def _light_snapshot_batch_instance(self, context, instance, options):
+        try:
+            skip = (options.get('skip_empty') and
+                    self.driver.light_snapshot_is_empty(instance))
+        except Exception:
+            # NOTE: The check runs before light_snapshot_instance, which
+            # reverts the task_state on its errors, so revert it here.
+            LOG.exception(_LE("Error checking the light-snapshot overlay."),
+                          instance=instance)
+            self._light_snapshot_reset_pending(instance)
+            return
+        if skip:
+            LOG.debug('Light-snapshot overlay is empty, skip the snapshot',
+                      instance=instance)
+            self._light_snapshot_reset_pending(instance)
+            return
+
+        try:
+            self.light_snapshot_instance(context, instance)
+        except Exception:
+            # NOTE: light_snapshot_instance has already reverted the
+            # task_state and recorded the fault.
+            LOG.exception(_LE("Error trying to light_snapshot."),
+                          instance=instance)
+
+    def _light_snapshot_reset_pending(self, instance):
+        try:
+            instance.task_state = None
+            instance.save(expected_task_state=
+                          snapshot_task_states.VM_SNAPSHOT_PENDING)
+        except (exception.InstanceNotFound,
+                exception.UnexpectedTaskStateError):
+            LOG.debug('Instance task_state changed, not resetting it',
+                      instance=instance)
+
+    # Added by YuanruiFan. Run a light-snapshot operation on the instances
+    # of this host sent together by the API, a bounded number of them at a
+    # time.
+    @wrap_exception()
+    def light_snapshot_bulk(self, context, method, instances, kwargs=None):
+        """Run the light-snapshot operation method on each of the instances.
+
+           :param method: one of LIGHT_SNAPSHOT_BULK_METHODS
+           :param kwargs: dict of the arguments of method
+        """
+        if method not in LIGHT_SNAPSHOT_BULK_METHODS:
+            raise exception.NovaException(
+                _('%s is not a light-snapshot operation') % method)
+        function = getattr(self, method)
+        kwargs = kwargs or {}
+        pool = eventlet.GreenPool(max(CONF.light_snapshot_all_workers, 1))
+        for instance in instances:
+            pool.spawn_n(self._light_snapshot_bulk_instance, function,
+                         context, instance, kwargs)
+        pool.waitall()
+
+    def _light_snapshot_bulk_instance(self, function, context, instance,
+                                      kwargs):
+        try:
+            function(context, instance, **kwargs)
+        except Exception:
+            # NOTE: The operations have already reverted the task_state and
+            # recorded the fault.
+            LOG.exception(_LE("Error trying to %s."), function.__name__,
+                          instance=instance)
+
     # Added by YuanruiFan. This function will call the API supported by libvirt/driver.py.
     def _light_snapshot_instance(self, context, instance, expected_task_state):
         context = context.elevated()
@@ -3241,13 +3531,20 @@ class ComputeManager(manager.Manager):
                 instance.task_state = task_state
                 instance.save(expected_task_state=expected_state)
 
-            self.driver.light_snapshot(context, instance, update_task_state)
+            # Added by YuanruiFan. The instance is written once per
+            # task_state change.
+            with light_uow.unit_of_work(instance) as unit:
+                with light_profiler.profile(instance.uuid,
+                                            'light_snapshot') as profile:
+                    self.driver.light_snapshot(context, instance,
+                                               update_task_state)
 
-            instance.task_state = None
-            instance.save(expected_task_state=snapshot_task_states.VM_SNAPSHOT_COMMIT)
+                instance.task_state = None
+                unit.flush(expected_task_state=snapshot_task_states.VM_SNAPSHOT_COMMIT)
 
             self._notify_about_instance_usage(context, instance,
-                                              "light_snapshot.end")
+                                              "light_snapshot.end",
+                    extra_usage_info=light_profiler.usage_info(profile))
         except (exception.InstanceNotFound,
                 exception.UnexpectedDeletingTaskStateError):
             # the instance got deleted during the snapshot
@@ -3305,16 +3602,22 @@ class ComputeManager(manager.Manager):
             network_info = self.network_api.get_instance_nw_info(context, instance)
 
 
-            self.driver.recover_instance_from_snapshot(context, instance,network_info,block_device_info,
-                                                       use_root=use_root, snap_index=snap_index)
+            # Added by YuanruiFan. The instance is written once per
+            # task_state change.
+            with light_uow.unit_of_work(instance) as unit:
+                with light_profiler.profile(instance.uuid,
+                                            'recover_instance') as profile:
+                    self.driver.recover_instance_from_snapshot(context, instance,network_info,block_device_info,
+                                                               use_root=use_root, snap_index=snap_index)
 
-            instance.power_state = self._get_power_state(context, instance)
-            instance.vm_state = vm_states.ACTIVE
-            instance.task_state = None
-            instance.save(expected_task_state=expected_task_state)
+                instance.power_state = self._get_power_state(context, instance)
+                instance.vm_state = vm_states.ACTIVE
+                instance.task_state = None
+                unit.flush(expected_task_state=expected_task_state)
 
             self._notify_about_instance_usage(context, instance,
-                                              "recover_instance.end")
+                                              "recover_instance.end",
+                    extra_usage_info=light_profiler.usage_info(profile))
         except (exception.InstanceNotFound,
                 exception.UnexpectedDeletingTaskStateError):
             # the instance got deleted during the snapshot
@@ -3331,33 +3634,48 @@ class ComputeManager(manager.Manager):
         """
         context = context.elevated()
 
-        # Get all instances on this host.
-        local_instances =self._get_instances_on_driver(context)
-
+        # Added by YuanruiFan. The instances are filtered in the database,
+        # and their power state is read with a single libvirt call.
+        if not CONF.light_snapshot_enabled:
+            return
+        local_instances = objects.InstanceList.get_light_snapshot_candidates(
+            context, self.host, daily=daily,
+            expected_attrs=['light_snapshot'], use_slave=True)
+        running = set(self.driver.list_running_instance_uuids())
+
+        # Added by YuanruiFan. The driver locks each instance during its
+        # light-snapshot operations, so the instances are snapshotted in
+        # parallel.
+        pool = eventlet.GreenPool(max(CONF.light_snapshot_all_workers, 1))
         for instance in local_instances:
-            instance.power_state = self._get_power_state(context, instance)
-            try:
-                instance.save()
-
-                # if instance is not running, we do not snapshot it.
-                if instance.power_state != power_state.RUNNING:
-                    continue
+            # if instance is not running, we do not snapshot it.
+            if instance.uuid not in running:
+                continue
+            pool.spawn_n(self._light_snapshot_all_instance, context,
+                         instance)
+        pool.waitall()
 
-                if daily and (not instance.snapshot_daily):
-                    continue
-                # For all the instance that to snapshot, first update their task_state
-                if (CONF.light_snapshot_enabled and instance.light_snapshot_enable and (not instance.snapshot_committed)):
-                    instance.task_state = snapshot_task_states.VM_SNAPSHOT_PENDING
-                    instance.save(expected_task_state=[None])
-                    self.light_snapshot_instance(context, instance)
-            except Exception as error:
-                LOG.exception(_LE("Error trying to light_snapshot."),
-                              instance=instance)
-                compute_utils.add_instance_fault_from_exc(context,
-                                                          instance, error,
-                                                          exc_info=sys.exc_info())
-                self._notify_about_instance_usage(context, instance,
-                                                  'light_snapshot.error', fault=error) 
+    def _light_snapshot_all_instance(self, context, instance):
+        try:
+            # Added by YuanruiFan. An idle instance would only get
+            # a snapshot identical to its last one.
+            if (CONF.light_snapshot_skip_empty and
+                    self.driver.light_snapshot_is_empty(instance)):
+                LOG.debug('Light-snapshot overlay is empty, skip '
+                          'the snapshot', instance=instance)
+                return
+            # For all the instance that to snapshot, first update their task_state
+            instance.task_state = snapshot_task_states.VM_SNAPSHOT_PENDING
+            instance.save(expected_task_state=[None])
+            self.light_snapshot_instance(context, instance)
+        except Exception as error:
+            LOG.exception(_LE("Error trying to light_snapshot."),
+                          instance=instance)
+            compute_utils.add_instance_fault_from_exc(context,
+                                                      instance, error,
+                                                      exc_info=sys.exc_info())
+            self._notify_about_instance_usage(context, instance,
+                                              'light_snapshot.error', fault=error) 
 
 
     # Added by YuanruiFan. To commit the last external snapshot.
@@ -3406,13 +3724,19 @@ class ComputeManager(manager.Manager):
             self._notify_about_instance_usage(
                 context, instance, "commit_snapshot.start")
 
-            self.driver.commit_light_snapshot(context, instance)
+            # Added by YuanruiFan. The instance is written once per
+            # task_state change.
+            with light_uow.unit_of_work(instance) as unit:
+                with light_profiler.profile(instance.uuid,
+                                            'commit_snapshot') as profile:
+                    self.driver.commit_light_snapshot(context, instance)
 
-            instance.task_state = None
-            instance.save(expected_task_state = expected_task_state)
+                instance.task_state = None
+                unit.flush(expected_task_state = expected_task_state)
 
             self._notify_about_instance_usage(context, instance,
-                                              "commit_snapshot.end")
+                                              "commit_snapshot.end",
+                    extra_usage_info=light_profiler.usage_info(profile))
        
             LOG.info(_LI('instance snapshot has committed'), context=context,
                   instance=instance)
@@ -3426,6 +3750,126 @@ class ComputeManager(manager.Manager):
  
  
 
+    # Added by YuanruiFan. Commit the light snapshots of all the stopped
+    # instances of this host. The commits run in parallel, the driver
+    # bounds how many of them touch the disks at the same time.
+    @wrap_exception()
+    def light_commit_stopped(self, context):
+        context = context.elevated()
+        pool = eventlet.GreenPool()
+
+        for instance in self._get_instances_on_driver(context):
+            if not (CONF.light_snapshot_enabled and
+                    instance.light_snapshot_enable and
+                    not instance.snapshot_committed):
+                continue
+            if instance.vm_state != vm_states.STOPPED:
+                continue
+            try:
+                instance.task_state = snapshot_task_states.VM_COMMITING
+                instance.save(expected_task_state=[None])
+            except (exception.InstanceNotFound,
+                    exception.UnexpectedTaskStateError):
+                continue
+            pool.spawn_n(self._light_commit_stopped_instance, context,
+                         instance)
+
+        pool.waitall()
+
+    def _light_commit_stopped_instance(self, context, instance):
+        try:
+            self._light_commit_snapshot(context, instance,
+                                        snapshot_task_states.VM_COMMITING)
+        except Exception as error:
+            LOG.exception(_LE('Error trying to commit the light snapshots of '
+                              'a stopped instance.'), instance=instance)
+            compute_utils.add_instance_fault_from_exc(context, instance,
+                                                      error,
+                                                      exc_info=sys.exc_info())
+            instance.task_state = None
+            try:
+                instance.save()
+            except exception.InstanceNotFound:
+                pass
+
+    # Added by YuanruiFan. Finish a light-snapshot commit interrupted by a
+    # restart of the service, see _init_instance.
+    def _resume_light_snapshot_commit(self, context, instance):
+        context = context.elevated()
+        try:
+            if self.driver.resume_light_snapshot_commit(context, instance):
+                self._notify_about_instance_usage(context, instance,
+                                                  "commit_snapshot.end")
+                LOG.info(_LI('instance snapshot has committed'),
+                         context=context, instance=instance)
+        except exception.InstanceNotFound:
+            LOG.debug('Instance disappeared during commit snapshot',
+                      instance=instance)
+            return
+        except Exception as error:
+            LOG.exception(_LE('Failed to resume the light-snapshot commit.'),
+                          instance=instance)
+            compute_utils.add_instance_fault_from_exc(context, instance,
+                                                      error,
+                                                      exc_info=sys.exc_info())
+
+        instance.task_state = None
+        try:
+            instance.save()
+        except exception.InstanceNotFound:
+            pass
+
+    # Added by YuanruiFan. Return the execute profile of the last
+    # light-snapshot operation of the instance on this host.
+    @wrap_exception()
+    def get_light_snapshot_profile(self, context, instance):
+        return light_profiler.get_last_profile(instance.uuid)
+
+    # Added by YuanruiFan. Pre-stage the read-only light-snapshot layers of
+    # the instance on the host it is going to be migrated to. They are kept
+    # up to date by _sync_light_snapshot_prestage until the migration. A
+    # host of None cancels the pre-stage.
+    @wrap_exception()
+    @wrap_instance_fault
+    def prestage_light_snapshot(self, context, instance, host):
+        if not host:
+            if self._drop_light_snapshot_prestage(instance):
+                instance.save()
+            return
+
+        self._drop_light_snapshot_prestage(instance, keep_host=host)
+
+        instance.system_metadata[LIGHT_SNAPSHOT_PRESTAGE_HOST] = host
+        instance.save()
+        self._prestage_light_snapshot(context, instance, host)
+
+    # Added by YuanruiFan. Forget the pre-stage of the instance, removing
+    # the staged layers unless they are on keep_host, where they are still
+    # wanted. Return whether there was a pre-stage; the caller saves the
+    # instance.
+    def _drop_light_snapshot_prestage(self, instance, keep_host=None):
+        host = instance.system_metadata.pop(LIGHT_SNAPSHOT_PRESTAGE_HOST,
+                                            None)
+        if host and host != keep_host:
+            try:
+                self.driver.unstage_light_snapshot_chain(instance, host)
+            except Exception:
+                LOG.warning(_LW('Failed to remove the light-snapshot layers '
+                                'pre-staged on %s'), host, instance=instance,
+                            exc_info=True)
+        return bool(host)
+
+    def _prestage_light_snapshot(self, context, instance, host):
+        LOG.debug('Pre-staging light-snapshot layers on %s', host,
+                  instance=instance)
+        try:
+            with light_profiler.profile(instance.uuid, 'prestage'):
+                self.driver.stage_light_snapshot_chain(context, instance,
+                                                       host)
+        except (exception.InstanceNotFound, exception.InstanceNotRunning):
+            LOG.debug('Instance is not running, light-snapshot layers are '
+                      'not pre-staged', instance=instance)
+
     @wrap_exception()
     @reverts_task_state
     @wrap_instance_fault
@@ -4191,6 +4635,16 @@ class ComputeManager(manager.Manager):
             # not re-scheduling
             six.reraise(*exc_info)
 
+    # Added by YuanruiFan. The light-snapshot chain of an instance is
+    # carried by a migration only when the root disk keeps its size, since
+    # the overlays of the chain cannot be resized.
+    def _keep_light_snapshot_chain(self, instance, instance_type):
+        if CONF.light_snapshot_migrate_mode != 'chain':
+            return False
+        if not instance_type:
+            return False
+        return instance_type['root_gb'] == instance.root_gb
+
     @wrap_exception()
     @reverts_task_state
     @wrap_instance_event
@@ -4204,9 +4658,10 @@ class ComputeManager(manager.Manager):
         # Added by YuanruiFan. Before starting resize/migration, 
         # we check whether the instance has light-snapshot. Then
         # we commit all the snapshots to its root disk if the instance
-        # has. 
+        # has, unless its chain can be carried to the destination.
         if (CONF.light_snapshot_enabled and instance.light_snapshot_enable and (not instance.snapshot_committed)):
-            self.driver.commit_all_snapshots(context, instance) 
+            if not self._keep_light_snapshot_chain(instance, instance_type):
+                self.driver.commit_all_snapshots(context, instance) 
 
 
         quotas = objects.Quotas.from_reservations(context,
@@ -4259,6 +4714,11 @@ class ComputeManager(manager.Manager):
             with migration.obj_as_admin():
                 migration.save()
 
+            # Added by YuanruiFan. The layers pre-staged on the destination
+            # have been used by the migration, any others are stale.
+            self._drop_light_snapshot_prestage(
+                instance, keep_host=migration.dest_compute)
+
             instance.host = migration.dest_compute
             instance.node = migration.dest_node
             instance.task_state = task_states.RESIZE_MIGRATED
@@ -5530,6 +5990,21 @@ class ComputeManager(manager.Manager):
             else:
                 disk = None
 
+            # Added by YuanruiFan. Copy the read-only lower layers of the
+            # light-snapshot chain ahead, so that the block migration only
+            # has to transfer the top overlay.
+            if (block_migration and CONF.light_snapshot_enabled and
+                    instance.light_snapshot_enable and
+                    not instance.snapshot_committed):
+                self.driver.stage_light_snapshot_chain(context, instance,
+                                                       dest)
+            # Added by YuanruiFan. pre_live_migration on dest takes or drops
+            # what is staged there for a block migration, layers pre-staged
+            # anywhere else are stale.
+            if self._drop_light_snapshot_prestage(
+                    instance, keep_host=dest if block_migration else None):
+                instance.save()
+
             pre_migration_data = self.compute_rpcapi.pre_live_migration(
                 context, instance,
                 block_migration, disk, dest, migrate_data)
@@ -6154,6 +6629,127 @@ class ComputeManager(manager.Manager):
                 LOG.exception(_LE('Periodic task failed to offload instance.'),
                         instance=instance)
 
+    # Added by YuanruiFan. Bring the pre-staged light-snapshot layers up to
+    # date, so that little is left to copy when the migration starts.
+    @periodic_task.periodic_task(
+        spacing=CONF.light_snapshot_prestage_interval)
+    def _sync_light_snapshot_prestage(self, context):
+        if not CONF.light_snapshot_enabled:
+            return
+
+        instances = objects.InstanceList.get_by_host(
+            context, self.host,
+            expected_attrs=['system_metadata', 'light_snapshot'],
+            use_slave=True)
+        for instance in instances:
+            host = instance.system_metadata.get(LIGHT_SNAPSHOT_PRESTAGE_HOST)
+            if not host or instance.task_state is not None:
+                continue
+            if (not instance.light_snapshot_enable or
+                    instance.snapshot_committed):
+                continue
+            try:
+                self._prestage_light_snapshot(context, instance, host)
+            except Exception:
+                LOG.exception(_LE('Periodic task failed to pre-stage the '
+                                  'light-snapshot layers of instance.'),
+                              instance=instance)
+
+    # Added by YuanruiFan. Snapshot the light-snapshot instances according
+    # to their writes instead of on a fixed schedule: when the current
+    # overlay has grown past light_snapshot_overlay_max_mb, or when it has
+    # been written to and the last snapshot is older than light_snapshot_rpo.
+    # The snapshots run in a bounded pool, an instance left over when it is
+    # full is picked up by the next run.
+    @periodic_task.periodic_task(
+        spacing=CONF.light_snapshot_adaptive_interval)
+    def _adaptive_light_snapshot(self, context):
+        if not CONF.light_snapshot_enabled:
+            return
+
+        context = context.elevated()
+        instances = objects.InstanceList.get_by_host(
+            context, self.host, expected_attrs=['light_snapshot'],
+            use_slave=True)
+        seen = set()
+        for instance in instances:
+            if (not instance.light_snapshot_enable or
+                    instance.snapshot_committed or
+                    instance.vm_state != vm_states.ACTIVE or
+                    instance.task_state is not None):
+                continue
+
+            try:
+                stats = self.driver.get_light_snapshot_write_stats(instance)
+            except (exception.InstanceNotFound,
+                    exception.InstanceNotRunning):
+                continue
+            except Exception:
+                LOG.exception(_LE('Failed to sample the disk writes of '
+                                  'instance.'), instance=instance)
+                continue
+            seen.add(instance.uuid)
+
+            # The counters restart with the domain, and the instance may
+            # have been snapshotted by other means since the last sample.
+            # Without a mark, e.g. after a restart of the service, whether
+            # the overlay has been written to is not known.
+            mark = self._light_snapshot_write_marks.get(instance.uuid)
+            if (mark is not None and (mark[0] != instance.snapshot_index or
+                                      stats['wr_bytes'] < mark[1])):
+                mark = (instance.snapshot_index, stats['wr_bytes'])
+            if mark is None:
+                written = None
+                self._light_snapshot_write_marks[instance.uuid] = (
+                    instance.snapshot_index, stats['wr_bytes'])
+            else:
+                written = stats['wr_bytes'] - mark[1]
+                self._light_snapshot_write_marks[instance.uuid] = mark
+
+            snapshot_at = instance.light_snapshot.snapshot_at
+            overlay_full = (stats['allocation'] >=
+                            CONF.light_snapshot_overlay_max_mb * units.Mi)
+            rpo_due = (written != 0 and
+                       (snapshot_at is None or
+                        timeutils.is_older_than(snapshot_at,
+                                                CONF.light_snapshot_rpo)))
+            if not (overlay_full or rpo_due):
+                continue
+
+            if not self._light_snapshot_adaptive_pool.free():
+                LOG.debug('Adaptive light snapshot: all workers busy, '
+                          'instance is left for the next run',
+                          instance=instance)
+                continue
+
+            LOG.debug('Adaptive light snapshot: overlay of %(size)d bytes, '
+                      '%(written)s bytes written since %(at)s',
+                      {'size': stats['allocation'], 'written': written,
+                       'at': snapshot_at}, instance=instance)
+            try:
+                instance.task_state = snapshot_task_states.VM_SNAPSHOT_PENDING
+                instance.save(expected_task_state=[None])
+            except Exception:
+                LOG.exception(_LE('Periodic task failed to light snapshot '
+                                  'instance.'), instance=instance)
+                continue
+            self._light_snapshot_adaptive_pool.spawn_n(
+                self._adaptive_light_snapshot_instance, context, instance,
+                stats['wr_bytes'])
+
+        for uuid in set(self._light_snapshot_write_marks) - seen:
+            del self._light_snapshot_write_marks[uuid]
+
+    def _adaptive_light_snapshot_instance(self, context, instance, wr_bytes):
+        try:
+            self.light_snapshot_instance(context, instance)
+        except Exception:
+            LOG.exception(_LE('Periodic task failed to light snapshot '
+                              'instance.'), instance=instance)
+            return
+        self._light_snapshot_write_marks[instance.uuid] = (
+            instance.snapshot_index, wr_bytes)
+
     @periodic_task.periodic_task
     def _instance_usage_audit(self, context):
         if not CONF.instance_usage_audit:
@@ -786,6 +786,24 @@ class ComputeAPI(object):
         cctxt.cast(ctxt, 'light_snapshot_instance',
                    instance=instance)
 
+    # Added by YuanruiFan. Light snapshot a list of instances of host with
+    # a single message.
+    def light_snapshot_instances(self, ctxt, host, instances, options=None):
+        version = '4.0'
+        cctxt = self.client.prepare(server=_compute_host(host, None),
+                version=version)
+        cctxt.cast(ctxt, 'light_snapshot_instances',
+                   instances=instances, options=options)
+
+    # Added by YuanruiFan. Run a light-snapshot operation on a list of
+    # instances of host with a single message.
+    def light_snapshot_bulk(self, ctxt, host, method, instances, kwargs=None):
+        version = '4.0'
+        cctxt = self.client.prepare(server=_compute_host(host, None),
+                version=version)
+        cctxt.cast(ctxt, 'light_snapshot_bulk', method=method,
+                   instances=instances, kwargs=kwargs)
+
     def light_recover_instance(self, ctxt, instance, use_root=False, snap_index=None):
         version = '4.0'
         cctxt = self.client.prepare(server=_compute_host(None, instance),
@@ -830,6 +848,26 @@ class ComputeAPI(object):
                 version=version)
         cctxt.cast(ctxt, 'light_snapshot_all', daily=daily)
 
+    def light_commit_stopped(self, ctxt, host):
+        version = '4.0'
+        cctxt = self.client.prepare(server=_compute_host(host, None),
+                version=version)
+        cctxt.cast(ctxt, 'light_commit_stopped')
+
+    def get_light_snapshot_profile(self, ctxt, instance):
+        version = '4.0'
+        cctxt = self.client.prepare(server=_compute_host(None, instance),
+                version=version)
+        return cctxt.call(ctxt, 'get_light_snapshot_profile',
+                          instance=instance)
+
+    def prestage_light_snapshot(self, ctxt, instance, host):
+        version = '4.0'
+        cctxt = self.client.prepare(server=_compute_host(None, instance),
+                version=version)
+        cctxt.cast(ctxt, 'prestage_light_snapshot',
+                   instance=instance, host=host)
+
     def snapshot_instance(self, ctxt, instance, image_id):
         version = '4.0'
         cctxt = self.client.prepare(server=_compute_host(None, instance),
@@ -0,0 +1,484 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Queries of the light-snapshot system.
+
+   The light-snapshot state of an instance is kept in the
+   instance_light_snapshot table, and every light snapshot has a row in
+   the light_snapshots table.
+"""
+
+import functools
+
+from oslo_db import api as oslo_db_api
+from oslo_db import exception as db_exc
+from oslo_utils import timeutils
+from sqlalchemy import and_
+from sqlalchemy import or_
+from sqlalchemy.sql import false
+from sqlalchemy.sql import func
+from sqlalchemy.sql import true
+
+from nova.compute import vm_states
+from nova.db.sqlalchemy import api as sqlalchemy_api
+from nova.db.sqlalchemy import models
+from nova import exception
+
+
+def _light_snapshot_query(context, session=None, use_slave=False):
+    return sqlalchemy_api.model_query(context, models.InstanceLightSnapshot,
+                                      session=session, read_deleted='no',
+                                      use_slave=use_slave)
+
+
+@sqlalchemy_api.require_context
+def instance_get_light_snapshot_candidates(context, host, daily=False,
+                                          columns_to_join=None,
+                                          use_slave=False):
+    """Return the active instances of host which can be light snapshotted.
+
+       :param daily: only return the instances snapshotted daily
+    """
+    state = models.InstanceLightSnapshot
+    query = sqlalchemy_api._instance_get_all_query(context,
+                                                   use_slave=use_slave).\
+        join(state, state.instance_uuid == models.Instance.uuid).\
+        filter(state.deleted == 0).\
+        filter_by(host=host).\
+        filter_by(vm_state=vm_states.ACTIVE).\
+        filter_by(task_state=None).\
+        filter(state.light_snapshot_enable == true()).\
+        filter(or_(state.snapshot_committed == false(),
+                   state.snapshot_committed == None))  # noqa
+    if daily:
+        query = query.filter(state.snapshot_daily == true())
+
+    return sqlalchemy_api._instances_fill_metadata(
+        context, query.all(), manual_joins=columns_to_join,
+        use_slave=use_slave)
+
+
+@sqlalchemy_api.require_context
+def instance_light_snapshot_get(context, instance_uuid, use_slave=False):
+    """Return the light-snapshot state of an instance, or None."""
+    return _light_snapshot_query(context, use_slave=use_slave).\
+        filter_by(instance_uuid=instance_uuid).\
+        first()
+
+
+@sqlalchemy_api.require_context
+def instance_light_snapshot_get_by_instance_uuids(context, instance_uuids,
+                                                  use_slave=False):
+    """Return the light-snapshot states of a list of instances."""
+    if not instance_uuids:
+        return []
+    return _light_snapshot_query(context, use_slave=use_slave).\
+        filter(models.InstanceLightSnapshot.instance_uuid.in_(
+            instance_uuids)).\
+        all()
+
+
+def _light_snapshot_filter(query, filters):
+    """Filter query, which selects the light-snapshot states, on filters.
+
+       A state which is NULL, as in the states copied from the instances
+       table or those of an instance outer joined without any, matches a
+       false filter and snapshot_older_than.
+    """
+    state = models.InstanceLightSnapshot
+    for key in ('light_snapshot_enable', 'snapshot_daily',
+                'snapshot_store', 'snapshot_committed'):
+        if key not in filters:
+            continue
+        column = getattr(state, key)
+        if filters[key]:
+            query = query.filter(column == true())
+        else:
+            query = query.filter(or_(column == false(),
+                                     column == None))  # noqa
+
+    if filters.get('snapshot_older_than') is not None:
+        older_than = timeutils.normalize_time(filters['snapshot_older_than'])
+        query = query.filter(or_(state.snapshot_at < older_than,
+                                 state.snapshot_at == None))  # noqa
+    return query
+
+
+@sqlalchemy_api.require_context
+def instance_light_snapshot_get_all_by_filters(context, filters,
+                                               use_slave=False):
+    """Return the light-snapshot states matching filters.
+
+       Only the instances which have a light-snapshot state are returned,
+       the light_snapshot filter of instance_get_all_by_filters_sort also
+       matches the others.
+
+       :param filters: dict which may contain the booleans
+                       light_snapshot_enable, snapshot_daily,
+                       snapshot_store and snapshot_committed, the datetime
+                       snapshot_older_than, which also matches the
+                       instances never snapshotted, and the host of the
+                       instances
+    """
+    state = models.InstanceLightSnapshot
+    query = _light_snapshot_query(context, use_slave=use_slave)
+    query = _light_snapshot_filter(query, filters)
+
+    # NOTE: The host is a column of the instances, the join goes through
+    # the index on their host and the unique key of the states.
+    if filters.get('host'):
+        query = query.join(models.Instance,
+                           models.Instance.uuid == state.instance_uuid).\
+            filter(models.Instance.host == filters['host']).\
+            filter(models.Instance.deleted == 0)
+
+    return query.all()
+
+
+# Added by YuanruiFan. instance_get_all_by_filters_sort applies the exact
+# filters of the instances through _exact_instance_filter, on their query
+# already joined, filtered on deleted and cleaned and scoped to the project
+# of the context, and before the regex filters and the pagination. The
+# light-snapshot filters, passed as filters['light_snapshot'], are applied
+# there too, so listing the instances by their light-snapshot state keeps
+# everything else instance_get_all_by_filters_sort does.
+def _light_snapshot_instance_filter(exact_instance_filter):
+    @functools.wraps(exact_instance_filter)
+    def wrapper(query, filters, legal_keys):
+        light_snapshot_filters = filters.pop('light_snapshot', None)
+        if light_snapshot_filters:
+            # NOTE: The states are outer joined, so an instance which has
+            # never used light snapshots is disabled, uncommitted and never
+            # snapshotted.
+            state = models.InstanceLightSnapshot
+            query = query.outerjoin(
+                state, and_(state.instance_uuid == models.Instance.uuid,
+                            state.deleted == 0))
+            query = _light_snapshot_filter(query, light_snapshot_filters)
+        return exact_instance_filter(query, filters, legal_keys)
+    wrapper.light_snapshot_filter = True
+    return wrapper
+
+
+if not getattr(sqlalchemy_api._exact_instance_filter,
+               'light_snapshot_filter', False):
+    sqlalchemy_api._exact_instance_filter = _light_snapshot_instance_filter(
+        sqlalchemy_api._exact_instance_filter)
+
+
+def _check_instance_states(context, session, instance_uuid,
+                           expected_task_state, expected_vm_state):
+    """Lock the instance row and check its task_state and vm_state, as
+       instance_update_and_get_original does.
+    """
+    row = sqlalchemy_api.model_query(context, models.Instance,
+                                     (models.Instance.task_state,
+                                      models.Instance.vm_state),
+                                     session=session, read_deleted='no').\
+        filter_by(uuid=instance_uuid).\
+        with_lockmode('update').\
+        first()
+    if row is None:
+        raise exception.InstanceNotFound(instance_id=instance_uuid)
+    actual_task_state, actual_vm_state = row
+
+    if expected_task_state is not None:
+        expected = expected_task_state
+        if not isinstance(expected, (list, tuple, set)):
+            expected = [expected]
+        if actual_task_state not in expected:
+            raise exception.UnexpectedTaskStateError(
+                instance_uuid=instance_uuid, expected=expected_task_state,
+                actual=actual_task_state)
+    if expected_vm_state is not None:
+        expected = expected_vm_state
+        if not isinstance(expected, (list, tuple, set)):
+            expected = [expected]
+        if actual_vm_state not in expected:
+            raise exception.UnexpectedVMStateError(
+                instance_uuid=instance_uuid, expected=expected_vm_state,
+                actual=actual_vm_state)
+
+
+@sqlalchemy_api.require_context
+@oslo_db_api.wrap_db_retry(max_retries=5, retry_on_deadlock=True)
+def instance_light_snapshot_update(context, instance_uuid, values,
+                                   expected_task_state=None,
+                                   expected_vm_state=None):
+    """Update the light-snapshot state of an instance, creating it if the
+       instance has none yet.
+
+       With expected_task_state or expected_vm_state, the instance row is
+       checked in the same transaction, and nothing is written if it does
+       not match.
+    """
+    sqlalchemy_api.convert_objects_related_datetimes(values, 'snapshot_at')
+    session = sqlalchemy_api.get_session()
+    try:
+        with session.begin():
+            if (expected_task_state is not None or
+                    expected_vm_state is not None):
+                _check_instance_states(context, session, instance_uuid,
+                                       expected_task_state,
+                                       expected_vm_state)
+            state_ref = _light_snapshot_query(context, session=session).\
+                filter_by(instance_uuid=instance_uuid).\
+                first()
+            if state_ref is None:
+                state_ref = models.InstanceLightSnapshot()
+                state_ref.instance_uuid = instance_uuid
+            state_ref.update(values)
+            session.add(state_ref)
+    except db_exc.DBDuplicateEntry:
+        # Another request created the state first, update it instead.
+        return instance_light_snapshot_update(
+            context, instance_uuid, values,
+            expected_task_state=expected_task_state,
+            expected_vm_state=expected_vm_state)
+    except db_exc.DBReferenceError:
+        raise exception.InstanceNotFound(instance_id=instance_uuid)
+    return state_ref
+
+
+@sqlalchemy_api.require_context
+@oslo_db_api.wrap_db_retry(max_retries=5, retry_on_deadlock=True)
+def instance_light_snapshot_update_bulk(context, instance_uuids, values):
+    """Update the light-snapshot states of a list of instances with a
+       single update, creating the states of the instances which have none
+       yet.
+
+       :returns: the uuids of the instances updated, the deleted instances
+                 are left out
+    """
+    if not instance_uuids:
+        return []
+    values = dict(values)
+    sqlalchemy_api.convert_objects_related_datetimes(values, 'snapshot_at')
+    state = models.InstanceLightSnapshot
+    session = sqlalchemy_api.get_session()
+    try:
+        with session.begin():
+            uuids = [row[0] for row in
+                     sqlalchemy_api.model_query(context, models.Instance,
+                                                (models.Instance.uuid,),
+                                                session=session,
+                                                read_deleted='no').
+                     filter(models.Instance.uuid.in_(instance_uuids)).
+                     all()]
+            if not uuids:
+                return []
+            # The states stay locked until the update, so that a state
+            # created meanwhile is not missed.
+            existing = set(row[0] for row in
+                           sqlalchemy_api.model_query(
+                               context, state, (state.instance_uuid,),
+                               session=session, read_deleted='no').
+                           filter(state.instance_uuid.in_(uuids)).
+                           with_lockmode('update').
+                           all())
+            if existing:
+                _light_snapshot_query(context, session=session).\
+                    filter(state.instance_uuid.in_(existing)).\
+                    update(values, synchronize_session=False)
+            missing = [uuid for uuid in uuids if uuid not in existing]
+            if missing:
+                rows = []
+                for instance_uuid in missing:
+                    row = dict(values)
+                    row['instance_uuid'] = instance_uuid
+                    rows.append(row)
+                session.execute(state.__table__.insert(), rows)
+    except db_exc.DBDuplicateEntry:
+        # Another request created a state first, update it instead.
+        return instance_light_snapshot_update_bulk(context, instance_uuids,
+                                                   values)
+    return uuids
+
+
+@sqlalchemy_api.require_context
+def instance_light_snapshot_destroy(context, instance_uuid):
+    """Delete the light-snapshot state and snapshots of an instance."""
+    session = sqlalchemy_api.get_session()
+    with session.begin():
+        _light_snapshot_query(context, session=session).\
+            filter_by(instance_uuid=instance_uuid).\
+            soft_delete(synchronize_session=False)
+        _light_snapshots_query(context, session=session).\
+            filter_by(instance_uuid=instance_uuid).\
+            soft_delete(synchronize_session=False)
+
+
+@sqlalchemy_api.require_context
+@oslo_db_api.wrap_db_retry(max_retries=5, retry_on_deadlock=True)
+def instance_allocate_snapshot_indexes(context, instance_uuid, count=1):
+    """Reserve the next count snapshot indexes of an instance.
+
+       The index is incremented by the database, so that two operations
+       never get the same index.
+
+       :returns: the first and the last index reserved
+    """
+    session = sqlalchemy_api.get_session()
+    state = models.InstanceLightSnapshot
+    try:
+        with session.begin():
+            query = _light_snapshot_query(context, session=session).\
+                filter_by(instance_uuid=instance_uuid)
+            # A NULL index means that the instance has no snapshot yet.
+            rows = query.update(
+                {'snapshot_index':
+                     func.coalesce(state.snapshot_index, -1) + count},
+                synchronize_session=False)
+            if not rows:
+                # The instance has no light-snapshot state yet.
+                state_ref = state()
+                state_ref.instance_uuid = instance_uuid
+                state_ref.snapshot_index = count - 1
+                session.add(state_ref)
+                last = count - 1
+            else:
+                # The row stays locked by the update until the commit.
+                last = sqlalchemy_api.model_query(context, state,
+                                                  (state.snapshot_index,),
+                                                  session=session,
+                                                  read_deleted='no').\
+                    filter_by(instance_uuid=instance_uuid).\
+                    scalar()
+    except db_exc.DBDuplicateEntry:
+        # Another request created the state first, increment it instead.
+        return instance_allocate_snapshot_indexes(context, instance_uuid,
+                                                  count=count)
+    except db_exc.DBReferenceError:
+        raise exception.InstanceNotFound(instance_id=instance_uuid)
+    return last - count + 1, last
+
+
+@sqlalchemy_api.require_context
+@oslo_db_api.wrap_db_retry(max_retries=5, retry_on_deadlock=True)
+def instance_release_snapshot_index(context, instance_uuid, index,
+                                    previous_index):
+    """Give back the snapshot index reserved last by an operation.
+
+       snapshot_index is set back to previous_index only if it is still
+       index, so that an index reserved by another operation since is not
+       overwritten.
+
+       :returns: True if the index has been given back
+    """
+    session = sqlalchemy_api.get_session()
+    with session.begin():
+        rows = _light_snapshot_query(context, session=session).\
+            filter_by(instance_uuid=instance_uuid).\
+            filter_by(snapshot_index=index).\
+            update({'snapshot_index': previous_index},
+                   synchronize_session=False)
+    return bool(rows)
+
+
+@sqlalchemy_api.require_context
+@oslo_db_api.wrap_db_retry(max_retries=5, retry_on_deadlock=True)
+def instance_task_state_update_bulk(context, instance_uuids, task_state,
+                                    expected_task_state=None):
+    """Set the task_state of a list of instances with a single update.
+
+       Only the instances whose task_state is expected_task_state are
+       updated, as instance.save(expected_task_state=...) would do.
+
+       :returns: the uuids of the instances updated
+    """
+    if not instance_uuids:
+        return []
+    session = sqlalchemy_api.get_session()
+    with session.begin():
+        # The rows stay locked until the update, so that the uuids
+        # returned are the instances really updated.
+        query = sqlalchemy_api.model_query(context, models.Instance,
+                                           (models.Instance.uuid,),
+                                           session=session,
+                                           read_deleted='no').\
+            filter(models.Instance.uuid.in_(instance_uuids)).\
+            filter(models.Instance.task_state ==
+                   expected_task_state).\
+            with_lockmode('update')
+        uuids = [row[0] for row in query.all()]
+        if uuids:
+            sqlalchemy_api.model_query(context, models.Instance,
+                                       session=session, read_deleted='no').\
+                filter(models.Instance.uuid.in_(uuids)).\
+                update({'task_state': task_state},
+                       synchronize_session=False)
+    return uuids
+
+
+@sqlalchemy_api.require_context
+def instance_count_by_host_and_task_states(context, hosts, task_states,
+                                           use_slave=False):
+    """Count the instances of each host whose task_state is one of
+       task_states.
+
+       :returns: dict of host to the number of instances, the hosts
+                 without any are left out
+    """
+    if not hosts:
+        return {}
+    rows = sqlalchemy_api.model_query(context, models.Instance,
+                                      (models.Instance.host,
+                                       func.count(models.Instance.id)),
+                                      read_deleted='no',
+                                      use_slave=use_slave).\
+        filter(models.Instance.host.in_(hosts)).\
+        filter(models.Instance.task_state.in_(task_states)).\
+        group_by(models.Instance.host).\
+        all()
+    return dict(rows)
+
+
+def _light_snapshots_query(context, session=None, use_slave=False):
+    return sqlalchemy_api.model_query(context, models.LightSnapshot,
+                                      session=session, read_deleted='no',
+                                      use_slave=use_slave)
+
+
+@sqlalchemy_api.require_context
+def light_snapshot_create(context, values):
+    """Record a new light snapshot of an instance."""
+    snapshot_ref = models.LightSnapshot()
+    snapshot_ref.update(values)
+    snapshot_ref.save()
+    return snapshot_ref
+
+
+@sqlalchemy_api.require_context
+def light_snapshot_get_all_by_instance(context, instance_uuid,
+                                       use_slave=False):
+    """Return the light snapshots of an instance, oldest first."""
+    return _light_snapshots_query(context, use_slave=use_slave).\
+        filter_by(instance_uuid=instance_uuid).\
+        order_by(models.LightSnapshot.snapshot_index).\
+        all()
+
+
+@sqlalchemy_api.require_context
+def light_snapshot_mark_committed(context, instance_uuid, root_index,
+                                  status):
+    """Set the status of the active snapshots of an instance up to
+       root_index, once they are committed to the root disk.
+
+       :returns: the number of snapshots updated
+    """
+    return _light_snapshots_query(context).\
+        filter_by(instance_uuid=instance_uuid).\
+        filter_by(status='active').\
+        filter(models.LightSnapshot.snapshot_index <= root_index).\
+        update({'status': status,
+                'committed_at': timeutils.utcnow()},
+               synchronize_session=False)
@@ -338,15 +338,6 @@ class Instance(BASE, NovaBase):
     # Records whether an instance has been deleted from disk
     cleaned = Column(Integer, default=0)
 
-    # Added by YuanruiFan. We add a column 'light_snapshot_enable' for the instance and
-    # to tell whether the instance allow light-snapshot
-    light_snapshot_enable = Column(Boolean)
-    snapshot_committed = Column(Boolean)
-    snapshot_index = Column(Integer)
-    root_index = Column(Integer)
-    snapshot_store = Column(Boolean)
-    snapshot_daily = Column(Boolean)    
-
 
 class InstanceInfoCache(BASE, NovaBase):
     """Represents a cache of information about an instance
@@ -388,6 +379,63 @@ class InstanceExtra(BASE, NovaBase):
                             primaryjoin=instance_uuid == Instance.uuid)
 
 
+# Added by YuanruiFan. The light-snapshot state of an instance. It is kept
+# out of the instances table, so that only the operations which need it
+# load it.
+class InstanceLightSnapshot(BASE, NovaBase):
+    """Represents the light-snapshot state of an instance."""
+    __tablename__ = 'instance_light_snapshot'
+    __table_args__ = (
+        schema.UniqueConstraint(
+            "instance_uuid",
+            name="uniq_instance_light_snapshot0instance_uuid"),
+        Index('instance_light_snapshot_enable_daily_idx',
+              'light_snapshot_enable', 'snapshot_daily'),
+        Index('instance_light_snapshot_snapshot_at_idx', 'snapshot_at'),)
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    instance_uuid = Column(String(36), ForeignKey('instances.uuid'),
+                           nullable=False)
+
+    # Whether the instance uses the light-snapshot system
+    light_snapshot_enable = Column(Boolean, default=False)
+    # Whether all the snapshots are committed to the root disk
+    snapshot_committed = Column(Boolean, default=False)
+    # Index of the top disk file, disk<snapshot_index>
+    snapshot_index = Column(Integer)
+    # Index of the last snapshot committed to the root disk
+    root_index = Column(Integer)
+    # Whether the committed snapshots are kept in snapshots/
+    snapshot_store = Column(Boolean, default=False)
+    # Whether the instance is snapshotted by the daily task
+    snapshot_daily = Column(Boolean, default=False)
+    # When the last snapshot was taken
+    snapshot_at = Column(DateTime)
+
+    instance = orm.relationship(Instance,
+                            backref=orm.backref('light_snapshot',
+                                                uselist=False),
+                            foreign_keys=instance_uuid,
+                            primaryjoin=instance_uuid == Instance.uuid)
+
+
+# Added by YuanruiFan. One row per light snapshot of an instance.
+class LightSnapshot(BASE, NovaBase):
+    """Represents a light snapshot of an instance."""
+    __tablename__ = 'light_snapshots'
+    __table_args__ = (
+        Index('light_snapshots_instance_uuid_index_idx',
+              'instance_uuid', 'snapshot_index'),
+        Index('light_snapshots_instance_uuid_status_idx',
+              'instance_uuid', 'status'),)
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    instance_uuid = Column(String(36), ForeignKey('instances.uuid'),
+                           nullable=False)
+    snapshot_index = Column(Integer, nullable=False)
+    # active, committed or stored
+    status = Column(String(16), nullable=False)
+    committed_at = Column(DateTime)
+
+
 class InstanceTypes(BASE, NovaBase):
     """Represents possible flavors for instances.
 
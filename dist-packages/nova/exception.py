@@ -397,6 +397,15 @@ class InstanceInvalidState(Invalid):
 class InstanceNotRunning(Invalid):
     msg_fmt = _("Instance %(instance_id)s is not running.")
 
+# Added by YuanruiFan. This exception is raised when the host of an
+# instance already runs as many light-snapshot operations as allowed.
+class LightSnapshotHostBusy(NovaException):
+    msg_fmt = _("The host of instance %(instance_uuid)s already runs "
+                "%(count)d light-snapshot operations, retry after "
+                "%(retry_after)d seconds.")
+    code = 429
+
+
 # Added by YuanruiFan. This exception is raised when we do
 # light snapshot for instance that is not running.
 class InstanceNotRunningInLightSnapshot(Invalid):
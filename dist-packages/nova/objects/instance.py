@@ -25,12 +25,14 @@ from nova.cells import rpcapi as cells_rpcapi
 from nova.cells import utils as cells_utils
 from nova.compute import flavors
 from nova import db
+from nova.db.sqlalchemy import light_snapshot_api as light_snapshot_db
 from nova import exception
 from nova.i18n import _LE
 from nova import notifications
 from nova import objects
 from nova.objects import base
 from nova.objects import fields
+from nova.objects import light_snapshot as light_snapshot_obj
 from nova import utils
 
 
@@ -44,7 +46,8 @@ _INSTANCE_OPTIONAL_JOINED_FIELDS = ['metadata', 'system_metadata',
                                     'pci_devices', 'tags']
 # These are fields that are optional but don't translate to db columns
 _INSTANCE_OPTIONAL_NON_COLUMN_FIELDS = ['fault', 'flavor', 'old_flavor',
-                                        'new_flavor', 'ec2_ids']
+                                        'new_flavor', 'ec2_ids',
+                                        'light_snapshot']
 # These are fields that are optional and in instance_extra
 _INSTANCE_EXTRA_FIELDS = ['numa_topology', 'pci_requests',
                           'flavor', 'vcpu_model', 'migration_context']
@@ -180,14 +183,9 @@ class _BaseInstance(base.NovaPersistentObject, base.NovaObject,
         'ec2_ids': fields.ObjectField('EC2Ids'),
         'migration_context': fields.ObjectField('MigrationContext',
                                                 nullable=True),
-        # Added by YuanruiFan. We add this column to notify that the instance 
-        # uses our light_snapshot_system
-        'light_snapshot_enable': fields.BooleanField(default=False),
-        'snapshot_committed': fields.BooleanField(default=False),
-        'snapshot_index': fields.IntegerField(nullable=True),
-        'root_index': fields.IntegerField(nullable=True),
-        'snapshot_store': fields.BooleanField(default=False),
-        'snapshot_daily': fields.BooleanField(default=False)
+        # Added by YuanruiFan. The state of our light_snapshot_system for
+        # the instance, only loaded when it is used.
+        'light_snapshot': fields.ObjectField('InstanceLightSnapshot'),
         }
 
     obj_extra_fields = ['name']
@@ -248,6 +246,35 @@ class _BaseInstance(base.NovaPersistentObject, base.NovaObject,
                 base_name = self.uuid
         return base_name
 
+    # Added by YuanruiFan. The light-snapshot fields used to be columns of
+    # the instance. They are kept as attributes of the instance, which
+    # read and write light_snapshot.
+    def _get_light_snapshot(self):
+        if (not self.obj_attr_is_set('light_snapshot') and
+                not self.obj_attr_is_set('id')):
+            # NOTE: The instance is not created yet, there is nothing to
+            # load. The state is created along with the instance.
+            self.light_snapshot = (
+                light_snapshot_obj.InstanceLightSnapshot._new(
+                    self._context, self.get('uuid', None)))
+        return self.light_snapshot
+
+    def _light_snapshot_property(name):
+        def getter(self):
+            return getattr(self._get_light_snapshot(), name)
+
+        def setter(self, value):
+            setattr(self._get_light_snapshot(), name, value)
+        return property(getter, setter)
+
+    light_snapshot_enable = _light_snapshot_property('light_snapshot_enable')
+    snapshot_committed = _light_snapshot_property('snapshot_committed')
+    snapshot_index = _light_snapshot_property('snapshot_index')
+    root_index = _light_snapshot_property('root_index')
+    snapshot_store = _light_snapshot_property('snapshot_store')
+    snapshot_daily = _light_snapshot_property('snapshot_daily')
+    del _light_snapshot_property
+
     def _flavor_from_db(self, db_flavor):
         """Load instance flavor information from instance_extra."""
 
@@ -323,6 +350,8 @@ class _BaseInstance(base.NovaPersistentObject, base.NovaObject,
                 instance.vcpu_model = None
         if 'ec2_ids' in expected_attrs:
             instance._load_ec2_ids()
+        if 'light_snapshot' in expected_attrs:
+            instance._load_light_snapshot()
         if 'migration_context' in expected_attrs:
             if have_extra:
                 instance._load_migration_context(
@@ -439,8 +468,12 @@ class _BaseInstance(base.NovaPersistentObject, base.NovaObject,
             expected_attrs.append('vcpu_model')
             updates['extra']['vcpu_model'] = (
                 jsonutils.dumps(vcpu_model.obj_to_primitive()))
+        light_snapshot = updates.pop('light_snapshot', None)
         db_inst = db.instance_create(self._context, updates)
         self._from_db_object(self._context, self, db_inst, expected_attrs)
+        if light_snapshot:
+            light_snapshot.instance_uuid = self.uuid
+            light_snapshot.save()
 
     @base.remotable
     def destroy(self):
@@ -464,6 +497,8 @@ class _BaseInstance(base.NovaPersistentObject, base.NovaObject,
             db_inst = db.instance_destroy(self._context, self.uuid,
                                           constraint=constraint)
             self._from_db_object(self._context, self, db_inst)
+            light_snapshot_db.instance_light_snapshot_destroy(self._context,
+                                                              self.uuid)
         except exception.ConstraintNotMet:
             raise exception.ObjectActionError(action='destroy',
                                               reason='host changed')
@@ -549,6 +584,28 @@ class _BaseInstance(base.NovaPersistentObject, base.NovaObject,
         # NOTE(hanlind): Read-only so no need to save this.
         pass
 
+    def _save_light_snapshot(self, context):
+        # NOTE: Written by save() once the task_state and vm_state checks
+        # have passed, see _update_light_snapshot.
+        pass
+
+    # Added by YuanruiFan. Write the light-snapshot changes of the instance.
+    # Given expected states, they are checked in the same transaction.
+    def _update_light_snapshot(self, context, expected_task_state=None,
+                               expected_vm_state=None):
+        if not self.obj_attr_is_set('light_snapshot'):
+            return
+        state = self.light_snapshot
+        updates = state.obj_get_changes()
+        updates.pop('instance_uuid', None)
+        if not updates:
+            return
+        db_state = light_snapshot_db.instance_light_snapshot_update(
+            context, self.uuid, updates,
+            expected_task_state=expected_task_state,
+            expected_vm_state=expected_vm_state)
+        state._from_db_object(context, state, db_state)
+
     def _save_migration_context(self, context):
         if self.migration_context:
             self.migration_context.instance_uuid = self.uuid
@@ -639,6 +696,10 @@ class _BaseInstance(base.NovaPersistentObject, base.NovaObject,
                     updates[field] = self[field]
 
         if not updates:
+            # Added by YuanruiFan. The light-snapshot state is checked
+            # against the expected states on its own.
+            self._update_light_snapshot(context, expected_task_state,
+                                        expected_vm_state)
             if cells_update_from_api:
                 _handle_cell_update_from_api()
             return
@@ -679,6 +740,9 @@ class _BaseInstance(base.NovaPersistentObject, base.NovaObject,
         old_ref, inst_ref = db.instance_update_and_get_original(
                 context, self.uuid, updates,
                 columns_to_join=_expected_cols(expected_attrs))
+        # Added by YuanruiFan. Only written once the instance update has
+        # passed its checks, and before light_snapshot is read back.
+        self._update_light_snapshot(context)
         self._from_db_object(context, self, inst_ref,
                              expected_attrs=expected_attrs)
 
@@ -801,6 +865,11 @@ class _BaseInstance(base.NovaPersistentObject, base.NovaObject,
     def _load_ec2_ids(self):
         self.ec2_ids = objects.EC2Ids.get_by_instance(self._context, self)
 
+    def _load_light_snapshot(self):
+        self.light_snapshot = (
+            light_snapshot_obj.InstanceLightSnapshot.get_by_instance_uuid(
+                self._context, self.uuid))
+
     def _load_migration_context(self, db_context=_NO_DATA_SENTINEL):
         if db_context is _NO_DATA_SENTINEL:
             try:
@@ -880,6 +949,8 @@ class _BaseInstance(base.NovaPersistentObject, base.NovaObject,
             self._load_ec2_ids()
         elif attrname == 'migration_context':
             self._load_migration_context()
+        elif attrname == 'light_snapshot':
+            self._load_light_snapshot()
         elif 'flavor' in attrname:
             self._load_flavor()
         else:
@@ -917,6 +988,27 @@ class _BaseInstance(base.NovaPersistentObject, base.NovaObject,
 
         self.save()
 
+    # Added by YuanruiFan. Reserve snapshot indexes of the instance in the
+    # database, see instance_allocate_snapshot_indexes.
+    def allocate_snapshot_indexes(self, count=1):
+        """Reserve the next count light-snapshot indexes.
+
+        snapshot_index is updated to the last index reserved.
+
+        :returns: the first and the last index reserved
+        """
+        return self._get_light_snapshot().allocate_indexes(count=count)
+
+    # Added by YuanruiFan. Give back an index reserved by
+    # allocate_snapshot_indexes, see instance_release_snapshot_index.
+    def release_snapshot_index(self, index, previous_index):
+        """Give back index if no other index has been reserved since.
+
+        :returns: True if the index has been given back
+        """
+        return self._get_light_snapshot().release_index(index,
+                                                        previous_index)
+
     @base.remotable
     def delete_metadata_key(self, key):
         """Optimized metadata delete method.
@@ -1010,7 +1102,12 @@ class InstanceV1(_BaseInstance):
     # Version 1.21: TagList 1.1
     # Version 1.22: InstanceNUMATopology 1.2
     # Version 1.23: Added migration_context
-    VERSION = '1.23'
+    # Version 1.24: Added allocate_snapshot_indexes()
+    # Version 1.25: Moved the light-snapshot fields to light_snapshot,
+    #               allocate_snapshot_indexes() is no longer remotable
+    # Version 1.26: InstanceLightSnapshot 1.1
+    # Version 1.27: InstanceLightSnapshot 1.2
+    VERSION = '1.27'
 
     fields = {
         # NOTE(sbiswas7): this field is depcrecated,
@@ -1032,6 +1129,8 @@ class InstanceV1(_BaseInstance):
         'vcpu_model': [('1.19', '1.0')],
         'ec2_ids': [('1.20', '1.0')],
         'migration_context': [('1.23', '1.0')],
+        'light_snapshot': [('1.25', '1.0'), ('1.26', '1.1'),
+                           ('1.27', '1.2')],
     }
 
     def obj_make_compatible(self, primitive, target_version):
@@ -1067,7 +1166,12 @@ class InstanceV1(_BaseInstance):
 @base.NovaObjectRegistry.register
 class InstanceV2(_BaseInstance):
     # Version 2.0: Initial version
-    VERSION = '2.0'
+    # Version 2.1: Added allocate_snapshot_indexes()
+    # Version 2.2: Moved the light-snapshot fields to light_snapshot,
+    #              allocate_snapshot_indexes() is no longer remotable
+    # Version 2.3: InstanceLightSnapshot 1.1
+    # Version 2.4: InstanceLightSnapshot 1.2
+    VERSION = '2.4'
 
     def obj_make_compatible(self, primitive, target_version):
         if target_version.startswith('1.'):
@@ -1103,6 +1207,20 @@ def _make_instance_list(context, inst_list, db_inst_list, expected_attrs):
             if fault.instance_uuid not in inst_faults:
                 inst_faults[fault.instance_uuid] = fault
 
+    # Added by YuanruiFan. Load the light-snapshot states of the whole list
+    # in one query.
+    get_light_snapshot = (expected_attrs and
+                          'light_snapshot' in expected_attrs)
+    inst_light_snapshots = {}
+    if get_light_snapshot:
+        expected_attrs = [attr for attr in expected_attrs
+                          if attr != 'light_snapshot']
+        instance_uuids = [inst['uuid'] for inst in db_inst_list]
+        states = light_snapshot_obj.InstanceLightSnapshotList.\
+            get_by_instance_uuids(context, instance_uuids)
+        for state in states:
+            inst_light_snapshots[state.instance_uuid] = state
+
     inst_cls = inst_list.NOVA_OBJ_INSTANCE_CLS
 
     inst_list.objects = []
@@ -1112,6 +1230,13 @@ def _make_instance_list(context, inst_list, db_inst_list, expected_attrs):
                 expected_attrs=expected_attrs)
         if get_fault:
             inst_obj.fault = inst_faults.get(inst_obj.uuid, None)
+        if get_light_snapshot:
+            state = inst_light_snapshots.get(inst_obj.uuid)
+            if state is None:
+                state = light_snapshot_obj.InstanceLightSnapshot._new(
+                    context, inst_obj.uuid)
+            inst_obj.light_snapshot = state
+            inst_obj.obj_reset_changes(['light_snapshot'])
         inst_list.objects.append(inst_obj)
     inst_list.obj_reset_changes()
     return inst_list
@@ -1127,6 +1252,8 @@ class _BaseInstanceList(base.ObjectListBase, base.NovaObject):
                        sort_key='created_at', sort_dir='desc', limit=None,
                        marker=None, expected_attrs=None, use_slave=False,
                        sort_keys=None, sort_dirs=None):
+        # Added by YuanruiFan. filters['light_snapshot'] is applied by
+        # instance_get_all_by_filters_sort, see light_snapshot_db.
         if sort_keys or sort_dirs:
             db_inst_list = db.instance_get_all_by_filters_sort(
                 context, filters, limit=limit, marker=marker,
@@ -1148,6 +1275,44 @@ class _BaseInstanceList(base.ObjectListBase, base.NovaObject):
         return _make_instance_list(context, cls(), db_inst_list,
                                    expected_attrs)
 
+    # Added by YuanruiFan. The instances of a host which light_snapshot_all
+    # snapshots, filtered in the database.
+    @base.remotable_classmethod
+    def get_light_snapshot_candidates(cls, context, host, daily=False,
+                                      expected_attrs=None, use_slave=False):
+        db_inst_list = (
+            light_snapshot_db.instance_get_light_snapshot_candidates(
+                context, host, daily=daily,
+                columns_to_join=_expected_cols(expected_attrs),
+                use_slave=use_slave))
+        return _make_instance_list(context, cls(), db_inst_list,
+                                   expected_attrs)
+
+    # Added by YuanruiFan. Set the task_state of a list of instances with
+    # a single database update, for the light-snapshot bulk operations.
+    @base.remotable_classmethod
+    def set_task_state(cls, context, instance_uuids, task_state,
+                       expected_task_state=None):
+        """Set the task_state of the instances whose task_state is
+        expected_task_state.
+
+        :returns: the uuids of the instances updated
+        """
+        return light_snapshot_db.instance_task_state_update_bulk(
+            context, instance_uuids, task_state,
+            expected_task_state=expected_task_state)
+
+    # Added by YuanruiFan. The number of light-snapshot operations in
+    # flight on each host, for the admission control of the API.
+    @base.remotable_classmethod
+    def count_by_hosts_and_task_states(cls, context, hosts, task_states):
+        """Count the instances of each host in one of task_states.
+
+        :returns: dict of host to the number of instances
+        """
+        return light_snapshot_db.instance_count_by_host_and_task_states(
+            context, hosts, task_states)
+
     @base.remotable_classmethod
     def get_by_host_and_node(cls, context, host, node, expected_attrs=None):
         db_inst_list = db.instance_get_all_by_host_and_node(
@@ -1296,7 +1461,14 @@ class InstanceListV1(_BaseInstanceList):
     # Version 1.20: Instance <= version 1.22
     # Version 1.21: New method get_by_grantee_security_group_ids()
     # Version 1.22: Instance <= version 1.23
-    VERSION = '1.22'
+    # Version 1.23: New method get_light_snapshot_candidates()
+    # Version 1.24: Instance <= version 1.24
+    # Version 1.25: Instance <= version 1.25
+    # Version 1.26: Instance <= version 1.26
+    # Version 1.27: New method set_task_state()
+    # Version 1.28: New method count_by_hosts_and_task_states()
+    # Version 1.29: Instance <= version 1.27
+    VERSION = '1.29'
 
     NOVA_OBJ_INSTANCE_CLS = InstanceV1
 
@@ -1309,14 +1481,23 @@ class InstanceListV1(_BaseInstanceList):
                     ('1.13', '1.17'), ('1.14', '1.18'), ('1.15', '1.19'),
                     ('1.16', '1.19'), ('1.17', '1.20'), ('1.18', '1.21'),
                     ('1.19', '1.21'), ('1.20', '1.22'), ('1.21', '1.22'),
-                    ('1.22', '1.23')],
+                    ('1.22', '1.23'), ('1.23', '1.23'),
+                    ('1.24', '1.24'), ('1.25', '1.25'),
+                    ('1.26', '1.26'), ('1.27', '1.26'),
+                    ('1.28', '1.26'), ('1.29', '1.27')],
     }
 
 
 @base.NovaObjectRegistry.register
 class InstanceListV2(_BaseInstanceList):
     # Version 2.0: Initial version
-    VERSION = '2.0'
+    # Version 2.1: New method get_light_snapshot_candidates()
+    # Version 2.2: Instance version 2.2
+    # Version 2.3: Instance version 2.3
+    # Version 2.4: New method set_task_state()
+    # Version 2.5: New method count_by_hosts_and_task_states()
+    # Version 2.6: Instance version 2.4
+    VERSION = '2.6'
 
     NOVA_OBJ_INSTANCE_CLS = InstanceV2
 
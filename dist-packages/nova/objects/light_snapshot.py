@@ -0,0 +1,223 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from nova.db.sqlalchemy import light_snapshot_api as light_snapshot_db
+from nova import exception
+from nova.objects import base
+from nova.objects import fields
+from nova import utils
+
+
+# Status of a light snapshot
+ACTIVE = 'active'
+COMMITTED = 'committed'
+STORED = 'stored'
+
+
+@base.NovaObjectRegistry.register
+class InstanceLightSnapshot(base.NovaPersistentObject, base.NovaObject):
+    # Version 1.0: Initial version
+    # Version 1.1: Added snapshot_at
+    # Version 1.2: Added release_index()
+    VERSION = '1.2'
+
+    fields = {
+        'instance_uuid': fields.UUIDField(),
+        'light_snapshot_enable': fields.BooleanField(default=False),
+        'snapshot_committed': fields.BooleanField(default=False),
+        'snapshot_index': fields.IntegerField(nullable=True),
+        'root_index': fields.IntegerField(nullable=True),
+        'snapshot_store': fields.BooleanField(default=False),
+        'snapshot_daily': fields.BooleanField(default=False),
+        'snapshot_at': fields.DateTimeField(nullable=True),
+    }
+
+    def obj_make_compatible(self, primitive, target_version):
+        super(InstanceLightSnapshot, self).obj_make_compatible(
+            primitive, target_version)
+        target_version = utils.convert_version_to_tuple(target_version)
+        if target_version < (1, 1):
+            primitive.pop('snapshot_at', None)
+
+    @staticmethod
+    def _from_db_object(context, state, db_state):
+        for field in state.fields:
+            setattr(state, field, db_state[field])
+        state._context = context
+        state.obj_reset_changes()
+        return state
+
+    @classmethod
+    def _new(cls, context, instance_uuid):
+        """The state of an instance which has never used light snapshots."""
+        state = cls(context)
+        if instance_uuid is not None:
+            state.instance_uuid = instance_uuid
+        state.obj_set_defaults('light_snapshot_enable', 'snapshot_committed',
+                               'snapshot_store', 'snapshot_daily')
+        state.snapshot_index = None
+        state.root_index = None
+        state.snapshot_at = None
+        state.obj_reset_changes()
+        return state
+
+    @base.remotable_classmethod
+    def get_by_instance_uuid(cls, context, instance_uuid):
+        db_state = light_snapshot_db.instance_light_snapshot_get(
+            context, instance_uuid)
+        if db_state is None:
+            return cls._new(context, instance_uuid)
+        return cls._from_db_object(context, cls(context), db_state)
+
+    @base.remotable
+    def save(self):
+        updates = self.obj_get_changes()
+        updates.pop('instance_uuid', None)
+        if updates:
+            db_state = light_snapshot_db.instance_light_snapshot_update(
+                self._context, self.instance_uuid, updates)
+            self._from_db_object(self._context, self, db_state)
+        self.obj_reset_changes()
+
+    @base.remotable
+    def allocate_indexes(self, count=1):
+        """Reserve the next count snapshot indexes.
+
+        snapshot_index is updated to the last index reserved.
+
+        :returns: the first and the last index reserved
+        """
+        first, last = light_snapshot_db.instance_allocate_snapshot_indexes(
+            self._context, self.instance_uuid, count=count)
+        self.snapshot_index = last
+        self.obj_reset_changes(['snapshot_index'])
+        return first, last
+
+    @base.remotable
+    def release_index(self, index, previous_index):
+        """Give back index, reserved by allocate_indexes.
+
+        snapshot_index goes back to previous_index unless another index
+        has been reserved since.
+
+        :returns: True if the index has been given back
+        """
+        released = light_snapshot_db.instance_release_snapshot_index(
+            self._context, self.instance_uuid, index, previous_index)
+        if released:
+            self.snapshot_index = previous_index
+            self.obj_reset_changes(['snapshot_index'])
+        return released
+
+
+@base.NovaObjectRegistry.register
+class InstanceLightSnapshotList(base.ObjectListBase, base.NovaObject):
+    # Version 1.0: Initial version
+    # Version 1.1: InstanceLightSnapshot <= version 1.1
+    #              get_enabled() replaced by get_by_filters()
+    # Version 1.2: InstanceLightSnapshot <= version 1.2
+    # Version 1.3: New method update_by_instance_uuids()
+    VERSION = '1.3'
+
+    fields = {
+        'objects': fields.ListOfObjectsField('InstanceLightSnapshot'),
+    }
+    obj_relationships = {
+        'objects': [('1.0', '1.0'), ('1.1', '1.1'), ('1.2', '1.2'),
+                    ('1.3', '1.2')],
+    }
+
+    @base.remotable_classmethod
+    def get_by_instance_uuids(cls, context, instance_uuids, use_slave=False):
+        db_states = (
+            light_snapshot_db.instance_light_snapshot_get_by_instance_uuids(
+                context, instance_uuids, use_slave=use_slave))
+        return base.obj_make_list(context, cls(context),
+                                  InstanceLightSnapshot,
+                                  db_states)
+
+    @base.remotable_classmethod
+    def get_by_filters(cls, context, filters, use_slave=False):
+        """See instance_light_snapshot_get_all_by_filters."""
+        db_states = (
+            light_snapshot_db.instance_light_snapshot_get_all_by_filters(
+                context, filters, use_slave=use_slave))
+        return base.obj_make_list(context, cls(context),
+                                  InstanceLightSnapshot,
+                                  db_states)
+
+    @base.remotable_classmethod
+    def update_by_instance_uuids(cls, context, instance_uuids, values):
+        """See instance_light_snapshot_update_bulk."""
+        return light_snapshot_db.instance_light_snapshot_update_bulk(
+            context, instance_uuids, values)
+
+
+@base.NovaObjectRegistry.register
+class LightSnapshot(base.NovaPersistentObject, base.NovaObject):
+    # Version 1.0: Initial version
+    VERSION = '1.0'
+
+    fields = {
+        'id': fields.IntegerField(read_only=True),
+        'instance_uuid': fields.UUIDField(),
+        'snapshot_index': fields.IntegerField(),
+        'status': fields.StringField(),
+        'committed_at': fields.DateTimeField(nullable=True),
+    }
+
+    @staticmethod
+    def _from_db_object(context, snapshot, db_snapshot):
+        for field in snapshot.fields:
+            setattr(snapshot, field, db_snapshot[field])
+        snapshot._context = context
+        snapshot.obj_reset_changes()
+        return snapshot
+
+    @base.remotable
+    def create(self):
+        if self.obj_attr_is_set('id'):
+            raise exception.ObjectActionError(action='create',
+                                              reason='already created')
+        updates = self.obj_get_changes()
+        db_snapshot = light_snapshot_db.light_snapshot_create(self._context,
+                                                              updates)
+        self._from_db_object(self._context, self, db_snapshot)
+
+
+@base.NovaObjectRegistry.register
+class LightSnapshotList(base.ObjectListBase, base.NovaObject):
+    # Version 1.0: Initial version
+    VERSION = '1.0'
+
+    fields = {
+        'objects': fields.ListOfObjectsField('LightSnapshot'),
+    }
+    obj_relationships = {
+        'objects': [('1.0', '1.0')],
+    }
+
+    @base.remotable_classmethod
+    def get_by_instance_uuid(cls, context, instance_uuid, use_slave=False):
+        db_snapshots = light_snapshot_db.light_snapshot_get_all_by_instance(
+            context, instance_uuid, use_slave=use_slave)
+        return base.obj_make_list(context, cls(context), LightSnapshot,
+                                  db_snapshots)
+
+    @base.remotable_classmethod
+    def mark_committed(cls, context, instance_uuid, root_index, stored=False):
+        """Record that the active snapshots up to root_index have been
+        committed to the root disk, and kept in snapshots/ if stored.
+        """
+        light_snapshot_db.light_snapshot_mark_committed(
+            context, instance_uuid, root_index,
+            STORED if stored else COMMITTED)
@@ -0,0 +1,282 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import datetime
+
+import mock
+import webob
+
+from nova.api.openstack.compute import extension_info
+from nova.api.openstack.compute import servers
+from nova.compute import api as compute_api
+from nova import exception
+from nova import objects
+from nova import test
+from nova.tests.unit.api.openstack import fakes
+from nova.tests.unit import fake_instance
+
+
+class LightSnapshotServersTestCase(test.NoDBTestCase):
+    def setUp(self):
+        super(LightSnapshotServersTestCase, self).setUp()
+        ext_info = extension_info.LoadedExtensionInfo()
+        self.controller = servers.ServersController(extension_info=ext_info)
+
+
+class LightSnapshotFiltersTestCase(LightSnapshotServersTestCase):
+    def setUp(self):
+        super(LightSnapshotFiltersTestCase, self).setUp()
+        patcher = mock.patch.object(compute_api.API, 'get_all',
+                                    return_value=objects.InstanceList(
+                                        objects=[]))
+        self.mock_get_all = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _list(self, params, use_admin_context=True):
+        req = fakes.HTTPRequestV21.blank(
+            '/fake/servers?%s' % params,
+            use_admin_context=use_admin_context)
+        self.controller.index(req)
+        return self.mock_get_all.call_args[1]['search_opts']
+
+    def test_boolean_filters(self):
+        search_opts = self._list('light_snapshot_enable=false'
+                                 '&snapshot_daily=1&snapshot_store=true')
+        self.assertEqual({'light_snapshot_enable': False,
+                          'snapshot_daily': True,
+                          'snapshot_store': True},
+                         search_opts['light_snapshot'])
+        self.assertNotIn('light_snapshot_enable', search_opts)
+
+    def test_snapshot_older_than(self):
+        search_opts = self._list('snapshot_older_than=2016-01-24T17:08:01Z')
+        older_than = search_opts['light_snapshot']['snapshot_older_than']
+        self.assertEqual(datetime.datetime(2016, 1, 24, 17, 8, 1),
+                         older_than.replace(tzinfo=None))
+        self.assertNotIn('snapshot_older_than', search_opts)
+
+    def test_snapshot_older_than_invalid(self):
+        self.assertRaises(webob.exc.HTTPBadRequest, self._list,
+                          'snapshot_older_than=yesterday')
+
+    def test_without_filters(self):
+        search_opts = self._list('name=server')
+        self.assertNotIn('light_snapshot', search_opts)
+
+    def test_filters_ignored_for_non_admin(self):
+        search_opts = self._list('light_snapshot_enable=false',
+                                 use_admin_context=False)
+        self.assertNotIn('light_snapshot', search_opts)
+
+
+class LightSnapshotBulkTestCase(LightSnapshotServersTestCase):
+    def setUp(self):
+        super(LightSnapshotBulkTestCase, self).setUp()
+        self.req = fakes.HTTPRequestV21.blank(
+            '/fake/servers/light_snapshot_bulk', use_admin_context=True)
+        self.context = self.req.environ['nova.context']
+        self.enabled = self._create_instance(light_snapshot_enable=True)
+        self.disabled = self._create_instance()
+        for patcher in (
+                mock.patch.object(objects.InstanceList, 'get_by_filters',
+                                  return_value=[self.enabled,
+                                                self.disabled]),
+                mock.patch.object(compute_api.API, 'light_snapshot_bulk',
+                                  return_value={}),
+                mock.patch.object(servers, 'authorize')):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def _create_instance(self, **light_snapshot):
+        instance = fake_instance.fake_instance_obj(self.context)
+        instance.light_snapshot = objects.InstanceLightSnapshot._new(
+            self.context, instance.uuid)
+        for field, value in light_snapshot.items():
+            setattr(instance.light_snapshot, field, value)
+        instance.light_snapshot.obj_reset_changes()
+        return instance
+
+    def _bulk(self, action, servers=None, options=None):
+        if servers is None:
+            servers = [self.enabled.uuid, self.disabled.uuid]
+        body = {'lightSnapshotBulk': {'action': action, 'servers': servers,
+                                      'options': options}}
+        return self.controller.light_snapshot_bulk(self.req,
+                                                   body=body)['servers']
+
+    def _accepted(self, results):
+        return dict((result['id'], result['accepted'])
+                    for result in results)
+
+    def test_invalid_body(self):
+        self.assertRaises(webob.exc.HTTPBadRequest,
+                          self.controller.light_snapshot_bulk, self.req,
+                          body={'createSnapshot': {}})
+
+    def test_invalid_action(self):
+        self.assertRaises(webob.exc.HTTPBadRequest, self._bulk,
+                          'deleteSnapshot')
+
+    def test_invalid_servers(self):
+        self.assertRaises(webob.exc.HTTPBadRequest, self._bulk,
+                          'createSnapshot', servers=[])
+        self.assertRaises(webob.exc.HTTPBadRequest, self._bulk,
+                          'createSnapshot', servers=self.enabled.uuid)
+
+    def test_recover_use_root_and_snap_index(self):
+        self.assertRaises(webob.exc.HTTPBadRequest, self._bulk,
+                          'recoverInstance',
+                          options={'use_root': True, 'snap_index': 2})
+
+    def test_create_snapshot(self):
+        missing = '00000000-0000-0000-0000-000000000000'
+        results = self._bulk('createSnapshot',
+                             servers=[self.enabled.uuid, self.disabled.uuid,
+                                      missing, 'not-a-uuid'],
+                             options={'skip_empty': True})
+
+        self.assertEqual({self.enabled.uuid: True, self.disabled.uuid: False,
+                          missing: False, 'not-a-uuid': False},
+                         self._accepted(results))
+        objects.InstanceList.get_by_filters.assert_called_once_with(
+            self.context,
+            {'uuid': [self.enabled.uuid, self.disabled.uuid, missing],
+             'deleted': False},
+            expected_attrs=['light_snapshot'])
+        compute_api.API.light_snapshot_bulk.assert_called_once_with(
+            self.context, [self.enabled], 'create_snapshot',
+            kwargs={'skip_empty': True})
+
+    def test_forbidden(self):
+        def fake_authorize(context, instance, action):
+            if instance is self.disabled:
+                raise exception.PolicyNotAuthorized(action=action)
+        servers.authorize.side_effect = fake_authorize
+
+        results = self._bulk('commitSnapshot')
+
+        self.assertEqual({self.enabled.uuid: True, self.disabled.uuid: False},
+                         self._accepted(results))
+        servers.authorize.assert_any_call(self.context, self.enabled,
+                                          'commit_snapshot')
+        compute_api.API.light_snapshot_bulk.assert_called_once_with(
+            self.context, [self.enabled], 'commit_snapshot')
+
+    def test_rejected_by_compute_api(self):
+        compute_api.API.light_snapshot_bulk.return_value = {
+            self.enabled.uuid: 'busy'}
+
+        results = self._bulk('commitSnapshot')
+
+        self.assertEqual([{'id': self.enabled.uuid, 'accepted': False,
+                           'reason': 'busy'},
+                          {'id': self.disabled.uuid, 'accepted': True}],
+                         results)
+        compute_api.API.light_snapshot_bulk.assert_called_once_with(
+            self.context, [self.enabled, self.disabled], 'commit_snapshot')
+
+    def test_recover(self):
+        self._bulk('recoverInstance', servers=[self.enabled.uuid],
+                   options={'snap_index': 2})
+        compute_api.API.light_snapshot_bulk.assert_called_once_with(
+            self.context, [self.enabled], 'recover',
+            kwargs={'use_root': False, 'snap_index': 2})
+
+    def test_enable_snapshot(self):
+        results = self._bulk('enableSnapshot')
+
+        self.assertEqual({self.enabled.uuid: True, self.disabled.uuid: True},
+                         self._accepted(results))
+        compute_api.API.light_snapshot_bulk.assert_called_once_with(
+            self.context, [self.disabled], 'enable')
+
+    @mock.patch.object(objects.InstanceLightSnapshotList,
+                       'update_by_instance_uuids')
+    def test_daily_snapshot(self, mock_update):
+        mock_update.return_value = [self.enabled.uuid, self.disabled.uuid]
+        results = self._bulk('dailySnapshot', options={'enable': False})
+
+        mock_update.assert_called_once_with(
+            self.context, [self.enabled.uuid, self.disabled.uuid],
+            {'snapshot_daily': False})
+        self.assertEqual({self.enabled.uuid: True, self.disabled.uuid: True},
+                         self._accepted(results))
+        self.assertFalse(compute_api.API.light_snapshot_bulk.called)
+
+    @mock.patch.object(objects.InstanceLightSnapshotList,
+                       'update_by_instance_uuids')
+    def test_store_snapshot(self, mock_update):
+        mock_update.return_value = [self.enabled.uuid, self.disabled.uuid]
+        self._bulk('storeSnapshot')
+
+        mock_update.assert_called_once_with(
+            self.context, [self.enabled.uuid, self.disabled.uuid],
+            {'snapshot_store': True})
+        compute_api.API.light_snapshot_bulk.assert_called_once_with(
+            self.context, [self.enabled], 'store_init')
+
+    @mock.patch.object(objects.InstanceLightSnapshotList,
+                       'update_by_instance_uuids')
+    def test_store_snapshot_instance_deleted(self, mock_update):
+        mock_update.return_value = [self.disabled.uuid]
+        results = self._bulk('storeSnapshot')
+
+        self.assertEqual({self.enabled.uuid: False, self.disabled.uuid: True},
+                         self._accepted(results))
+        compute_api.API.light_snapshot_bulk.assert_called_once_with(
+            self.context, [], 'store_init')
+
+
+class LightSnapshotHostBusyTestCase(LightSnapshotServersTestCase):
+    def setUp(self):
+        super(LightSnapshotHostBusyTestCase, self).setUp()
+        self.req = fakes.HTTPRequestV21.blank('/fake/servers/fake/action',
+                                              use_admin_context=True)
+        context = self.req.environ['nova.context']
+        instance = fake_instance.fake_instance_obj(context)
+        instance.light_snapshot = objects.InstanceLightSnapshot._new(
+            context, instance.uuid)
+        instance.light_snapshot.light_snapshot_enable = True
+        self.busy = exception.LightSnapshotHostBusy(
+            instance_uuid=instance.uuid, count=2, retry_after=10)
+        for patcher in (
+                mock.patch.object(self.controller, '_get_instance',
+                                  return_value=instance),
+                mock.patch.object(servers, 'authorize')):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def _assert_too_many_requests(self, action, body):
+        ex = self.assertRaises(webob.exc.HTTPTooManyRequests, action,
+                               self.req, 'fake', body=body)
+        self.assertEqual('10', str(ex.headers['Retry-After']))
+
+    @mock.patch.object(compute_api.API, 'light_snapshot')
+    def test_create_snapshot(self, mock_snapshot):
+        mock_snapshot.side_effect = self.busy
+        self._assert_too_many_requests(
+            self.controller._light_snapshot_instance,
+            {'createSnapshot': None})
+
+    @mock.patch.object(compute_api.API, 'commit_snapshot')
+    def test_commit_snapshot(self, mock_commit):
+        mock_commit.side_effect = self.busy
+        self._assert_too_many_requests(
+            self.controller._light_commit_snapshot,
+            {'commitSnapshot': None})
+
+    @mock.patch.object(compute_api.API, 'light_recover')
+    def test_recover(self, mock_recover):
+        mock_recover.side_effect = self.busy
+        self._assert_too_many_requests(
+            self.controller._light_recover_instance,
+            {'recoverInstance': {'use_root': False, 'snap_index': None}})
@@ -0,0 +1,138 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import json
+import os
+
+import fixtures
+import mock
+
+from nova.compute.light_snapshot import journal
+from nova import exception
+from nova import test
+
+
+class JournalTestCase(test.NoDBTestCase):
+    def setUp(self):
+        super(JournalTestCase, self).setUp()
+        self.instance_path = self.useFixture(fixtures.TempDir()).path
+        self.path = os.path.join(self.instance_path,
+                                 journal.JOURNAL_FILENAME)
+        self.calls = []
+        self.handlers = {
+            'mv': lambda src, dest: self.calls.append(('mv', src, dest)),
+            'rm': lambda path: self.calls.append(('rm', path)),
+        }
+        self.steps = [['mv', 'disk2', 'snapshots/disk2'],
+                      ['mv', 'disk3', 'disk2'],
+                      ['rm', 'disk1']]
+        self.rollback = [['mv', 'snapshots/disk2', 'disk2']]
+
+    def _read(self):
+        with open(self.path) as f:
+            return json.load(f)
+
+    def _fail_on(self, name):
+        def fail(*args):
+            raise test.TestingException()
+        self.handlers[name] = fail
+
+    def test_begin_writes_journal(self):
+        journal.Journal.begin(self.instance_path, 'post_commit', self.steps,
+                              commit_point=2, rollback=self.rollback)
+
+        self.assertEqual({'operation': 'post_commit', 'steps': self.steps,
+                          'done': 0, 'commit_point': 2,
+                          'rollback': self.rollback}, self._read())
+        self.assertFalse(os.path.exists(self.path + '.tmp'))
+
+    def test_begin_unfinished(self):
+        journal.Journal.begin(self.instance_path, 'post_commit', self.steps)
+        self.assertRaises(exception.NovaException, journal.Journal.begin,
+                          self.instance_path, 'recover', self.steps)
+
+    def test_load_none(self):
+        self.assertIsNone(journal.Journal.load(self.instance_path))
+
+    def test_run(self):
+        jnl = journal.Journal.begin(self.instance_path, 'post_commit',
+                                    self.steps)
+        jnl.run(self.handlers)
+
+        self.assertEqual([tuple(step) for step in self.steps], self.calls)
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_run_unknown_step(self):
+        jnl = journal.Journal.begin(self.instance_path, 'post_commit',
+                                    [['cp', 'disk1', 'disk2']])
+        self.assertRaises(exception.NovaException, jnl.run, self.handlers)
+
+    def test_run_fails_before_commit_point(self):
+        self._fail_on('rm')
+        jnl = journal.Journal.begin(self.instance_path, 'post_commit',
+                                    self.steps + [['rm', 'disk4']],
+                                    commit_point=4, rollback=self.rollback)
+
+        self.assertRaises(test.TestingException, jnl.run, self.handlers)
+
+        self.assertEqual([('mv', 'disk2', 'snapshots/disk2'),
+                          ('mv', 'disk3', 'disk2'),
+                          ('mv', 'snapshots/disk2', 'disk2')], self.calls)
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_run_fails_past_commit_point(self):
+        self._fail_on('rm')
+        jnl = journal.Journal.begin(self.instance_path, 'post_commit',
+                                    self.steps, commit_point=2,
+                                    rollback=self.rollback)
+
+        self.assertRaises(test.TestingException, jnl.run, self.handlers)
+
+        self.assertEqual(2, self._read()['done'])
+        self.assertEqual(2, len(self.calls))
+
+    @mock.patch.object(journal.LOG, 'exception')
+    def test_run_rollback_fails(self, mock_log):
+        self.handlers['mv'] = mock.Mock(
+            side_effect=[None, test.TestingException, test.TestingException])
+        jnl = journal.Journal.begin(self.instance_path, 'post_commit',
+                                    self.steps, commit_point=3,
+                                    rollback=self.rollback)
+
+        self.assertRaises(test.TestingException, jnl.run, self.handlers)
+
+        self.assertTrue(mock_log.called)
+        self.assertEqual(1, self._read()['done'])
+
+    def test_recover_replays(self):
+        jnl = journal.Journal.begin(self.instance_path, 'post_commit',
+                                    self.steps, commit_point=2,
+                                    rollback=self.rollback)
+        jnl.done = 2
+        jnl._write()
+
+        journal.Journal.load(self.instance_path).recover(self.handlers)
+
+        self.assertEqual([('rm', 'disk1')], self.calls)
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_recover_rolls_back(self):
+        jnl = journal.Journal.begin(self.instance_path, 'post_commit',
+                                    self.steps, commit_point=2,
+                                    rollback=self.rollback)
+        jnl.done = 1
+        jnl._write()
+
+        journal.Journal.load(self.instance_path).recover(self.handlers)
+
+        self.assertEqual([('mv', 'snapshots/disk2', 'disk2')], self.calls)
+        self.assertFalse(os.path.exists(self.path))
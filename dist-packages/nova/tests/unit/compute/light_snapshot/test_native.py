@@ -0,0 +1,89 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import mock
+
+from nova.compute.light_snapshot import native
+from nova.compute.light_snapshot import profiler
+from nova import test
+
+
+class NativeCallTestCase(test.NoDBTestCase):
+    def setUp(self):
+        super(NativeCallTestCase, self).setUp()
+        self.flags(light_snapshot_profile_execute=True)
+        self.addCleanup(profiler._last_profiles.clear)
+        self.addCleanup(setattr, native, '_semaphore', None)
+        native._semaphore = None
+
+    @mock.patch('eventlet.tpool.execute')
+    def test_call(self, mock_execute):
+        func = mock.Mock()
+        with profiler.profile('uuid', 'commit') as prof:
+            result = native.call('virDomain.blockCommit', func, 'vda',
+                                 flags=4)
+
+        self.assertEqual(mock_execute.return_value, result)
+        mock_execute.assert_called_once_with(func, 'vda', flags=4)
+        self.assertEqual(['virDomain.blockCommit'], list(prof.commands))
+
+    @mock.patch('eventlet.tpool.execute', side_effect=test.TestingException)
+    def test_call_fails(self, mock_execute):
+        with profiler.profile('uuid', 'commit') as prof:
+            self.assertRaises(test.TestingException, native.call,
+                              'virDomain.blockCommit', mock.Mock())
+        self.assertEqual(1, prof.failed_count)
+
+    def test_semaphore_bounded(self):
+        self.flags(light_snapshot_native_threads=2)
+        semaphore = native._get_semaphore()
+        self.assertEqual(2, semaphore.balance)
+        self.assertIs(semaphore, native._get_semaphore())
+
+    @mock.patch.object(native, 'call')
+    def test_proxy(self, mock_call):
+        domain = mock.Mock()
+        domain.name = 'instance-00000001'
+        proxy = native.NativeProxy(domain)
+
+        self.assertEqual('instance-00000001', proxy.name)
+        proxy.blockCommit('vda', None, None, 0, flags=4)
+
+        mock_call.assert_called_once_with('virDomain.blockCommit',
+                                          domain.blockCommit, 'vda', None,
+                                          None, 0, flags=4)
+
+
+class StallDetectorTestCase(test.NoDBTestCase):
+    def setUp(self):
+        super(StallDetectorTestCase, self).setUp()
+        self.addCleanup(setattr, native, '_detector', None)
+        native._detector = None
+
+    @mock.patch.object(native.HubStallDetector, 'start')
+    def test_start(self, mock_start):
+        self.flags(light_snapshot_hub_stall_threshold=2.0)
+
+        native.start_stall_detector()
+        native.start_stall_detector()
+
+        self.assertEqual(2.0, native._detector.threshold)
+        mock_start.assert_called_once_with()
+
+    @mock.patch.object(native.HubStallDetector, 'start')
+    def test_start_disabled(self, mock_start):
+        self.flags(light_snapshot_hub_stall_threshold=0)
+
+        native.start_stall_detector()
+
+        self.assertIsNone(native._detector)
+        self.assertFalse(mock_start.called)
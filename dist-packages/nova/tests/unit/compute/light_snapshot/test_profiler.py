@@ -0,0 +1,94 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import mock
+
+from nova.compute.light_snapshot import profiler
+from nova import test
+from nova.virt.libvirt import utils as libvirt_utils
+
+
+class ProfilerTestCase(test.NoDBTestCase):
+    def setUp(self):
+        super(ProfilerTestCase, self).setUp()
+        self.flags(light_snapshot_profile_execute=True)
+        self.addCleanup(profiler._last_profiles.clear)
+
+    def test_profile_disabled(self):
+        self.flags(light_snapshot_profile_execute=False)
+        with profiler.profile('uuid', 'snapshot') as prof:
+            self.assertIsNone(prof)
+            with profiler.timed(['qemu-img', 'info', 'disk']):
+                pass
+        self.assertIsNone(profiler.get_last_profile('uuid'))
+
+    def test_timed_records_command(self):
+        with profiler.profile('uuid', 'snapshot') as prof:
+            with profiler.timed(['qemu-img', 'info', 'disk'], as_root=True):
+                pass
+            with profiler.timed(['mv', 'disk1', 'snapshots/disk1']):
+                pass
+
+        self.assertEqual(2, prof.count)
+        self.assertEqual(1, prof.root_count)
+        self.assertEqual(0, prof.failed_count)
+        self.assertEqual(set(['qemu-img info', 'mv']),
+                         set(prof.commands))
+        self.assertEqual(['test_timed_records_command'], list(prof.callers))
+        self.assertEqual('snapshot',
+                         profiler.get_last_profile('uuid')['operation'])
+
+    def test_timed_counts_failure(self):
+        def _fail():
+            with profiler.timed(['rm', '-rf', 'disk1']):
+                raise test.TestingException()
+
+        with profiler.profile('uuid', 'commit') as prof:
+            self.assertRaises(test.TestingException, _fail)
+
+        self.assertEqual(1, prof.count)
+        self.assertEqual(1, prof.failed_count)
+
+    def test_nested_profile_uses_outermost(self):
+        with profiler.profile('uuid', 'commit') as outer:
+            with profiler.profile('uuid', 'post_commit') as inner:
+                self.assertIs(outer, inner)
+                self.assertEqual(2, profiler.active_operations())
+        self.assertEqual(0, profiler.active_operations())
+        self.assertIsNone(profiler.current())
+
+    def test_last_profiles_bounded(self):
+        self.flags(light_snapshot_profile_history=1)
+        for uuid in ('uuid1', 'uuid2'):
+            with profiler.profile(uuid, 'snapshot'):
+                pass
+        self.assertIsNone(profiler.get_last_profile('uuid1'))
+        self.assertIsNotNone(profiler.get_last_profile('uuid2'))
+
+    def test_usage_info(self):
+        self.assertEqual({}, profiler.usage_info(None))
+        with profiler.profile('uuid', 'snapshot') as prof:
+            pass
+        self.assertEqual(prof.to_dict(),
+                         profiler.usage_info(prof)['execute_profile'])
+
+    @mock.patch('nova.utils.execute', return_value=('', ''))
+    def test_libvirt_utils_execute_accounted(self, mock_execute):
+        with profiler.profile('uuid', 'snapshot') as prof:
+            libvirt_utils.execute('qemu-img', 'rebase', '-u', 'disk1',
+                                  run_as_root=True)
+        mock_execute.assert_called_once_with('qemu-img', 'rebase', '-u',
+                                             'disk1', run_as_root=True)
+        self.assertEqual({'qemu-img rebase': {'count': 1,
+                                              'time': mock.ANY}},
+                         prof.commands)
+        self.assertEqual(1, prof.root_count)
@@ -0,0 +1,71 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import mock
+
+from nova.compute.light_snapshot import progress
+from nova import exception
+from nova import test
+
+
+@mock.patch('time.time')
+class InstanceProgressTestCase(test.NoDBTestCase):
+    def setUp(self):
+        super(InstanceProgressTestCase, self).setUp()
+        self.flags(light_snapshot_progress_interval=5,
+                   light_snapshot_progress_step=5)
+        self.instance = mock.Mock(progress=None)
+        self.progress = progress.InstanceProgress(self.instance)
+
+    def test_first_update_written(self, mock_time):
+        mock_time.return_value = 100
+        self.progress.update(1, 4)
+        self.assertEqual(25, self.instance.progress)
+        self.instance.save.assert_called_once_with()
+
+    def test_small_step_skipped(self, mock_time):
+        mock_time.return_value = 100
+        self.progress.update(10, 100)
+        mock_time.return_value = 200
+        self.progress.update(12, 100)
+        self.assertEqual(10, self.instance.progress)
+        self.assertEqual(1, self.instance.save.call_count)
+
+    def test_too_soon_skipped(self, mock_time):
+        mock_time.return_value = 100
+        self.progress.update(10, 100)
+        mock_time.return_value = 102
+        self.progress.update(50, 100)
+        self.assertEqual(10, self.instance.progress)
+        mock_time.return_value = 106
+        self.progress.update(50, 100)
+        self.assertEqual(50, self.instance.progress)
+        self.assertEqual(2, self.instance.save.call_count)
+
+    def test_completion_always_written(self, mock_time):
+        mock_time.return_value = 100
+        self.progress.update(98, 100)
+        self.progress.update(100, 100)
+        self.assertEqual(100, self.instance.progress)
+        self.progress.finish()
+        self.assertEqual(2, self.instance.save.call_count)
+
+    def test_zero_end_ignored(self, mock_time):
+        self.progress.update(0, 0)
+        self.assertFalse(self.instance.save.called)
+
+    def test_instance_gone(self, mock_time):
+        mock_time.return_value = 100
+        self.instance.save.side_effect = exception.InstanceNotFound(
+            instance_id='uuid')
+        self.progress.finish()
+        self.assertEqual(100, self.instance.progress)
@@ -0,0 +1,79 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import mock
+
+from nova.compute.light_snapshot import unit_of_work
+from nova import test
+
+
+class UnitOfWorkTestCase(test.NoDBTestCase):
+    def setUp(self):
+        super(UnitOfWorkTestCase, self).setUp()
+        self.instance = mock.Mock(uuid='uuid')
+        self.instance.obj_what_changed.return_value = set(['snapshot_index'])
+
+    def test_save_outside_unit(self):
+        unit_of_work.save(self.instance)
+        self.instance.save.assert_called_once_with()
+
+    def test_saves_deferred_to_end(self):
+        with unit_of_work.unit_of_work(self.instance) as unit:
+            unit_of_work.save(self.instance)
+            unit_of_work.save(self.instance)
+            self.assertEqual(2, unit.deferred)
+            self.assertFalse(self.instance.save.called)
+        self.instance.save.assert_called_once_with()
+
+    def test_flush(self):
+        with unit_of_work.unit_of_work(self.instance) as unit:
+            unit_of_work.save(self.instance)
+            unit.flush(expected_task_state=['light_snapshot'])
+            self.assertEqual(0, unit.deferred)
+        self.instance.save.assert_called_once_with(
+            expected_task_state=['light_snapshot'])
+
+    def test_nothing_left_to_save(self):
+        with unit_of_work.unit_of_work(self.instance):
+            unit_of_work.save(self.instance)
+            self.instance.obj_what_changed.return_value = set()
+        self.assertFalse(self.instance.save.called)
+
+    def test_no_deferred_save(self):
+        with unit_of_work.unit_of_work(self.instance):
+            pass
+        self.assertFalse(self.instance.save.called)
+
+    def test_nested_units(self):
+        with unit_of_work.unit_of_work(self.instance) as outer:
+            with unit_of_work.unit_of_work(self.instance) as inner:
+                self.assertIs(outer, inner)
+                unit_of_work.save(self.instance)
+            self.assertFalse(self.instance.save.called)
+        self.instance.save.assert_called_once_with()
+
+    def test_units_per_instance(self):
+        other = mock.Mock(uuid='other')
+        with unit_of_work.unit_of_work(self.instance):
+            unit_of_work.save(other)
+            other.save.assert_called_once_with()
+
+    def test_flushed_on_error(self):
+        def _fail():
+            with unit_of_work.unit_of_work(self.instance):
+                unit_of_work.save(self.instance)
+                raise test.TestingException()
+
+        self.assertRaises(test.TestingException, _fail)
+        self.instance.save.assert_called_once_with()
+        unit_of_work.save(self.instance)
+        self.assertEqual(2, self.instance.save.call_count)
@@ -0,0 +1,345 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import datetime
+
+import mock
+from oslo_utils import timeutils
+
+from nova.compute import api as compute_api
+from nova.compute.light_snapshot import snapshot_task_states
+from nova.compute import vm_states
+from nova import context
+from nova import exception
+from nova import objects
+from nova import test
+from nova.tests.unit import fake_instance
+
+
+def fake_set_task_state(context, instance_uuids, task_state,
+                        expected_task_state=None):
+    return instance_uuids
+
+
+class LightSnapshotComputeAPITestCase(test.NoDBTestCase):
+    def setUp(self):
+        super(LightSnapshotComputeAPITestCase, self).setUp()
+        self.context = context.RequestContext('fake', 'fake')
+        self.compute_api = compute_api.API(skip_policy_check=True)
+        patcher = mock.patch.object(self.compute_api, 'compute_rpcapi')
+        self.rpcapi = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _create_instance(self, **updates):
+        values = {'host': 'host1', 'vm_state': vm_states.ACTIVE,
+                  'task_state': None, 'launched_at': timeutils.utcnow()}
+        values.update(updates)
+        return fake_instance.fake_instance_obj(self.context, **values)
+
+
+class LightSnapshotInstancesTestCase(LightSnapshotComputeAPITestCase):
+    def setUp(self):
+        super(LightSnapshotInstancesTestCase, self).setUp()
+        patcher = mock.patch.object(objects.InstanceList, 'set_task_state',
+                                    side_effect=fake_set_task_state)
+        self.mock_set_task_state = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_one_cast_per_host(self):
+        host1 = [self._create_instance(), self._create_instance()]
+        host2 = [self._create_instance(host='host2')]
+
+        errors = self.compute_api.light_snapshot_instances(
+            self.context, host1 + host2, options={'skip_empty': True})
+
+        self.assertEqual({}, errors)
+        self.mock_set_task_state.assert_called_once_with(
+            self.context, [instance.uuid for instance in host1 + host2],
+            snapshot_task_states.VM_SNAPSHOT_PENDING,
+            expected_task_state=None)
+        for instance in host1 + host2:
+            self.assertEqual(snapshot_task_states.VM_SNAPSHOT_PENDING,
+                             instance.task_state)
+        self.assertEqual(2, self.rpcapi.light_snapshot_instances.call_count)
+        self.rpcapi.light_snapshot_instances.assert_has_calls(
+            [mock.call(self.context, 'host1', host1,
+                       options={'skip_empty': True}),
+             mock.call(self.context, 'host2', host2,
+                       options={'skip_empty': True})], any_order=True)
+
+    def test_invalid_instances_rejected(self):
+        stopped = self._create_instance(vm_state=vm_states.STOPPED)
+        busy = self._create_instance(
+            task_state=snapshot_task_states.VM_COMMITING)
+        no_host = self._create_instance(host=None)
+        instance = self._create_instance()
+
+        errors = self.compute_api.light_snapshot_instances(
+            self.context, [stopped, busy, no_host, instance])
+
+        self.assertEqual(sorted([stopped.uuid, busy.uuid, no_host.uuid]),
+                         sorted(errors))
+        self.rpcapi.light_snapshot_instances.assert_called_once_with(
+            self.context, 'host1', [instance], options=None)
+
+    def test_task_state_changed_since_loaded(self):
+        instances = [self._create_instance(), self._create_instance()]
+        self.mock_set_task_state.side_effect = None
+        self.mock_set_task_state.return_value = [instances[0].uuid]
+
+        errors = self.compute_api.light_snapshot_instances(self.context,
+                                                           instances)
+
+        self.assertEqual([instances[1].uuid], list(errors))
+        self.assertIsNone(instances[1].task_state)
+        self.rpcapi.light_snapshot_instances.assert_called_once_with(
+            self.context, 'host1', [instances[0]], options=None)
+
+
+class LightSnapshotBulkTestCase(LightSnapshotComputeAPITestCase):
+    @mock.patch.object(objects.InstanceList, 'set_task_state',
+                       side_effect=fake_set_task_state)
+    def test_commit_snapshot(self, mock_set_task_state):
+        stopped = self._create_instance(vm_state=vm_states.STOPPED)
+        instance = self._create_instance(host='host2')
+
+        errors = self.compute_api.light_snapshot_bulk(
+            self.context, [stopped, instance], 'commit_snapshot')
+
+        self.assertEqual({}, errors)
+        mock_set_task_state.assert_called_once_with(
+            self.context, [stopped.uuid, instance.uuid],
+            snapshot_task_states.VM_COMMIT_START, expected_task_state=None)
+        self.rpcapi.light_snapshot_bulk.assert_has_calls(
+            [mock.call(self.context, 'host1', 'light_commit_snapshot',
+                       [stopped], kwargs=None),
+             mock.call(self.context, 'host2', 'light_commit_snapshot',
+                       [instance], kwargs=None)], any_order=True)
+        self.assertFalse(self.rpcapi.light_snapshot_instances.called)
+
+    @mock.patch.object(objects.InstanceList, 'set_task_state')
+    def test_operation_without_task_state(self, mock_set_task_state):
+        instance = self._create_instance()
+
+        self.compute_api.light_snapshot_bulk(self.context, [instance],
+                                             'enable')
+
+        self.assertFalse(mock_set_task_state.called)
+        self.assertIsNone(instance.task_state)
+        self.rpcapi.light_snapshot_bulk.assert_called_once_with(
+            self.context, 'host1', 'enable_light_snapshot', [instance],
+            kwargs=None)
+
+    @mock.patch.object(compute_api, 'check_policy')
+    @mock.patch.object(objects.InstanceList, 'set_task_state',
+                       side_effect=fake_set_task_state)
+    def test_forbidden(self, mock_set_task_state, mock_check_policy):
+        forbidden = self._create_instance()
+        instance = self._create_instance()
+        mock_check_policy.side_effect = [
+            exception.PolicyNotAuthorized(action='light_recover'), None]
+        self.compute_api.skip_policy_check = False
+
+        errors = self.compute_api.light_snapshot_bulk(
+            self.context, [forbidden, instance], 'recover',
+            kwargs={'use_root': True, 'snap_index': None})
+
+        self.assertEqual([forbidden.uuid], list(errors))
+        mock_check_policy.assert_called_with(self.context, 'light_recover',
+                                             instance)
+        self.rpcapi.light_snapshot_bulk.assert_called_once_with(
+            self.context, 'host1', 'light_recover_instance', [instance],
+            kwargs={'use_root': True, 'snap_index': None})
+
+
+class CoalesceLightSnapshotTestCase(LightSnapshotComputeAPITestCase):
+    def setUp(self):
+        super(CoalesceLightSnapshotTestCase, self).setUp()
+        self.flags(light_snapshot_coalesce_window=60)
+
+    def _pending(self, task_state=snapshot_task_states.VM_SNAPSHOT_PENDING,
+                 age=0, **updates):
+        return self._create_instance(
+            task_state=task_state,
+            updated_at=timeutils.utcnow() - datetime.timedelta(seconds=age),
+            **updates)
+
+    def test_attach_to_pending_snapshot(self):
+        instance = self._pending()
+        with mock.patch.object(instance, 'save') as mock_save:
+            self.compute_api.light_snapshot(self.context, instance)
+        self.assertFalse(mock_save.called)
+        self.assertFalse(self.rpcapi.light_snapshot_instance.called)
+
+    def test_attach_to_commit(self):
+        instance = self._pending(snapshot_task_states.VM_COMMITING)
+        with mock.patch.object(instance, 'save') as mock_save:
+            self.compute_api.commit_snapshot(self.context, instance)
+        self.assertFalse(mock_save.called)
+        self.assertFalse(self.rpcapi.light_commit_snapshot.called)
+
+    def test_window_disabled(self):
+        self.flags(light_snapshot_coalesce_window=0)
+        self.assertRaises(exception.InstanceInvalidState,
+                          self.compute_api.light_snapshot, self.context,
+                          self._pending())
+
+    def test_operation_older_than_window(self):
+        self.assertRaises(exception.InstanceInvalidState,
+                          self.compute_api.light_snapshot, self.context,
+                          self._pending(age=120))
+
+    def test_snapshot_taken_by_host(self):
+        self.assertRaises(exception.InstanceInvalidState,
+                          self.compute_api.light_snapshot, self.context,
+                          self._pending(snapshot_task_states.VM_SNAPSHOT))
+
+    def _lose_race(self, instance, task_state):
+        """Fail the save of instance as if a concurrent request had set
+        its task_state first.
+        """
+        def fake_refresh():
+            instance.task_state = task_state
+            instance.updated_at = timeutils.utcnow()
+
+        error = exception.UnexpectedTaskStateError(
+            instance_uuid=instance.uuid, expected=[None], actual=task_state)
+        return test.nested(
+            mock.patch.object(instance, 'save', side_effect=error),
+            mock.patch.object(instance, 'refresh', side_effect=fake_refresh))
+
+    def test_lost_race_to_same_operation(self):
+        instance = self._create_instance()
+        with self._lose_race(instance,
+                             snapshot_task_states.VM_SNAPSHOT_PENDING):
+            self.compute_api.light_snapshot(self.context, instance)
+        self.assertFalse(self.rpcapi.light_snapshot_instance.called)
+
+    def test_lost_race_to_other_operation(self):
+        instance = self._create_instance()
+        with self._lose_race(instance, snapshot_task_states.VM_COMMIT_START):
+            self.assertRaises(exception.UnexpectedTaskStateError,
+                              self.compute_api.light_snapshot, self.context,
+                              instance)
+        self.assertFalse(self.rpcapi.light_snapshot_instance.called)
+
+    @mock.patch.object(objects.InstanceList, 'get_by_filters')
+    @mock.patch.object(objects.InstanceList, 'set_task_state')
+    def test_bulk(self, mock_set_task_state, mock_get_by_filters):
+        pending = self._pending()
+        joined = self._create_instance()
+        conflict = self._create_instance()
+        instance = self._create_instance()
+        mock_set_task_state.return_value = [instance.uuid]
+        mock_get_by_filters.return_value = [
+            self._pending(uuid=joined.uuid),
+            self._pending(snapshot_task_states.VM_SNAPSHOT,
+                          uuid=conflict.uuid)]
+
+        errors = self.compute_api.light_snapshot_bulk(
+            self.context, [pending, joined, conflict, instance],
+            'create_snapshot')
+
+        self.assertEqual([conflict.uuid], list(errors))
+        mock_set_task_state.assert_called_once_with(
+            self.context, [joined.uuid, conflict.uuid, instance.uuid],
+            snapshot_task_states.VM_SNAPSHOT_PENDING,
+            expected_task_state=None)
+        mock_get_by_filters.assert_called_once_with(
+            self.context, {'uuid': [joined.uuid, conflict.uuid],
+                           'deleted': False}, expected_attrs=[])
+        self.rpcapi.light_snapshot_instances.assert_called_once_with(
+            self.context, 'host1', [instance], options=None)
+
+
+class LightSnapshotAdmissionTestCase(LightSnapshotComputeAPITestCase):
+    def setUp(self):
+        super(LightSnapshotAdmissionTestCase, self).setUp()
+        self.flags(light_snapshot_max_in_flight_per_host=2,
+                   light_snapshot_retry_after=10)
+        patcher = mock.patch.object(objects.InstanceList,
+                                    'count_by_hosts_and_task_states',
+                                    return_value={'host1': 1})
+        self.mock_count = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_no_limit(self):
+        self.flags(light_snapshot_max_in_flight_per_host=0)
+        instance = self._create_instance()
+        with mock.patch.object(instance, 'save'):
+            self.compute_api.light_snapshot(self.context, instance)
+        self.assertFalse(self.mock_count.called)
+        self.rpcapi.light_snapshot_instance.assert_called_once_with(
+            self.context, instance)
+
+    def test_under_limit(self):
+        instance = self._create_instance()
+        with mock.patch.object(instance, 'save'):
+            self.compute_api.commit_snapshot(self.context, instance)
+        self.mock_count.assert_called_once_with(
+            self.context, ['host1'],
+            compute_api.LIGHT_SNAPSHOT_IN_FLIGHT_TASK_STATES)
+        self.rpcapi.light_commit_snapshot.assert_called_once_with(
+            self.context, instance)
+
+    def test_host_busy(self):
+        self.mock_count.return_value = {'host1': 2}
+        instance = self._create_instance()
+        with mock.patch.object(instance, 'save') as mock_save:
+            ex = self.assertRaises(exception.LightSnapshotHostBusy,
+                                   self.compute_api.light_recover,
+                                   self.context, instance)
+        self.assertEqual(10, ex.kwargs['retry_after'])
+        self.assertFalse(mock_save.called)
+        self.assertIsNone(instance.task_state)
+        self.assertFalse(self.rpcapi.light_recover_instance.called)
+
+    def test_coalesced_request_not_limited(self):
+        self.flags(light_snapshot_coalesce_window=60)
+        self.mock_count.return_value = {'host1': 2}
+        instance = self._create_instance(
+            task_state=snapshot_task_states.VM_SNAPSHOT_PENDING,
+            updated_at=timeutils.utcnow())
+        self.compute_api.light_snapshot(self.context, instance)
+        self.assertFalse(self.mock_count.called)
+
+    @mock.patch.object(objects.InstanceList, 'set_task_state',
+                       side_effect=fake_set_task_state)
+    def test_bulk(self, mock_set_task_state):
+        host1 = [self._create_instance() for i in range(3)]
+        host2 = [self._create_instance(host='host2')]
+
+        errors = self.compute_api.light_snapshot_bulk(
+            self.context, host1 + host2, 'commit_snapshot')
+
+        self.assertEqual(sorted(instance.uuid for instance in host1[1:]),
+                         sorted(errors))
+        self.assertEqual(1, self.mock_count.call_count)
+        self.assertEqual(['host1', 'host2'],
+                         sorted(self.mock_count.call_args[0][1]))
+        mock_set_task_state.assert_called_once_with(
+            self.context, [host1[0].uuid, host2[0].uuid],
+            snapshot_task_states.VM_COMMIT_START, expected_task_state=None)
+
+    @mock.patch.object(objects.InstanceList, 'set_task_state')
+    def test_bulk_operation_without_task_state(self, mock_set_task_state):
+        self.mock_count.return_value = {'host1': 2}
+        instance = self._create_instance()
+
+        errors = self.compute_api.light_snapshot_bulk(
+            self.context, [instance], 'enable')
+
+        self.assertEqual({}, errors)
+        self.assertFalse(self.mock_count.called)
+        self.rpcapi.light_snapshot_bulk.assert_called_once_with(
+            self.context, 'host1', 'enable_light_snapshot', [instance],
+            kwargs=None)
@@ -0,0 +1,694 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import datetime
+
+import mock
+from oslo_config import cfg
+from oslo_utils import importutils
+from oslo_utils import timeutils
+from oslo_utils import units
+
+from nova.compute.light_snapshot import snapshot_task_states
+from nova.compute import manager
+from nova.compute import power_state
+from nova.compute import utils as compute_utils
+from nova.compute import vm_states
+from nova import context
+from nova import exception
+from nova import objects
+from nova import test
+from nova.tests.unit import fake_instance
+
+CONF = cfg.CONF
+CONF.import_opt('compute_manager', 'nova.service')
+
+
+class LightSnapshotManagerTestCase(test.NoDBTestCase):
+    def setUp(self):
+        super(LightSnapshotManagerTestCase, self).setUp()
+        self.flags(use_local=True, group='conductor')
+        self.flags(light_snapshot_enabled=True)
+        self.compute = importutils.import_object(CONF.compute_manager)
+        self.context = context.RequestContext('fake', 'fake')
+
+    def _create_instance(self, **light_snapshot):
+        instance = fake_instance.fake_instance_obj(
+            self.context, expected_attrs=['system_metadata'])
+        instance.light_snapshot = objects.InstanceLightSnapshot._new(
+            self.context, instance.uuid)
+        for field, value in light_snapshot.items():
+            setattr(instance.light_snapshot, field, value)
+        instance.light_snapshot.obj_reset_changes()
+        return instance
+
+
+class PrestageLightSnapshotTestCase(LightSnapshotManagerTestCase):
+    def setUp(self):
+        super(PrestageLightSnapshotTestCase, self).setUp()
+        self.instance = self._create_instance(light_snapshot_enable=True)
+        self.sysmeta = self.instance.system_metadata
+        for patcher in (mock.patch.object(self.compute, 'driver'),
+                        mock.patch.object(self.instance, 'save')):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_prestage(self):
+        self.compute.prestage_light_snapshot(self.context, self.instance,
+                                             'dest')
+
+        self.assertEqual('dest',
+                         self.sysmeta[manager.LIGHT_SNAPSHOT_PRESTAGE_HOST])
+        self.instance.save.assert_called_once_with()
+        driver = self.compute.driver
+        driver.stage_light_snapshot_chain.assert_called_once_with(
+            self.context, self.instance, 'dest')
+        self.assertFalse(driver.unstage_light_snapshot_chain.called)
+
+    def test_prestage_other_host_unstages(self):
+        self.sysmeta[manager.LIGHT_SNAPSHOT_PRESTAGE_HOST] = 'old'
+
+        self.compute.prestage_light_snapshot(self.context, self.instance,
+                                             'dest')
+
+        self.assertEqual('dest',
+                         self.sysmeta[manager.LIGHT_SNAPSHOT_PRESTAGE_HOST])
+        self.compute.driver.unstage_light_snapshot_chain.\
+            assert_called_once_with(self.instance, 'old')
+
+    def test_prestage_same_host_keeps_layers(self):
+        self.sysmeta[manager.LIGHT_SNAPSHOT_PRESTAGE_HOST] = 'dest'
+
+        self.compute.prestage_light_snapshot(self.context, self.instance,
+                                             'dest')
+
+        driver = self.compute.driver
+        self.assertFalse(driver.unstage_light_snapshot_chain.called)
+        self.assertTrue(driver.stage_light_snapshot_chain.called)
+
+    def test_cancel_prestage(self):
+        self.sysmeta[manager.LIGHT_SNAPSHOT_PRESTAGE_HOST] = 'old'
+
+        self.compute.prestage_light_snapshot(self.context, self.instance,
+                                             None)
+
+        self.assertNotIn(manager.LIGHT_SNAPSHOT_PRESTAGE_HOST, self.sysmeta)
+        self.instance.save.assert_called_once_with()
+        self.compute.driver.unstage_light_snapshot_chain.\
+            assert_called_once_with(self.instance, 'old')
+        self.assertFalse(self.compute.driver.stage_light_snapshot_chain.called)
+
+    def test_cancel_without_prestage(self):
+        self.compute.prestage_light_snapshot(self.context, self.instance,
+                                             None)
+
+        self.assertFalse(self.instance.save.called)
+
+    def test_drop_prestage_unstage_fails(self):
+        self.sysmeta[manager.LIGHT_SNAPSHOT_PRESTAGE_HOST] = 'old'
+        self.compute.driver.unstage_light_snapshot_chain.side_effect = (
+            test.TestingException)
+
+        self.assertTrue(
+            self.compute._drop_light_snapshot_prestage(self.instance))
+        self.assertNotIn(manager.LIGHT_SNAPSHOT_PRESTAGE_HOST, self.sysmeta)
+
+
+class LightSnapshotAllInstanceTestCase(LightSnapshotManagerTestCase):
+    def setUp(self):
+        super(LightSnapshotAllInstanceTestCase, self).setUp()
+        self.instance = self._create_instance(light_snapshot_enable=True)
+        for patcher in (mock.patch.object(self.compute, 'driver'),
+                        mock.patch.object(self.compute,
+                                          'light_snapshot_instance'),
+                        mock.patch.object(self.instance, 'save')):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_skip_empty_overlay(self):
+        self.compute.driver.light_snapshot_is_empty.return_value = True
+
+        self.compute._light_snapshot_all_instance(self.context,
+                                                  self.instance)
+
+        self.assertFalse(self.instance.save.called)
+        self.assertFalse(self.compute.light_snapshot_instance.called)
+
+    def test_snapshot_written_overlay(self):
+        self.compute.driver.light_snapshot_is_empty.return_value = False
+
+        self.compute._light_snapshot_all_instance(self.context,
+                                                  self.instance)
+
+        self.assertEqual(snapshot_task_states.VM_SNAPSHOT_PENDING,
+                         self.instance.task_state)
+        self.instance.save.assert_called_once_with(expected_task_state=[None])
+        self.compute.light_snapshot_instance.assert_called_once_with(
+            self.context, self.instance)
+
+    def test_skip_empty_disabled(self):
+        self.flags(light_snapshot_skip_empty=False)
+
+        self.compute._light_snapshot_all_instance(self.context,
+                                                  self.instance)
+
+        self.assertFalse(self.compute.driver.light_snapshot_is_empty.called)
+        self.assertTrue(self.compute.light_snapshot_instance.called)
+
+
+class AdaptiveLightSnapshotTestCase(LightSnapshotManagerTestCase):
+    def setUp(self):
+        super(AdaptiveLightSnapshotTestCase, self).setUp()
+        self.flags(light_snapshot_overlay_max_mb=64, light_snapshot_rpo=3600)
+        self.instance = self._create_instance(
+            light_snapshot_enable=True, snapshot_index=3,
+            snapshot_at=timeutils.utcnow())
+        self.instance.vm_state = vm_states.ACTIVE
+        self.instance.task_state = None
+        self.stats = {'wr_bytes': 4096, 'allocation': units.Mi}
+        for patcher in (
+                mock.patch.object(self.compute, 'driver'),
+                mock.patch.object(self.compute,
+                                  '_light_snapshot_adaptive_pool'),
+                mock.patch.object(objects.InstanceList, 'get_by_host',
+                                  return_value=[self.instance]),
+                mock.patch.object(self.instance, 'save')):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.compute.driver.get_light_snapshot_write_stats.return_value = (
+            self.stats)
+        self.pool = self.compute._light_snapshot_adaptive_pool
+        self.pool.free.return_value = 1
+
+    def _assert_snapshot_spawned(self):
+        self.assertEqual(snapshot_task_states.VM_SNAPSHOT_PENDING,
+                         self.instance.task_state)
+        self.instance.save.assert_called_once_with(expected_task_state=[None])
+        self.pool.spawn_n.assert_called_once_with(
+            self.compute._adaptive_light_snapshot_instance, self.context,
+            self.instance, self.stats['wr_bytes'])
+
+    def _assert_snapshot_not_spawned(self):
+        self.assertIsNone(self.instance.task_state)
+        self.assertFalse(self.instance.save.called)
+        self.assertFalse(self.pool.spawn_n.called)
+
+    def _run(self):
+        with mock.patch.object(self.context, 'elevated',
+                               return_value=self.context):
+            self.compute._adaptive_light_snapshot(self.context)
+
+    def test_written_and_rpo_due(self):
+        self.instance.light_snapshot.snapshot_at = (
+            timeutils.utcnow() - datetime.timedelta(hours=2))
+        self.compute._light_snapshot_write_marks[self.instance.uuid] = (3, 0)
+
+        self._run()
+
+        self._assert_snapshot_spawned()
+
+    def test_written_rpo_not_due(self):
+        self.compute._light_snapshot_write_marks[self.instance.uuid] = (3, 0)
+
+        self._run()
+
+        self._assert_snapshot_not_spawned()
+        self.assertEqual(
+            (3, 0),
+            self.compute._light_snapshot_write_marks[self.instance.uuid])
+
+    def test_not_written_rpo_due(self):
+        self.instance.light_snapshot.snapshot_at = (
+            timeutils.utcnow() - datetime.timedelta(hours=2))
+        self.compute._light_snapshot_write_marks[self.instance.uuid] = (
+            3, self.stats['wr_bytes'])
+
+        self._run()
+
+        self._assert_snapshot_not_spawned()
+
+    def test_no_mark_counts_as_written(self):
+        self.instance.light_snapshot.snapshot_at = None
+
+        self._run()
+
+        self._assert_snapshot_spawned()
+        self.assertEqual(
+            (3, self.stats['wr_bytes']),
+            self.compute._light_snapshot_write_marks[self.instance.uuid])
+
+    def test_mark_of_other_snapshot_reset(self):
+        self.instance.light_snapshot.snapshot_at = None
+        self.compute._light_snapshot_write_marks[self.instance.uuid] = (2, 0)
+
+        self._run()
+
+        self._assert_snapshot_not_spawned()
+        self.assertEqual(
+            (3, self.stats['wr_bytes']),
+            self.compute._light_snapshot_write_marks[self.instance.uuid])
+
+    def test_overlay_full(self):
+        self.stats['allocation'] = 64 * units.Mi
+        self.compute._light_snapshot_write_marks[self.instance.uuid] = (
+            3, self.stats['wr_bytes'])
+
+        self._run()
+
+        self._assert_snapshot_spawned()
+
+    def test_pool_full(self):
+        self.stats['allocation'] = 64 * units.Mi
+        self.pool.free.return_value = 0
+
+        self._run()
+
+        self._assert_snapshot_not_spawned()
+
+    def test_instance_busy(self):
+        self.stats['allocation'] = 64 * units.Mi
+        self.instance.task_state = snapshot_task_states.VM_COMMITING
+
+        self._run()
+
+        self.assertFalse(
+            self.compute.driver.get_light_snapshot_write_stats.called)
+        self.assertFalse(self.pool.spawn_n.called)
+
+    def test_stale_marks_pruned(self):
+        self.compute._light_snapshot_write_marks['gone'] = (1, 0)
+        self.compute.driver.get_light_snapshot_write_stats.side_effect = (
+            exception.InstanceNotRunning(instance_id=self.instance.uuid))
+
+        self._run()
+
+        self.assertEqual({}, self.compute._light_snapshot_write_marks)
+
+    def test_snapshot_instance_updates_mark(self):
+        self.instance.light_snapshot.snapshot_index = 4
+        with mock.patch.object(self.compute, 'light_snapshot_instance'):
+            self.compute._adaptive_light_snapshot_instance(
+                self.context, self.instance, 8192)
+        self.assertEqual(
+            (4, 8192),
+            self.compute._light_snapshot_write_marks[self.instance.uuid])
+
+    def test_snapshot_instance_fails(self):
+        with mock.patch.object(self.compute, 'light_snapshot_instance',
+                               side_effect=test.TestingException):
+            self.compute._adaptive_light_snapshot_instance(
+                self.context, self.instance, 8192)
+        self.assertNotIn(self.instance.uuid,
+                         self.compute._light_snapshot_write_marks)
+
+
+class LightCommitStoppedTestCase(LightSnapshotManagerTestCase):
+    def setUp(self):
+        super(LightCommitStoppedTestCase, self).setUp()
+        self.stopped = self._create_instance(light_snapshot_enable=True)
+        self.stopped.vm_state = vm_states.STOPPED
+        self.stopped.task_state = None
+        self.committed = self._create_instance(light_snapshot_enable=True,
+                                               snapshot_committed=True)
+        self.committed.vm_state = vm_states.STOPPED
+        self.active = self._create_instance(light_snapshot_enable=True)
+        self.active.vm_state = vm_states.ACTIVE
+        self.instances = [self.stopped, self.committed, self.active]
+        for instance in self.instances:
+            patcher = mock.patch.object(instance, 'save')
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def _run(self):
+        with test.nested(
+                mock.patch.object(self.context, 'elevated',
+                                  return_value=self.context),
+                mock.patch.object(self.compute, '_get_instances_on_driver',
+                                  return_value=self.instances)):
+            self.compute.light_commit_stopped(self.context)
+
+    @mock.patch.object(manager.ComputeManager,
+                       '_light_commit_stopped_instance')
+    def test_commit_stopped_instances(self, mock_commit):
+        self._run()
+
+        self.assertEqual(snapshot_task_states.VM_COMMITING,
+                         self.stopped.task_state)
+        self.stopped.save.assert_called_once_with(expected_task_state=[None])
+        self.assertFalse(self.committed.save.called)
+        self.assertFalse(self.active.save.called)
+        mock_commit.assert_called_once_with(self.context, self.stopped)
+
+    @mock.patch.object(manager.ComputeManager,
+                       '_light_commit_stopped_instance')
+    def test_commit_stopped_instance_busy(self, mock_commit):
+        self.stopped.save.side_effect = exception.UnexpectedTaskStateError(
+            instance_uuid=self.stopped.uuid, expected=[None],
+            actual='deleting')
+
+        self._run()
+
+        self.assertFalse(mock_commit.called)
+
+    @mock.patch.object(compute_utils, 'add_instance_fault_from_exc')
+    @mock.patch.object(manager.ComputeManager, '_light_commit_snapshot',
+                       side_effect=test.TestingException)
+    def test_commit_stopped_instance_fails(self, mock_commit, mock_fault):
+        self.stopped.task_state = snapshot_task_states.VM_COMMITING
+
+        self.compute._light_commit_stopped_instance(self.context,
+                                                    self.stopped)
+
+        mock_commit.assert_called_once_with(
+            self.context, self.stopped, snapshot_task_states.VM_COMMITING)
+        self.assertIsNone(self.stopped.task_state)
+        self.stopped.save.assert_called_once_with()
+        self.assertTrue(mock_fault.called)
+
+
+class ResumeLightSnapshotCommitTestCase(LightSnapshotManagerTestCase):
+    def setUp(self):
+        super(ResumeLightSnapshotCommitTestCase, self).setUp()
+        self.instance = self._create_instance(light_snapshot_enable=True)
+        self.instance.task_state = snapshot_task_states.VM_COMMITING
+        for patcher in (mock.patch.object(self.compute, 'driver'),
+                        mock.patch.object(self.compute,
+                                          '_notify_about_instance_usage'),
+                        mock.patch.object(self.instance, 'save')):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def _run(self):
+        with mock.patch.object(self.context, 'elevated',
+                               return_value=self.context):
+            self.compute._resume_light_snapshot_commit(self.context,
+                                                       self.instance)
+
+    def test_resume_commit(self):
+        self.compute.driver.resume_light_snapshot_commit.return_value = True
+
+        self._run()
+
+        self.compute.driver.resume_light_snapshot_commit.\
+            assert_called_once_with(self.context, self.instance)
+        self.compute._notify_about_instance_usage.assert_called_once_with(
+            self.context, self.instance, 'commit_snapshot.end')
+        self.assertIsNone(self.instance.task_state)
+        self.instance.save.assert_called_once_with()
+
+    def test_resume_nothing_left(self):
+        self.compute.driver.resume_light_snapshot_commit.return_value = False
+
+        self._run()
+
+        self.assertFalse(self.compute._notify_about_instance_usage.called)
+        self.assertIsNone(self.instance.task_state)
+        self.instance.save.assert_called_once_with()
+
+    @mock.patch.object(compute_utils, 'add_instance_fault_from_exc')
+    def test_resume_fails(self, mock_fault):
+        self.compute.driver.resume_light_snapshot_commit.side_effect = (
+            test.TestingException)
+
+        self._run()
+
+        self.assertTrue(mock_fault.called)
+        self.assertIsNone(self.instance.task_state)
+        self.instance.save.assert_called_once_with()
+
+    def test_resume_instance_gone(self):
+        self.compute.driver.resume_light_snapshot_commit.side_effect = (
+            exception.InstanceNotFound(instance_id=self.instance.uuid))
+
+        self._run()
+
+        self.assertFalse(self.instance.save.called)
+
+
+class ReconcileLightSnapshotChainsTestCase(LightSnapshotManagerTestCase):
+    def setUp(self):
+        super(ReconcileLightSnapshotChainsTestCase, self).setUp()
+        self.instance = self._create_instance(light_snapshot_enable=True,
+                                              snapshot_index=2)
+        self.instance.host = self.compute.host
+        self.instance.vm_state = vm_states.ACTIVE
+        self.instance.task_state = None
+        for patcher in (mock.patch.object(self.compute, 'driver'),
+                        mock.patch.object(self.compute, '_get_power_state',
+                                          return_value=power_state.RUNNING),
+                        mock.patch.object(self.instance, 'save')):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.compute.driver.check_light_snapshot_chain.return_value = {}
+
+    def test_check_chain_matches(self):
+        queue = []
+        self.compute._check_light_snapshot_chain(self.context,
+                                                 self.instance, queue)
+
+        self.assertFalse(self.instance.save.called)
+        self.assertEqual([], queue)
+
+    def test_check_chain_updates_instance(self):
+        self.compute.driver.check_light_snapshot_chain.return_value = {
+            'snapshot_index': 3}
+        queue = []
+
+        self.compute._check_light_snapshot_chain(self.context,
+                                                 self.instance, queue)
+
+        self.assertEqual(3, self.instance.snapshot_index)
+        self.instance.save.assert_called_once_with()
+        self.assertEqual([], queue)
+
+    def test_check_chain_queues_committed(self):
+        self.compute.driver.check_light_snapshot_chain.return_value = {
+            'snapshot_committed': True}
+        queue = []
+
+        self.compute._check_light_snapshot_chain(self.context,
+                                                 self.instance, queue)
+
+        self.assertEqual([self.instance], queue)
+
+    def test_check_chain_fails(self):
+        self.compute.driver.check_light_snapshot_chain.side_effect = (
+            test.TestingException)
+        queue = []
+
+        self.compute._check_light_snapshot_chain(self.context,
+                                                 self.instance, queue)
+
+        self.assertFalse(self.instance.save.called)
+        self.assertEqual([], queue)
+
+    @mock.patch('nova.utils.spawn_n')
+    def test_reconcile(self, mock_spawn):
+        self.instance.light_snapshot.snapshot_committed = True
+        busy = self._create_instance(light_snapshot_enable=True)
+        busy.host = self.compute.host
+        busy.task_state = snapshot_task_states.VM_COMMITING
+        other_host = self._create_instance(light_snapshot_enable=True)
+        other_host.host = 'other'
+
+        self.compute._reconcile_light_snapshot_chains(
+            self.context, [self.instance, busy, other_host])
+
+        self.compute.driver.check_light_snapshot_chain.\
+            assert_called_once_with(self.instance)
+        mock_spawn.assert_called_once_with(
+            self.compute._init_light_snapshot_chains, self.context,
+            [self.instance], CONF.light_snapshot_init_workers)
+
+    def test_init_chain(self):
+        self.instance.light_snapshot.snapshot_committed = True
+
+        self.compute._init_light_snapshot_chain(self.context, self.instance)
+
+        self.compute.driver.light_snapshot_init.assert_called_once_with(
+            self.context, self.instance)
+        self.assertFalse(self.instance.snapshot_committed)
+        self.assertIsNone(self.instance.task_state)
+        self.assertFalse(self.compute.driver.store_snapshot_init.called)
+
+    @mock.patch.object(manager.ComputeManager,
+                       '_update_scheduler_instance_info')
+    @mock.patch.object(manager.ComputeManager,
+                       '_reconcile_light_snapshot_chains')
+    @mock.patch.object(manager.ComputeManager, '_init_instance')
+    @mock.patch.object(manager.ComputeManager, '_destroy_evacuated_instances')
+    @mock.patch.object(manager.ComputeManager, 'init_virt_events')
+    @mock.patch('nova.compute.light_snapshot.native.start_stall_detector')
+    @mock.patch.object(objects.InstanceList, 'get_by_host')
+    def test_init_host_defers_chain_init(self, mock_get_by_host,
+                                         mock_stall_detector,
+                                         mock_virt_events, mock_evacuated,
+                                         mock_init_instance, mock_reconcile,
+                                         mock_update_scheduler):
+        mock_get_by_host.return_value = [self.instance]
+        calls = []
+        defer = self.compute.driver.deferred_light_snapshot_init.return_value
+        defer.__enter__.side_effect = lambda: calls.append('defer')
+        defer.__exit__.side_effect = (
+            lambda *args: calls.append('resume'))
+        mock_init_instance.side_effect = (
+            lambda *args: calls.append('init_instance'))
+        mock_reconcile.side_effect = lambda *args: calls.append('reconcile')
+
+        self.compute.init_host()
+
+        self.assertEqual(['defer', 'init_instance', 'resume', 'reconcile'],
+                         calls)
+
+
+class LightSnapshotAllTestCase(LightSnapshotManagerTestCase):
+    @mock.patch.object(manager.ComputeManager, '_light_snapshot_all_instance')
+    @mock.patch.object(objects.InstanceList, 'get_light_snapshot_candidates')
+    def test_snapshot_running_instances(self, mock_candidates,
+                                        mock_snapshot):
+        running = self._create_instance(light_snapshot_enable=True)
+        stopped = self._create_instance(light_snapshot_enable=True)
+        mock_candidates.return_value = [running, stopped]
+
+        with test.nested(
+                mock.patch.object(self.compute, 'driver'),
+                mock.patch.object(self.context, 'elevated',
+                                  return_value=self.context)):
+            self.compute.driver.list_running_instance_uuids.return_value = [
+                running.uuid]
+            self.compute.light_snapshot_all(self.context, daily=True)
+
+        mock_candidates.assert_called_once_with(
+            self.context, self.compute.host, daily=True,
+            expected_attrs=['light_snapshot'], use_slave=True)
+        mock_snapshot.assert_called_once_with(self.context, running)
+
+
+class LightSnapshotInstancesTestCase(LightSnapshotManagerTestCase):
+    def setUp(self):
+        super(LightSnapshotInstancesTestCase, self).setUp()
+        self.instances = [self._create_instance(light_snapshot_enable=True)
+                          for i in range(2)]
+        for patcher in (mock.patch.object(self.compute, 'driver'),
+                        mock.patch.object(self.compute,
+                                          'light_snapshot_instance')):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_snapshot_instances(self):
+        self.compute.light_snapshot_instances(self.context, self.instances)
+
+        self.assertFalse(self.compute.driver.light_snapshot_is_empty.called)
+        self.assertEqual(
+            [mock.call(self.context, instance)
+             for instance in self.instances],
+            self.compute.light_snapshot_instance.call_args_list)
+
+    def test_skip_empty_overlay(self):
+        self.compute.driver.light_snapshot_is_empty.side_effect = [True,
+                                                                   False]
+        skipped, snapshotted = self.instances
+        skipped.task_state = snapshot_task_states.VM_SNAPSHOT_PENDING
+
+        with mock.patch.object(skipped, 'save') as mock_save:
+            self.compute.light_snapshot_instances(
+                self.context, self.instances, options={'skip_empty': True})
+
+        self.assertIsNone(skipped.task_state)
+        mock_save.assert_called_once_with(
+            expected_task_state=snapshot_task_states.VM_SNAPSHOT_PENDING)
+        self.compute.light_snapshot_instance.assert_called_once_with(
+            self.context, snapshotted)
+
+    def test_skip_empty_check_fails(self):
+        self.compute.driver.light_snapshot_is_empty.side_effect = [
+            exception.InstanceNotRunning(instance_id='fake'), False]
+        failed, snapshotted = self.instances
+        failed.task_state = snapshot_task_states.VM_SNAPSHOT_PENDING
+
+        with mock.patch.object(failed, 'save') as mock_save:
+            self.compute.light_snapshot_instances(
+                self.context, self.instances, options={'skip_empty': True})
+
+        self.assertIsNone(failed.task_state)
+        mock_save.assert_called_once_with(
+            expected_task_state=snapshot_task_states.VM_SNAPSHOT_PENDING)
+        self.compute.light_snapshot_instance.assert_called_once_with(
+            self.context, snapshotted)
+
+    def test_skip_empty_task_state_changed(self):
+        self.compute.driver.light_snapshot_is_empty.return_value = True
+        skipped = self.instances[0]
+
+        with mock.patch.object(
+                skipped, 'save',
+                side_effect=exception.UnexpectedTaskStateError(
+                    instance_uuid=skipped.uuid, expected='pending',
+                    actual=None)) as mock_save:
+            self.compute.light_snapshot_instances(
+                self.context, [skipped], options={'skip_empty': True})
+
+        self.assertTrue(mock_save.called)
+        self.assertFalse(self.compute.light_snapshot_instance.called)
+
+    def test_failure_does_not_stop_batch(self):
+        self.compute.light_snapshot_instance.side_effect = [
+            test.TestingException, None]
+
+        self.compute.light_snapshot_instances(self.context, self.instances)
+
+        self.assertEqual(2, self.compute.light_snapshot_instance.call_count)
+
+    @mock.patch('eventlet.GreenPool')
+    def test_workers(self, mock_pool):
+        self.flags(light_snapshot_all_workers=0)
+
+        self.compute.light_snapshot_instances(self.context, self.instances)
+
+        mock_pool.assert_called_once_with(1)
+        self.assertEqual(2, mock_pool.return_value.spawn_n.call_count)
+        mock_pool.return_value.waitall.assert_called_once_with()
+
+
+class LightSnapshotBulkTestCase(LightSnapshotManagerTestCase):
+    def setUp(self):
+        super(LightSnapshotBulkTestCase, self).setUp()
+        self.instances = [self._create_instance(light_snapshot_enable=True)
+                          for i in range(2)]
+
+    def test_unknown_method(self):
+        self.assertRaises(exception.NovaException,
+                          self.compute.light_snapshot_bulk, self.context,
+                          'terminate_instance', self.instances)
+
+    @mock.patch.object(manager.ComputeManager, 'light_recover_instance')
+    def test_run_method(self, mock_recover):
+        self.compute.light_snapshot_bulk(
+            self.context, 'light_recover_instance', self.instances,
+            kwargs={'use_root': True})
+
+        self.assertEqual(
+            [mock.call(self.context, instance, use_root=True)
+             for instance in self.instances],
+            mock_recover.call_args_list)
+
+    @mock.patch.object(manager.ComputeManager, 'light_commit_snapshot',
+                       side_effect=[test.TestingException, None])
+    def test_failure_does_not_stop_batch(self, mock_commit):
+        mock_commit.__name__ = 'light_commit_snapshot'
+        self.compute.light_snapshot_bulk(
+            self.context, 'light_commit_snapshot', self.instances)
+
+        self.assertEqual(
+            [mock.call(self.context, instance)
+             for instance in self.instances],
+            mock_commit.call_args_list)
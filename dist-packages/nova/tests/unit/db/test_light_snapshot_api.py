@@ -0,0 +1,420 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import datetime
+
+from oslo_utils import timeutils
+
+from nova.compute import vm_states
+from nova import context
+from nova import db
+from nova.db.sqlalchemy import api as sqlalchemy_api
+from nova.db.sqlalchemy import light_snapshot_api
+from nova.db.sqlalchemy import models
+from nova import exception
+from nova import test
+
+
+class LightSnapshotDBApiTestCase(test.TestCase):
+    def setUp(self):
+        super(LightSnapshotDBApiTestCase, self).setUp()
+        # NOTE: The light-snapshot tables are created by hand, see the
+        # README, they are not part of the migrations.
+        engine = sqlalchemy_api.get_engine()
+        for model in (models.InstanceLightSnapshot, models.LightSnapshot):
+            model.__table__.create(engine, checkfirst=True)
+        self.ctxt = context.get_admin_context()
+
+    def _create_instance(self, light_snapshot=None, **values):
+        instance_values = {'host': 'host1', 'vm_state': vm_states.ACTIVE,
+                           'project_id': 'project1'}
+        instance_values.update(values)
+        instance = db.instance_create(self.ctxt, instance_values)
+        if light_snapshot is not None:
+            light_snapshot_api.instance_light_snapshot_update(
+                self.ctxt, instance['uuid'], light_snapshot)
+        return instance
+
+    def _uuids(self, instances):
+        return sorted(instance['uuid'] for instance in instances)
+
+
+class LightSnapshotCandidatesTestCase(LightSnapshotDBApiTestCase):
+    def setUp(self):
+        super(LightSnapshotCandidatesTestCase, self).setUp()
+        self.daily = self._create_instance(
+            {'light_snapshot_enable': True, 'snapshot_daily': True})
+        self.enabled = self._create_instance(
+            {'light_snapshot_enable': True, 'snapshot_committed': None})
+
+        # None of these can be light snapshotted.
+        self._create_instance({'light_snapshot_enable': False})
+        self._create_instance()
+        self._create_instance({'light_snapshot_enable': True,
+                               'snapshot_committed': True})
+        self._create_instance({'light_snapshot_enable': True},
+                              vm_state=vm_states.STOPPED)
+        self._create_instance({'light_snapshot_enable': True},
+                              task_state='light_snapshot')
+        self._create_instance({'light_snapshot_enable': True}, host='host2')
+
+    def _get_candidates(self, **kwargs):
+        return light_snapshot_api.instance_get_light_snapshot_candidates(
+            self.ctxt, 'host1', **kwargs)
+
+    def test_candidates(self):
+        self.assertEqual(self._uuids([self.daily, self.enabled]),
+                         self._uuids(self._get_candidates()))
+
+    def test_candidates_daily(self):
+        self.assertEqual([self.daily['uuid']],
+                         self._uuids(self._get_candidates(daily=True)))
+
+    def test_candidates_deleted_state(self):
+        light_snapshot_api.instance_light_snapshot_destroy(
+            self.ctxt, self.enabled['uuid'])
+        self.assertEqual([self.daily['uuid']],
+                         self._uuids(self._get_candidates()))
+
+    def test_candidates_metadata_joined(self):
+        candidates = self._get_candidates(daily=True,
+                                          columns_to_join=['metadata'])
+        self.assertEqual([], candidates[0]['metadata'])
+
+
+class SnapshotIndexTestCase(LightSnapshotDBApiTestCase):
+    def setUp(self):
+        super(SnapshotIndexTestCase, self).setUp()
+        self.instance = self._create_instance(
+            {'light_snapshot_enable': True, 'snapshot_index': 3})
+
+    def _get_index(self, instance_uuid=None):
+        state = light_snapshot_api.instance_light_snapshot_get(
+            self.ctxt, instance_uuid or self.instance['uuid'])
+        return state['snapshot_index']
+
+    def test_allocate(self):
+        self.assertEqual(
+            (4, 4), light_snapshot_api.instance_allocate_snapshot_indexes(
+                self.ctxt, self.instance['uuid']))
+        self.assertEqual(
+            (5, 7), light_snapshot_api.instance_allocate_snapshot_indexes(
+                self.ctxt, self.instance['uuid'], count=3))
+        self.assertEqual(7, self._get_index())
+
+    def test_allocate_first_index(self):
+        instance = self._create_instance({'light_snapshot_enable': True})
+        self.assertEqual(
+            (0, 0), light_snapshot_api.instance_allocate_snapshot_indexes(
+                self.ctxt, instance['uuid']))
+        self.assertEqual(0, self._get_index(instance['uuid']))
+
+    def test_allocate_without_state(self):
+        instance = self._create_instance()
+        self.assertEqual(
+            (0, 1), light_snapshot_api.instance_allocate_snapshot_indexes(
+                self.ctxt, instance['uuid'], count=2))
+        self.assertEqual(1, self._get_index(instance['uuid']))
+
+    def test_release(self):
+        light_snapshot_api.instance_allocate_snapshot_indexes(
+            self.ctxt, self.instance['uuid'])
+
+        self.assertTrue(light_snapshot_api.instance_release_snapshot_index(
+            self.ctxt, self.instance['uuid'], 4, 3))
+        self.assertEqual(3, self._get_index())
+
+    def test_release_after_another_allocation(self):
+        light_snapshot_api.instance_allocate_snapshot_indexes(
+            self.ctxt, self.instance['uuid'])
+        light_snapshot_api.instance_allocate_snapshot_indexes(
+            self.ctxt, self.instance['uuid'])
+
+        self.assertFalse(light_snapshot_api.instance_release_snapshot_index(
+            self.ctxt, self.instance['uuid'], 4, 3))
+        self.assertEqual(5, self._get_index())
+
+
+class LightSnapshotStateTestCase(LightSnapshotDBApiTestCase):
+    def setUp(self):
+        super(LightSnapshotStateTestCase, self).setUp()
+        self.instance = self._create_instance(task_state='light_snapshot')
+
+    def _get_state(self):
+        return light_snapshot_api.instance_light_snapshot_get(
+            self.ctxt, self.instance['uuid'])
+
+    def _create_snapshot(self, snapshot_index):
+        return light_snapshot_api.light_snapshot_create(
+            self.ctxt, {'instance_uuid': self.instance['uuid'],
+                        'snapshot_index': snapshot_index,
+                        'status': 'active'})
+
+    def test_update_creates_state(self):
+        self.assertIsNone(self._get_state())
+        light_snapshot_api.instance_light_snapshot_update(
+            self.ctxt, self.instance['uuid'], {'snapshot_index': 2})
+        light_snapshot_api.instance_light_snapshot_update(
+            self.ctxt, self.instance['uuid'], {'root_index': 1})
+
+        state = self._get_state()
+        self.assertEqual(2, state['snapshot_index'])
+        self.assertEqual(1, state['root_index'])
+
+    def test_update_expected_task_state(self):
+        light_snapshot_api.instance_light_snapshot_update(
+            self.ctxt, self.instance['uuid'], {'snapshot_index': 2},
+            expected_task_state=['light_snapshot'],
+            expected_vm_state=vm_states.ACTIVE)
+        self.assertEqual(2, self._get_state()['snapshot_index'])
+
+    def test_update_unexpected_task_state(self):
+        self.assertRaises(exception.UnexpectedTaskStateError,
+                          light_snapshot_api.instance_light_snapshot_update,
+                          self.ctxt, self.instance['uuid'],
+                          {'snapshot_index': 2},
+                          expected_task_state='light_commit')
+        self.assertIsNone(self._get_state())
+
+    def test_update_unexpected_vm_state(self):
+        self.assertRaises(exception.UnexpectedVMStateError,
+                          light_snapshot_api.instance_light_snapshot_update,
+                          self.ctxt, self.instance['uuid'],
+                          {'snapshot_index': 2},
+                          expected_vm_state=vm_states.STOPPED)
+        self.assertIsNone(self._get_state())
+
+    def test_update_unknown_instance(self):
+        self.assertRaises(exception.InstanceNotFound,
+                          light_snapshot_api.instance_light_snapshot_update,
+                          self.ctxt, 'fake-uuid', {'snapshot_index': 2},
+                          expected_task_state='light_snapshot')
+
+    def test_destroy(self):
+        light_snapshot_api.instance_light_snapshot_update(
+            self.ctxt, self.instance['uuid'], {'snapshot_index': 0})
+        self._create_snapshot(0)
+
+        light_snapshot_api.instance_light_snapshot_destroy(
+            self.ctxt, self.instance['uuid'])
+
+        self.assertIsNone(self._get_state())
+        self.assertEqual(
+            [], light_snapshot_api.light_snapshot_get_all_by_instance(
+                self.ctxt, self.instance['uuid']))
+
+    def test_mark_committed(self):
+        for snapshot_index in (2, 0, 1):
+            self._create_snapshot(snapshot_index)
+
+        self.assertEqual(
+            2, light_snapshot_api.light_snapshot_mark_committed(
+                self.ctxt, self.instance['uuid'], 1, 'committed'))
+
+        snapshots = light_snapshot_api.light_snapshot_get_all_by_instance(
+            self.ctxt, self.instance['uuid'])
+        self.assertEqual([(0, 'committed'), (1, 'committed'), (2, 'active')],
+                         [(snapshot['snapshot_index'], snapshot['status'])
+                          for snapshot in snapshots])
+        self.assertIsNotNone(snapshots[0]['committed_at'])
+        self.assertIsNone(snapshots[2]['committed_at'])
+
+
+class LightSnapshotFiltersTestCase(LightSnapshotDBApiTestCase):
+    def setUp(self):
+        super(LightSnapshotFiltersTestCase, self).setUp()
+        self.now = timeutils.utcnow()
+        self.enabled = self._create_instance(
+            {'light_snapshot_enable': True, 'snapshot_committed': True,
+             'snapshot_at': self.now - datetime.timedelta(days=2)})
+        self.disabled = self._create_instance(
+            {'light_snapshot_enable': False,
+             'snapshot_at': self.now - datetime.timedelta(hours=1)})
+        self.without_state = self._create_instance(host='host2')
+
+    def _get_all(self, light_snapshot_filters, filters=None, **kwargs):
+        if filters is None:
+            filters = {'deleted': False}
+        filters['light_snapshot'] = light_snapshot_filters
+        return db.instance_get_all_by_filters_sort(self.ctxt, filters,
+                                                   **kwargs)
+
+    def test_filter_hook_installed_once(self):
+        exact_instance_filter = sqlalchemy_api._exact_instance_filter
+        self.assertTrue(exact_instance_filter.light_snapshot_filter)
+        reload(light_snapshot_api)
+        self.assertIs(exact_instance_filter,
+                      sqlalchemy_api._exact_instance_filter)
+
+    def test_filter_keeps_caller_filters(self):
+        filters = {'deleted': False}
+        self._get_all({'light_snapshot_enable': True}, filters=filters)
+        self.assertEqual({'deleted': False,
+                          'light_snapshot': {'light_snapshot_enable': True}},
+                         filters)
+
+    def test_no_filter(self):
+        self.assertEqual(
+            self._uuids([self.enabled, self.disabled, self.without_state]),
+            self._uuids(self._get_all({})))
+
+    def test_filter_true(self):
+        self.assertEqual(
+            [self.enabled['uuid']],
+            self._uuids(self._get_all({'light_snapshot_enable': True})))
+
+    def test_filter_false_matches_missing_state(self):
+        self.assertEqual(
+            self._uuids([self.disabled, self.without_state]),
+            self._uuids(self._get_all({'light_snapshot_enable': False})))
+        self.assertEqual(
+            self._uuids([self.disabled, self.without_state]),
+            self._uuids(self._get_all({'snapshot_committed': False})))
+
+    def test_filter_deleted_state(self):
+        light_snapshot_api.instance_light_snapshot_destroy(
+            self.ctxt, self.enabled['uuid'])
+        self.assertEqual(
+            self._uuids([self.enabled, self.disabled, self.without_state]),
+            self._uuids(self._get_all({'light_snapshot_enable': False})))
+
+    def test_filter_snapshot_older_than(self):
+        older_than = self.now - datetime.timedelta(days=1)
+        self.assertEqual(
+            self._uuids([self.enabled, self.without_state]),
+            self._uuids(self._get_all({'snapshot_older_than': older_than})))
+
+    def test_filter_with_instance_filters(self):
+        self.assertEqual(
+            [self.without_state['uuid']],
+            self._uuids(self._get_all({'light_snapshot_enable': False},
+                                      filters={'deleted': False,
+                                               'host': 'host2'})))
+
+    def test_filter_deleted_instance(self):
+        db.instance_destroy(self.ctxt, self.disabled['uuid'])
+        self.assertEqual(
+            [self.without_state['uuid']],
+            self._uuids(self._get_all({'light_snapshot_enable': False})))
+
+    def test_filter_sort_and_limit(self):
+        instances = self._get_all({'light_snapshot_enable': False},
+                                  sort_keys=['host'], sort_dirs=['asc'],
+                                  limit=1)
+        self.assertEqual([self.disabled['uuid']], self._uuids(instances))
+        self.assertEqual([], self._get_all({}, limit=0))
+
+    def test_filter_marker_not_found(self):
+        self.assertRaises(exception.MarkerNotFound, self._get_all,
+                          {'light_snapshot_enable': False},
+                          marker='fake-uuid')
+
+    def test_get_states_by_filters(self):
+        states = light_snapshot_api.instance_light_snapshot_get_all_by_filters(
+            self.ctxt, {'light_snapshot_enable': False})
+        self.assertEqual([self.disabled['uuid']],
+                         [state['instance_uuid'] for state in states])
+
+    def test_get_states_by_host(self):
+        self._create_instance({'light_snapshot_enable': True}, host='host2')
+        states = light_snapshot_api.instance_light_snapshot_get_all_by_filters(
+            self.ctxt, {'light_snapshot_enable': True, 'host': 'host1'})
+        self.assertEqual([self.enabled['uuid']],
+                         [state['instance_uuid'] for state in states])
+
+
+class LightSnapshotUpdateBulkTestCase(LightSnapshotDBApiTestCase):
+    def _get_state(self, instance):
+        return light_snapshot_api.instance_light_snapshot_get(
+            self.ctxt, instance['uuid'])
+
+    def test_update(self):
+        with_state = self._create_instance({'light_snapshot_enable': True})
+        without_state = self._create_instance()
+        deleted = self._create_instance()
+        db.instance_destroy(self.ctxt, deleted['uuid'])
+
+        updated = light_snapshot_api.instance_light_snapshot_update_bulk(
+            self.ctxt, [with_state['uuid'], without_state['uuid'],
+                        deleted['uuid']], {'snapshot_daily': True})
+
+        self.assertEqual(self._uuids([with_state, without_state]),
+                         sorted(updated))
+        state = self._get_state(with_state)
+        self.assertTrue(state['snapshot_daily'])
+        self.assertTrue(state['light_snapshot_enable'])
+        state = self._get_state(without_state)
+        self.assertTrue(state['snapshot_daily'])
+        self.assertFalse(state['light_snapshot_enable'])
+        self.assertIsNone(self._get_state(deleted))
+
+    def test_update_empty(self):
+        self.assertEqual(
+            [], light_snapshot_api.instance_light_snapshot_update_bulk(
+                self.ctxt, [], {'snapshot_daily': True}))
+
+
+class TaskStateUpdateBulkTestCase(LightSnapshotDBApiTestCase):
+    def _update(self, instance_uuids, expected_task_state=None):
+        return light_snapshot_api.instance_task_state_update_bulk(
+            self.ctxt, instance_uuids, 'light_snapshot_pending',
+            expected_task_state=expected_task_state)
+
+    def _task_state(self, instance):
+        return db.instance_get_by_uuid(self.ctxt,
+                                       instance['uuid'])['task_state']
+
+    def test_update(self):
+        idle = self._create_instance()
+        busy = self._create_instance(task_state='light_commit')
+        deleted = self._create_instance()
+        db.instance_destroy(self.ctxt, deleted['uuid'])
+
+        updated = self._update([idle['uuid'], busy['uuid'],
+                                deleted['uuid']])
+
+        self.assertEqual([idle['uuid']], updated)
+        self.assertEqual('light_snapshot_pending', self._task_state(idle))
+        self.assertEqual('light_commit', self._task_state(busy))
+
+    def test_update_expected_task_state(self):
+        busy = self._create_instance(task_state='light_commit')
+        self.assertEqual([busy['uuid']],
+                         self._update([busy['uuid']],
+                                      expected_task_state='light_commit'))
+        self.assertEqual('light_snapshot_pending', self._task_state(busy))
+
+    def test_update_empty(self):
+        self.assertEqual([], self._update([]))
+
+
+class CountByHostAndTaskStatesTestCase(LightSnapshotDBApiTestCase):
+    def test_count(self):
+        for host, task_state in (('host1', 'light_snapshot_pending'),
+                                 ('host1', 'light_commit'),
+                                 ('host1', None),
+                                 ('host2', 'light_commit'),
+                                 ('host3', 'light_commit')):
+            self._create_instance(host=host, task_state=task_state)
+        deleted = self._create_instance(task_state='light_commit')
+        db.instance_destroy(self.ctxt, deleted['uuid'])
+
+        self.assertEqual(
+            {'host1': 2, 'host2': 1},
+            light_snapshot_api.instance_count_by_host_and_task_states(
+                self.ctxt, ['host1', 'host2', 'host4'],
+                ['light_snapshot_pending', 'light_commit']))
+
+    def test_count_without_hosts(self):
+        self.assertEqual(
+            {}, light_snapshot_api.instance_count_by_host_and_task_states(
+                self.ctxt, [], ['light_commit']))
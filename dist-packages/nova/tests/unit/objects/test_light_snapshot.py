@@ -0,0 +1,330 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import datetime
+
+import mock
+
+from nova import context
+from nova import exception
+from nova import objects
+from nova.objects import light_snapshot
+from nova import test
+
+
+FAKE_UUID = 'b48316c5-71e8-45e4-9884-6c78055b9b13'
+
+
+def fake_db_state(**updates):
+    db_state = {
+        'created_at': None,
+        'updated_at': None,
+        'deleted_at': None,
+        'deleted': False,
+        'instance_uuid': FAKE_UUID,
+        'light_snapshot_enable': True,
+        'snapshot_committed': False,
+        'snapshot_index': 3,
+        'root_index': 1,
+        'snapshot_store': False,
+        'snapshot_daily': False,
+        'snapshot_at': None,
+    }
+    db_state.update(updates)
+    return db_state
+
+
+class InstanceLightSnapshotTestCase(test.NoDBTestCase):
+    def setUp(self):
+        super(InstanceLightSnapshotTestCase, self).setUp()
+        self.context = context.RequestContext('fake', 'fake')
+
+    def _get_state(self, **updates):
+        return objects.InstanceLightSnapshot._from_db_object(
+            self.context, objects.InstanceLightSnapshot(),
+            fake_db_state(**updates))
+
+    def test_new(self):
+        state = objects.InstanceLightSnapshot._new(self.context, FAKE_UUID)
+        self.assertEqual(FAKE_UUID, state.instance_uuid)
+        self.assertFalse(state.light_snapshot_enable)
+        self.assertFalse(state.snapshot_committed)
+        self.assertIsNone(state.snapshot_index)
+        self.assertIsNone(state.root_index)
+        self.assertIsNone(state.snapshot_at)
+        self.assertEqual(set(), state.obj_what_changed())
+
+    @mock.patch.object(light_snapshot.light_snapshot_db,
+                       'instance_light_snapshot_get', return_value=None)
+    def test_get_by_instance_uuid_without_state(self, mock_get):
+        state = objects.InstanceLightSnapshot.get_by_instance_uuid(
+            self.context, FAKE_UUID)
+        mock_get.assert_called_once_with(self.context, FAKE_UUID)
+        self.assertEqual(FAKE_UUID, state.instance_uuid)
+        self.assertIsNone(state.snapshot_index)
+
+    @mock.patch.object(light_snapshot.light_snapshot_db,
+                       'instance_light_snapshot_get')
+    def test_get_by_instance_uuid(self, mock_get):
+        mock_get.return_value = fake_db_state()
+        state = objects.InstanceLightSnapshot.get_by_instance_uuid(
+            self.context, FAKE_UUID)
+        self.assertTrue(state.light_snapshot_enable)
+        self.assertEqual(3, state.snapshot_index)
+        self.assertEqual(1, state.root_index)
+
+    @mock.patch.object(light_snapshot.light_snapshot_db,
+                       'instance_light_snapshot_update')
+    def test_save(self, mock_update):
+        mock_update.return_value = fake_db_state(root_index=3)
+        state = self._get_state()
+        state.root_index = 3
+        state.instance_uuid = FAKE_UUID
+        state.save()
+        mock_update.assert_called_once_with(self.context, FAKE_UUID,
+                                            {'root_index': 3})
+        self.assertEqual(3, state.root_index)
+        self.assertEqual(set(), state.obj_what_changed())
+
+    @mock.patch.object(light_snapshot.light_snapshot_db,
+                       'instance_light_snapshot_update')
+    def test_save_without_changes(self, mock_update):
+        self._get_state().save()
+        self.assertFalse(mock_update.called)
+
+    @mock.patch.object(light_snapshot.light_snapshot_db,
+                       'instance_allocate_snapshot_indexes',
+                       return_value=(4, 6))
+    def test_allocate_indexes(self, mock_allocate):
+        state = self._get_state()
+        self.assertEqual((4, 6), state.allocate_indexes(count=3))
+        mock_allocate.assert_called_once_with(self.context, FAKE_UUID,
+                                              count=3)
+        self.assertEqual(6, state.snapshot_index)
+        self.assertEqual(set(), state.obj_what_changed())
+
+    @mock.patch.object(light_snapshot.light_snapshot_db,
+                       'instance_release_snapshot_index', return_value=True)
+    def test_release_index(self, mock_release):
+        state = self._get_state(snapshot_index=4)
+        self.assertTrue(state.release_index(4, 3))
+        mock_release.assert_called_once_with(self.context, FAKE_UUID, 4, 3)
+        self.assertEqual(3, state.snapshot_index)
+        self.assertEqual(set(), state.obj_what_changed())
+
+    @mock.patch.object(light_snapshot.light_snapshot_db,
+                       'instance_release_snapshot_index', return_value=False)
+    def test_release_index_after_another_allocation(self, mock_release):
+        state = self._get_state(snapshot_index=5)
+        self.assertFalse(state.release_index(4, 3))
+        self.assertEqual(5, state.snapshot_index)
+
+    def test_obj_make_compatible(self):
+        state = self._get_state(snapshot_at=datetime.datetime(2016, 1, 1))
+        primitive = state.obj_to_primitive(target_version='1.0')
+        self.assertNotIn('snapshot_at', primitive['nova_object.data'])
+        primitive = state.obj_to_primitive(target_version='1.1')
+        self.assertIn('snapshot_at', primitive['nova_object.data'])
+
+
+class LightSnapshotTestCase(test.NoDBTestCase):
+    def setUp(self):
+        super(LightSnapshotTestCase, self).setUp()
+        self.context = context.RequestContext('fake', 'fake')
+
+    @mock.patch.object(light_snapshot.light_snapshot_db,
+                       'light_snapshot_create')
+    def test_create(self, mock_create):
+        mock_create.return_value = {
+            'created_at': None, 'updated_at': None, 'deleted_at': None,
+            'deleted': False, 'id': 1, 'instance_uuid': FAKE_UUID,
+            'snapshot_index': 2, 'status': light_snapshot.ACTIVE,
+            'committed_at': None}
+        snapshot = objects.LightSnapshot(context=self.context,
+                                         instance_uuid=FAKE_UUID,
+                                         snapshot_index=2,
+                                         status=light_snapshot.ACTIVE)
+        snapshot.create()
+        mock_create.assert_called_once_with(
+            self.context, {'instance_uuid': FAKE_UUID, 'snapshot_index': 2,
+                           'status': light_snapshot.ACTIVE})
+        self.assertEqual(1, snapshot.id)
+
+    def test_create_already_created(self):
+        snapshot = objects.LightSnapshot(context=self.context, id=1)
+        self.assertRaises(exception.ObjectActionError, snapshot.create)
+
+    @mock.patch.object(light_snapshot.light_snapshot_db,
+                       'light_snapshot_mark_committed')
+    def test_mark_committed(self, mock_mark):
+        objects.LightSnapshotList.mark_committed(self.context, FAKE_UUID, 4)
+        mock_mark.assert_called_once_with(self.context, FAKE_UUID, 4,
+                                          light_snapshot.COMMITTED)
+
+    @mock.patch.object(light_snapshot.light_snapshot_db,
+                       'light_snapshot_mark_committed')
+    def test_mark_committed_stored(self, mock_mark):
+        objects.LightSnapshotList.mark_committed(self.context, FAKE_UUID, 4,
+                                                 stored=True)
+        mock_mark.assert_called_once_with(self.context, FAKE_UUID, 4,
+                                          light_snapshot.STORED)
+
+
+class InstanceLightSnapshotSaveTestCase(test.NoDBTestCase):
+    """The light-snapshot state saved along with its instance."""
+    def setUp(self):
+        super(InstanceLightSnapshotSaveTestCase, self).setUp()
+        self.context = context.RequestContext('fake', 'fake')
+        self.instance = objects.Instance(context=self.context, id=1,
+                                         uuid=FAKE_UUID, cell_name=None,
+                                         task_state='light_snapshot')
+        self.instance.light_snapshot = (
+            objects.InstanceLightSnapshot._from_db_object(
+                self.context, objects.InstanceLightSnapshot(),
+                fake_db_state()))
+        self.instance.obj_reset_changes(recursive=True)
+
+    def test_attributes(self):
+        self.assertTrue(self.instance.light_snapshot_enable)
+        self.instance.snapshot_index = 4
+        self.assertEqual(4, self.instance.light_snapshot.snapshot_index)
+        self.assertIn('light_snapshot', self.instance.obj_what_changed())
+
+    @mock.patch.object(light_snapshot.light_snapshot_db,
+                       'instance_light_snapshot_update')
+    @mock.patch('nova.db.instance_update_and_get_original')
+    def test_save_light_snapshot_only(self, mock_instance_update,
+                                      mock_update):
+        mock_update.return_value = fake_db_state(snapshot_index=4)
+        self.instance.snapshot_index = 4
+        self.instance.save(expected_task_state='light_snapshot')
+        self.assertFalse(mock_instance_update.called)
+        mock_update.assert_called_once_with(
+            self.context, FAKE_UUID, {'snapshot_index': 4},
+            expected_task_state='light_snapshot', expected_vm_state=None)
+        self.assertEqual(set(), self.instance.obj_what_changed())
+
+    @mock.patch('nova.notifications.send_update')
+    @mock.patch.object(objects.Instance, '_from_db_object')
+    @mock.patch.object(light_snapshot.light_snapshot_db,
+                       'instance_light_snapshot_update')
+    @mock.patch('nova.db.instance_update_and_get_original')
+    def test_save_after_instance_update(self, mock_instance_update,
+                                        mock_update, mock_from_db,
+                                        mock_send_update):
+        calls = mock.Mock()
+        calls.attach_mock(mock_instance_update, 'instance_update')
+        calls.attach_mock(mock_update, 'light_snapshot_update')
+        mock_instance_update.return_value = (mock.sentinel.old,
+                                             mock.sentinel.new)
+        mock_update.return_value = fake_db_state(snapshot_index=4)
+
+        self.instance.snapshot_index = 4
+        self.instance.task_state = None
+        self.instance.save(expected_task_state='light_snapshot')
+
+        self.assertEqual(['instance_update', 'light_snapshot_update'],
+                         [call[0] for call in calls.mock_calls])
+        mock_update.assert_called_once_with(
+            self.context, FAKE_UUID, {'snapshot_index': 4},
+            expected_task_state=None, expected_vm_state=None)
+
+    @mock.patch.object(light_snapshot.light_snapshot_db,
+                       'instance_light_snapshot_update')
+    @mock.patch('nova.db.instance_update_and_get_original')
+    def test_save_unexpected_task_state(self, mock_instance_update,
+                                        mock_update):
+        mock_instance_update.side_effect = (
+            exception.UnexpectedTaskStateError(instance_uuid=FAKE_UUID,
+                                               expected='light_snapshot',
+                                               actual=None))
+        self.instance.snapshot_index = 4
+        self.instance.task_state = None
+        self.assertRaises(exception.UnexpectedTaskStateError,
+                          self.instance.save,
+                          expected_task_state='light_snapshot')
+        self.assertFalse(mock_update.called)
+
+
+class InstanceListLightSnapshotFiltersTestCase(test.NoDBTestCase):
+    def setUp(self):
+        super(InstanceListLightSnapshotFiltersTestCase, self).setUp()
+        self.context = context.RequestContext('fake', 'fake')
+
+    @mock.patch('nova.db.instance_get_all_by_filters', return_value=[])
+    def test_get_by_filters(self, mock_get_all):
+        filters = {'deleted': False,
+                   'light_snapshot': {'light_snapshot_enable': False}}
+        objects.InstanceList.get_by_filters(self.context, filters,
+                                            sort_key='host', sort_dir='asc',
+                                            limit=10, marker='marker')
+        mock_get_all.assert_called_once_with(
+            self.context, filters, 'host', 'asc', limit=10, marker='marker',
+            columns_to_join=None, use_slave=False)
+
+    @mock.patch('nova.db.instance_get_all_by_filters_sort', return_value=[])
+    def test_get_by_filters_sort(self, mock_get_all_sort):
+        filters = {'deleted': False,
+                   'light_snapshot': {'light_snapshot_enable': False}}
+        objects.InstanceList.get_by_filters(self.context, filters,
+                                            sort_keys=['host'],
+                                            sort_dirs=['asc'])
+        mock_get_all_sort.assert_called_once_with(
+            self.context, filters, limit=None, marker=None,
+            columns_to_join=None, use_slave=False, sort_keys=['host'],
+            sort_dirs=['asc'])
+
+
+class InstanceListSetTaskStateTestCase(test.NoDBTestCase):
+    def setUp(self):
+        super(InstanceListSetTaskStateTestCase, self).setUp()
+        self.context = context.RequestContext('fake', 'fake')
+
+    @mock.patch.object(light_snapshot.light_snapshot_db,
+                       'instance_task_state_update_bulk',
+                       return_value=[FAKE_UUID])
+    def test_set_task_state(self, mock_update):
+        self.assertEqual(
+            [FAKE_UUID],
+            objects.InstanceList.set_task_state(self.context, [FAKE_UUID],
+                                                'light_snapshot_pending'))
+        mock_update.assert_called_once_with(
+            self.context, [FAKE_UUID], 'light_snapshot_pending',
+            expected_task_state=None)
+
+
+class InstanceLightSnapshotListUpdateTestCase(test.NoDBTestCase):
+    @mock.patch.object(light_snapshot.light_snapshot_db,
+                       'instance_light_snapshot_update_bulk',
+                       return_value=[FAKE_UUID])
+    def test_update_by_instance_uuids(self, mock_update):
+        ctxt = context.RequestContext('fake', 'fake')
+        self.assertEqual(
+            [FAKE_UUID],
+            objects.InstanceLightSnapshotList.update_by_instance_uuids(
+                ctxt, [FAKE_UUID], {'snapshot_daily': True}))
+        mock_update.assert_called_once_with(ctxt, [FAKE_UUID],
+                                            {'snapshot_daily': True})
+
+
+class InstanceListCountTestCase(test.NoDBTestCase):
+    @mock.patch.object(light_snapshot.light_snapshot_db,
+                       'instance_count_by_host_and_task_states',
+                       return_value={'host1': 2})
+    def test_count_by_hosts_and_task_states(self, mock_count):
+        ctxt = context.RequestContext('fake', 'fake')
+        self.assertEqual(
+            {'host1': 2},
+            objects.InstanceList.count_by_hosts_and_task_states(
+                ctxt, ['host1', 'host2'], ['light_commit']))
+        mock_count.assert_called_once_with(ctxt, ['host1', 'host2'],
+                                           ['light_commit'])
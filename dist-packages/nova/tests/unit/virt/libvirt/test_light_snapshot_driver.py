@@ -0,0 +1,814 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import os
+import time
+
+import fixtures
+import mock
+from oslo_utils import units
+
+from nova.compute.light_snapshot import journal as light_journal
+from nova.compute import power_state
+from nova import context
+from nova import exception
+from nova import objects
+from nova import test
+from nova.tests.unit import fake_instance
+from nova.tests.unit.virt.libvirt import fakelibvirt
+from nova.virt import fake
+from nova.virt.libvirt import blockinfo
+from nova.virt.libvirt import config as vconfig
+from nova.virt.libvirt import driver as libvirt_driver
+from nova.virt.libvirt import guest as libvirt_guest
+from nova.virt.libvirt import host
+from nova.virt.libvirt import utils as libvirt_utils
+
+
+class LightSnapshotDriverTestCase(test.NoDBTestCase):
+    def setUp(self):
+        super(LightSnapshotDriverTestCase, self).setUp()
+        self.useFixture(fakelibvirt.FakeLibvirtFixture())
+        self.flags(light_snapshot_enabled=True)
+        self.instances_path = self.useFixture(fixtures.TempDir()).path
+        self.flags(instances_path=self.instances_path)
+        self.context = context.get_admin_context()
+        self.drvr = libvirt_driver.LibvirtDriver(fake.FakeVirtAPI(), False)
+
+    def _create_instance(self, **light_snapshot):
+        instance = fake_instance.fake_instance_obj(
+            self.context, expected_attrs=['system_metadata'])
+        instance.light_snapshot = objects.InstanceLightSnapshot._new(
+            self.context, instance.uuid)
+        for field, value in light_snapshot.items():
+            setattr(instance.light_snapshot, field, value)
+        instance.light_snapshot.obj_reset_changes()
+        return instance
+
+    def _disk(self, path, source_type='file', target_dev='vda'):
+        disk = vconfig.LibvirtConfigGuestDisk()
+        disk.source_type = source_type
+        disk.source_path = path
+        disk.target_dev = target_dev
+        return disk
+
+    def _get_guest_xml_disk(self, instance, disks, disk_path):
+        conf = vconfig.LibvirtConfigGuest()
+        conf.virt_type = 'kvm'
+        conf.name = instance.name
+        conf.uuid = instance.uuid
+        conf.memory = 512 * 1024
+        conf.vcpus = 1
+        conf.os_type = 'hvm'
+        for disk in disks:
+            conf.add_device(disk)
+        with mock.patch.object(self.drvr, '_get_guest_config',
+                               return_value=conf):
+            return self.drvr._get_guest_xml_disk(self.context, instance, [],
+                                                 {}, {}, disk_path)
+
+    def _make_files(self, path, names):
+        if not os.path.exists(path):
+            os.makedirs(path)
+        for name in names:
+            open(os.path.join(path, name), 'w').close()
+
+
+class CopyLightSnapshotStoreTestCase(LightSnapshotDriverTestCase):
+    @mock.patch.object(libvirt_utils, 'copy_image')
+    @mock.patch.object(libvirt_utils, 'copy_dir')
+    @mock.patch.object(libvirt_utils, 'copy_snapshot_files')
+    def test_copy_store(self, mock_copy_files, mock_copy_dir,
+                        mock_copy_image):
+        self.flags(light_snapshot_transfer_streams=4, group='libvirt')
+        instance = self._create_instance()
+        src = os.path.join(self.instances_path, 'src')
+        snapshots_dir = os.path.join(src, 'snapshots')
+        self._make_files(snapshots_dir, ['disk2', 'disk', 'disk10', 'notes'])
+        os.mkdir(os.path.join(snapshots_dir, 'extra'))
+        self._make_files(src, ['snapshot.log'])
+
+        self.drvr._copy_light_snapshot_store(instance, src, '/dest',
+                                             'dest-host')
+
+        mock_copy_files.assert_called_once_with(
+            snapshots_dir, '/dest/snapshots',
+            ['disk', 'disk2', 'disk10', 'notes'], host='dest-host',
+            streams=4, compression=mock.ANY, update=False,
+            on_execute=mock.ANY, on_completion=mock.ANY)
+        mock_copy_dir.assert_called_once_with(
+            os.path.join(snapshots_dir, 'extra'), '/dest/snapshots',
+            host='dest-host')
+        mock_copy_image.assert_called_once_with(
+            os.path.join(src, 'snapshot.log'), '/dest', host='dest-host',
+            on_execute=mock.ANY, on_completion=mock.ANY)
+
+    @mock.patch.object(libvirt_utils, 'copy_image')
+    @mock.patch.object(libvirt_utils, 'copy_snapshot_files')
+    def test_copy_without_store(self, mock_copy_files, mock_copy_image):
+        instance = self._create_instance()
+        src = os.path.join(self.instances_path, 'src')
+        os.mkdir(src)
+
+        self.drvr._copy_light_snapshot_store(instance, src, '/dest', None)
+
+        self.assertFalse(mock_copy_files.called)
+        self.assertFalse(mock_copy_image.called)
+
+
+class LightSnapshotMigrationTestCase(LightSnapshotDriverTestCase):
+    def test_is_root_disk(self):
+        inst_dir = '/var/lib/nova/instances/uuid'
+        is_root = libvirt_driver.LibvirtDriver._is_light_snapshot_root_disk
+        self.assertTrue(is_root(self._disk(inst_dir + '/disk'), inst_dir))
+        self.assertTrue(is_root(self._disk(inst_dir + '/disk3'), inst_dir))
+        self.assertTrue(is_root(self._disk(inst_dir + '/disk'),
+                                inst_dir + '/'))
+        self.assertFalse(is_root(self._disk(inst_dir + '/disk.config'),
+                                 inst_dir))
+        self.assertFalse(is_root(self._disk(inst_dir + '/disk.local'),
+                                 inst_dir))
+        self.assertFalse(is_root(self._disk(inst_dir + '/snapshots/disk1'),
+                                 inst_dir))
+        self.assertFalse(is_root(self._disk(None, source_type='network'),
+                                 inst_dir))
+
+    def test_get_guest_xml_disk_only_root(self):
+        instance = self._create_instance()
+        inst_dir = libvirt_utils.get_instance_path(instance)
+        root = self._disk(os.path.join(inst_dir, 'disk'))
+        config_drive = self._disk(os.path.join(inst_dir, 'disk.config'),
+                                  target_dev='hdd')
+
+        self._get_guest_xml_disk(instance, [root, config_drive],
+                                 os.path.join(inst_dir, 'disk4'))
+
+        self.assertEqual(os.path.join(inst_dir, 'disk4'), root.source_path)
+        self.assertEqual(os.path.join(inst_dir, 'disk.config'),
+                         config_drive.source_path)
+
+    @mock.patch.object(libvirt_driver.LibvirtDriver,
+                       '_create_domain_and_network')
+    @mock.patch.object(libvirt_driver.LibvirtDriver,
+                       '_get_light_snapshot_guest_xml')
+    @mock.patch.object(blockinfo, 'get_disk_info')
+    @mock.patch.object(objects.ImageMeta, 'from_instance')
+    def _test_finish_revert_migration(self, sysmeta, mock_image_meta,
+                                      mock_disk_info, mock_xml, mock_create):
+        instance = self._create_instance(light_snapshot_enable=True,
+                                         snapshot_committed=True,
+                                         snapshot_index=7)
+        instance.system_metadata.update(sysmeta)
+        with test.nested(
+                mock.patch.object(self.drvr, 'image_backend'),
+                mock.patch.object(instance, 'save')) as (
+                mock_backend, mock_save):
+            self.drvr.finish_revert_migration(self.context, instance, [],
+                                              power_on=False)
+            mock_save.assert_called_once_with()
+        self.assertNotIn(libvirt_driver.LIGHT_SNAPSHOT_MIGRATED_TOP,
+                         instance.system_metadata)
+        return instance
+
+    def test_finish_revert_migration_chain_kept(self):
+        instance = self._test_finish_revert_migration(
+            {libvirt_driver.LIGHT_SNAPSHOT_MIGRATED_TOP: 'disk3'})
+        self.assertFalse(instance.snapshot_committed)
+        self.assertEqual(3, instance.snapshot_index)
+
+    def test_finish_revert_migration_chain_committed(self):
+        instance = self._test_finish_revert_migration(
+            {libvirt_driver.LIGHT_SNAPSHOT_MIGRATED_TOP: ''})
+        self.assertTrue(instance.snapshot_committed)
+        self.assertEqual(7, instance.snapshot_index)
+
+    def test_finish_revert_migration_unrecorded_commit_mode(self):
+        self.flags(light_snapshot_migrate_mode='commit')
+        instance = self._test_finish_revert_migration({})
+        self.assertTrue(instance.snapshot_committed)
+
+    def test_confirm_migration_drops_top(self):
+        instance = self._create_instance()
+        instance.system_metadata[
+            libvirt_driver.LIGHT_SNAPSHOT_MIGRATED_TOP] = 'disk3'
+        with test.nested(
+                mock.patch.object(self.drvr, '_cleanup_resize'),
+                mock.patch.object(instance, 'save')) as (
+                mock_cleanup, mock_save):
+            self.drvr.confirm_migration(None, instance, [])
+            mock_save.assert_called_once_with()
+        self.assertNotIn(libvirt_driver.LIGHT_SNAPSHOT_MIGRATED_TOP,
+                         instance.system_metadata)
+
+
+class AdoptStagedLightSnapshotChainTestCase(LightSnapshotDriverTestCase):
+    def setUp(self):
+        super(AdoptStagedLightSnapshotChainTestCase, self).setUp()
+        self.instance = self._create_instance()
+        self.inst_dir = os.path.join(self.instances_path, 'uuid')
+        self.staged_dir = (self.inst_dir +
+                           libvirt_driver.LIGHT_SNAPSHOT_STAGED_SUFFIX)
+        self._make_files(self.inst_dir, ['disk2'])
+        self._make_files(self.staged_dir, ['disk', 'disk1', 'disk2', 'disk3'])
+        self._make_files(os.path.join(self.staged_dir, 'snapshots'),
+                         ['disk'])
+
+    def test_adopt_lower_layers(self):
+        self.drvr._adopt_staged_light_snapshot_chain(self.instance,
+                                                     self.inst_dir, 'disk2')
+
+        self.assertEqual(['disk', 'disk1', 'disk2', 'snapshots'],
+                         sorted(os.listdir(self.inst_dir)))
+        self.assertFalse(os.path.exists(self.staged_dir))
+
+    def test_adopt_without_top(self):
+        self.drvr._adopt_staged_light_snapshot_chain(self.instance,
+                                                     self.inst_dir, None)
+
+        self.assertEqual(['disk2', 'snapshots'],
+                         sorted(os.listdir(self.inst_dir)))
+        self.assertFalse(os.path.exists(self.staged_dir))
+
+    def test_adopt_keeps_existing_files(self):
+        self._make_files(os.path.join(self.inst_dir, 'snapshots'), ['disk5'])
+
+        self.drvr._adopt_staged_light_snapshot_chain(self.instance,
+                                                     self.inst_dir, 'disk4')
+
+        self.assertEqual(['disk5'], os.listdir(
+            os.path.join(self.inst_dir, 'snapshots')))
+        self.assertEqual(['disk', 'disk1', 'disk2', 'disk3', 'snapshots'],
+                         sorted(os.listdir(self.inst_dir)))
+
+    def test_adopt_nothing_staged(self):
+        inst_dir = os.path.join(self.instances_path, 'other')
+        self.drvr._adopt_staged_light_snapshot_chain(self.instance,
+                                                     inst_dir, 'disk2')
+        self.assertFalse(os.path.exists(inst_dir))
+
+
+class LightSnapshotOverlayTestCase(LightSnapshotDriverTestCase):
+    def setUp(self):
+        super(LightSnapshotOverlayTestCase, self).setUp()
+        self.instance = self._create_instance()
+        self.inst_dir = os.path.join(self.instances_path, 'uuid')
+        self._make_files(self.inst_dir, ['disk', 'disk1'])
+        self.next_path = os.path.join(
+            self.inst_dir, libvirt_driver.LIGHT_SNAPSHOT_NEXT_OVERLAY)
+        self.top_path = os.path.join(self.inst_dir, 'disk1')
+        self.new_path = os.path.join(self.inst_dir, 'disk2')
+
+    @mock.patch.object(libvirt_driver.LibvirtDriver,
+                       '_create_light_snapshot_overlay')
+    @mock.patch.object(libvirt_utils, 'get_disk_backing_file')
+    def test_provide_reuses_next_overlay(self, mock_backing, mock_create):
+        self._make_files(self.inst_dir, [os.path.basename(self.next_path)])
+        mock_backing.return_value = self.top_path
+
+        self.drvr._provide_light_snapshot_overlay(self.instance,
+                                                  self.top_path,
+                                                  self.new_path)
+
+        mock_backing.assert_called_once_with(self.next_path, basename=False)
+        self.assertFalse(mock_create.called)
+        self.assertTrue(os.path.exists(self.new_path))
+        self.assertFalse(os.path.exists(self.next_path))
+
+    @mock.patch.object(libvirt_driver.LibvirtDriver,
+                       '_create_light_snapshot_overlay')
+    @mock.patch.object(libvirt_utils, 'get_disk_backing_file')
+    def test_provide_discards_stale_overlay(self, mock_backing, mock_create):
+        self._make_files(self.inst_dir, [os.path.basename(self.next_path)])
+        mock_backing.return_value = os.path.join(self.inst_dir, 'disk')
+
+        self.drvr._provide_light_snapshot_overlay(self.instance,
+                                                  self.top_path,
+                                                  self.new_path)
+
+        self.assertFalse(os.path.exists(self.next_path))
+        mock_create.assert_called_once_with(self.top_path, self.new_path)
+
+    @mock.patch.object(libvirt_driver.LibvirtDriver,
+                       '_create_light_snapshot_overlay')
+    def test_provide_without_next_overlay(self, mock_create):
+        self.drvr._provide_light_snapshot_overlay(self.instance,
+                                                  self.top_path,
+                                                  self.new_path)
+        mock_create.assert_called_once_with(self.top_path, self.new_path)
+
+    @mock.patch.object(libvirt_utils, 'create_light_snapshot_overlay')
+    def test_preprovision(self, mock_create):
+        self.flags(light_snapshot_overlay_cluster_size='64K',
+                   light_snapshot_overlay_lazy_refcounts=True,
+                   group='libvirt')
+
+        def fake_create(backing_file, path, **kwargs):
+            open(path, 'w').close()
+        mock_create.side_effect = fake_create
+
+        self.drvr._preprovision_light_snapshot_overlay(self.instance,
+                                                       self.new_path)
+
+        mock_create.assert_called_once_with(
+            self.new_path, self.next_path + '.tmp', cluster_size='64K',
+            lazy_refcounts=True, preallocation='off')
+        self.assertTrue(os.path.exists(self.next_path))
+        self.assertFalse(os.path.exists(self.next_path + '.tmp'))
+
+    @mock.patch.object(libvirt_utils, 'create_light_snapshot_overlay',
+                       side_effect=test.TestingException)
+    def test_preprovision_fails(self, mock_create):
+        self._make_files(self.inst_dir, [os.path.basename(self.next_path)])
+
+        self.drvr._preprovision_light_snapshot_overlay(self.instance,
+                                                       self.new_path)
+
+        self.assertFalse(os.path.exists(self.next_path))
+        self.assertFalse(os.path.exists(self.next_path + '.tmp'))
+
+
+class LightSnapshotIsEmptyTestCase(LightSnapshotDriverTestCase):
+    def setUp(self):
+        super(LightSnapshotIsEmptyTestCase, self).setUp()
+        self.instance = self._create_instance()
+        for patcher in (
+                mock.patch.object(self.drvr, '_get_light_snapshot_guest'),
+                mock.patch.object(libvirt_utils, 'find_disk'),
+                mock.patch.object(libvirt_utils, 'qcow2_has_data')):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        libvirt_utils.find_disk.return_value = ('/inst/disk3', 'qcow2')
+        libvirt_utils.qcow2_has_data.return_value = False
+
+    def test_is_empty(self):
+        self.assertTrue(self.drvr.light_snapshot_is_empty(self.instance))
+        libvirt_utils.qcow2_has_data.assert_called_once_with('/inst/disk3')
+
+    def test_is_not_empty(self):
+        libvirt_utils.qcow2_has_data.return_value = True
+        self.assertFalse(self.drvr.light_snapshot_is_empty(self.instance))
+
+    def test_root_disk_is_never_empty(self):
+        libvirt_utils.find_disk.return_value = ('/inst/disk', 'qcow2')
+        self.assertFalse(self.drvr.light_snapshot_is_empty(self.instance))
+        self.assertFalse(libvirt_utils.qcow2_has_data.called)
+
+    def test_preallocated_overlay_is_never_empty(self):
+        self.flags(light_snapshot_overlay_preallocation='metadata',
+                   group='libvirt')
+        self.assertFalse(self.drvr.light_snapshot_is_empty(self.instance))
+        self.assertFalse(libvirt_utils.qcow2_has_data.called)
+
+    def test_instance_not_running(self):
+        self.drvr._get_light_snapshot_guest.side_effect = (
+            exception.InstanceNotFound(instance_id=self.instance.uuid))
+        self.assertRaises(exception.InstanceNotRunning,
+                          self.drvr.light_snapshot_is_empty, self.instance)
+
+
+class LightSnapshotDiscardTestCase(LightSnapshotDriverTestCase):
+    def setUp(self):
+        super(LightSnapshotDiscardTestCase, self).setUp()
+        self.instance = self._create_instance()
+        self.inst_dir = libvirt_utils.get_instance_path(self.instance)
+        self.root = self._disk(os.path.join(self.inst_dir, 'disk'))
+        self.local = self._disk(os.path.join(self.inst_dir, 'disk.local'),
+                                target_dev='vdb')
+
+    @mock.patch.object(host.Host, 'has_min_version', return_value=True)
+    def test_discard_root_overlay(self, mock_version):
+        self.flags(light_snapshot_discard=True, group='libvirt')
+
+        self._get_guest_xml_disk(self.instance, [self.root, self.local],
+                                 os.path.join(self.inst_dir, 'disk2'))
+
+        self.assertEqual('unmap', self.root.driver_discard)
+        self.assertIsNone(self.local.driver_discard)
+
+    @mock.patch.object(host.Host, 'has_min_version', return_value=False)
+    def test_discard_unsupported(self, mock_version):
+        self.flags(light_snapshot_discard=True, group='libvirt')
+
+        self._get_guest_xml_disk(self.instance, [self.root],
+                                 os.path.join(self.inst_dir, 'disk2'))
+
+        self.assertIsNone(self.root.driver_discard)
+
+    def test_discard_disabled(self):
+        self._get_guest_xml_disk(self.instance, [self.root],
+                                 os.path.join(self.inst_dir, 'disk2'))
+
+        self.assertIsNone(self.root.driver_discard)
+
+    def test_trim_guest(self):
+        guest = mock.Mock()
+        self.drvr._trim_light_snapshot_guest(self.instance, guest)
+        guest.trim_filesystems.assert_called_once_with()
+
+    def test_trim_guest_not_supported(self):
+        guest = mock.Mock()
+        guest.trim_filesystems.side_effect = NotImplementedError
+        self.drvr._trim_light_snapshot_guest(self.instance, guest)
+
+    def test_trim_guest_agent_error(self):
+        guest = mock.Mock()
+        guest.trim_filesystems.side_effect = fakelibvirt.make_libvirtError(
+            fakelibvirt.libvirtError, 'QEMU guest agent is not connected',
+            error_code=fakelibvirt.VIR_ERR_OPERATION_INVALID)
+        self.drvr._trim_light_snapshot_guest(self.instance, guest)
+
+    def test_guest_trim_filesystems(self):
+        domain = mock.Mock()
+        libvirt_guest.Guest(domain).trim_filesystems(minimum=4096)
+        domain.fsTrim.assert_called_once_with(None, 4096, 0)
+
+    def test_guest_trim_filesystems_not_supported(self):
+        domain = mock.Mock(spec=['XMLDesc'])
+        self.assertRaises(NotImplementedError,
+                          libvirt_guest.Guest(domain).trim_filesystems)
+
+
+class LightSnapshotOfflineCommitTestCase(LightSnapshotDriverTestCase):
+    @mock.patch.object(libvirt_utils, 'commit_image')
+    def test_disk_commit(self, mock_commit):
+        self.flags(light_snapshot_commit_workers=4,
+                   light_snapshot_commit_bandwidth=100,
+                   light_snapshot_commit_cache='none', group='libvirt')
+        callback = mock.Mock()
+
+        self.drvr._disk_commit('/inst/disk3', '/inst/disk',
+                               progress_callback=callback)
+
+        mock_commit.assert_called_once_with(
+            '/inst/disk3', '/inst/disk', cache='none',
+            rate_limit=100 * units.Mi, progress_callback=callback)
+
+    @mock.patch.object(libvirt_utils, 'commit_image')
+    def test_disk_commit_unlimited(self, mock_commit):
+        self.drvr._disk_commit('/inst/disk3', '/inst/disk')
+
+        mock_commit.assert_called_once_with(
+            '/inst/disk3', '/inst/disk', cache='writeback', rate_limit=0,
+            progress_callback=None)
+
+
+class ResumeLightSnapshotCommitTestCase(LightSnapshotDriverTestCase):
+    def setUp(self):
+        super(ResumeLightSnapshotCommitTestCase, self).setUp()
+        self.instance = self._create_instance(light_snapshot_enable=True,
+                                              snapshot_index=3)
+        self.inst_dir = os.path.join(self.instances_path, 'uuid')
+        self._make_files(self.inst_dir, ['disk', 'disk1', 'disk2', 'disk3'])
+        self.guest = mock.Mock()
+        self.dev = self.guest.get_block_device.return_value
+        self.dev.get_job_info.return_value = None
+        for patcher in (
+                mock.patch.object(self.drvr, '_get_light_snapshot_guest',
+                                  return_value=self.guest),
+                mock.patch.object(self.drvr,
+                                  '_get_light_snapshot_power_state',
+                                  return_value=power_state.RUNNING),
+                mock.patch.object(self.drvr, 'post_commit'),
+                mock.patch.object(libvirt_utils, 'find_disk')):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def _set_top(self, name, backing_files):
+        path = os.path.join(self.inst_dir, name)
+        libvirt_utils.find_disk.return_value = (path, 'qcow2')
+        self.guest.get_xml_desc.return_value = (
+            "<domain type='kvm'><devices>"
+            "<disk type='file' device='disk'>"
+            "<driver name='qemu' type='qcow2'/>"
+            "<source file='%s'/><target dev='vda' bus='virtio'/>"
+            "</disk></devices></domain>" % path)
+        patcher = mock.patch.object(
+            libvirt_utils, 'get_disk_backing_file',
+            side_effect=lambda path: backing_files[os.path.basename(path)])
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_instance_not_active(self):
+        self.drvr._get_light_snapshot_power_state.return_value = (
+            power_state.SHUTDOWN)
+
+        self.assertFalse(self.drvr.resume_light_snapshot_commit(
+            self.context, self.instance))
+        self.assertFalse(self.drvr.post_commit.called)
+
+    def test_nothing_to_resume(self):
+        self._set_top('disk3', {'disk3': 'disk2', 'disk2': 'disk1',
+                                'disk1': 'disk'})
+
+        self.assertFalse(self.drvr.resume_light_snapshot_commit(
+            self.context, self.instance))
+        self.guest.get_block_device.assert_called_once_with('vda')
+        self.assertFalse(self.drvr.post_commit.called)
+
+    def test_finish_partial_commit(self):
+        self._set_top('disk3', {'disk3': 'disk2', 'disk2': 'disk'})
+
+        self.assertTrue(self.drvr.resume_light_snapshot_commit(
+            self.context, self.instance))
+        self.drvr.post_commit.assert_called_once_with(
+            self.context, self.instance,
+            [os.path.join(self.inst_dir, 'disk1')], False,
+            updates={'root_index': 1})
+
+    @mock.patch('time.sleep')
+    def test_resume_active_commit(self, mock_sleep):
+        self._set_top('disk', {})
+        self.dev.get_job_info.return_value = mock.Mock(
+            job=libvirt_driver.VIR_DOMAIN_BLOCK_JOB_TYPE_ACTIVE_COMMIT)
+        self.dev.wait_for_job.side_effect = [True, False]
+
+        with test.nested(
+                mock.patch.object(self.instance, 'allocate_snapshot_indexes',
+                                  return_value=(4, 4)),
+                mock.patch.object(self.instance, 'save')):
+            self.assertTrue(self.drvr.resume_light_snapshot_commit(
+                self.context, self.instance))
+
+        self.assertEqual(2, self.dev.wait_for_job.call_count)
+        self.dev.abort_job.assert_called_once_with(pivot=True)
+        self.drvr.post_commit.assert_called_once_with(
+            self.context, self.instance,
+            [os.path.join(self.inst_dir, name)
+             for name in ('disk3', 'disk2', 'disk1')], True,
+            updates={'snapshot_committed': True, 'root_index': 4})
+
+
+class LightSnapshotJournalTestCase(LightSnapshotDriverTestCase):
+    def setUp(self):
+        super(LightSnapshotJournalTestCase, self).setUp()
+        self.instance = self._create_instance()
+        self.inst_dir = libvirt_utils.get_instance_path(self.instance)
+        os.makedirs(self.inst_dir)
+        self.handlers = {'rm': mock.Mock(), 'mv': mock.Mock()}
+        patcher = mock.patch.object(
+            self.drvr, '_get_light_snapshot_journal_handlers',
+            return_value=self.handlers)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_run_journal(self):
+        self.drvr._run_light_snapshot_journal(
+            self.instance, 'post_commit', [['rm', 'disk1']])
+
+        self.handlers['rm'].assert_called_once_with('disk1')
+        self.assertIsNone(light_journal.Journal.load(self.inst_dir))
+
+    def test_run_journal_recovers_unfinished(self):
+        light_journal.Journal.begin(self.inst_dir, 'recover',
+                                    [['mv', 'disk2', 'disk3']])
+
+        self.drvr._run_light_snapshot_journal(
+            self.instance, 'post_commit', [['rm', 'disk1']])
+
+        self.handlers['mv'].assert_called_once_with('disk2', 'disk3')
+        self.handlers['rm'].assert_called_once_with('disk1')
+        self.assertIsNone(light_journal.Journal.load(self.inst_dir))
+
+
+class CheckLightSnapshotChainTestCase(LightSnapshotDriverTestCase):
+    def setUp(self):
+        super(CheckLightSnapshotChainTestCase, self).setUp()
+        self.instance = self._create_instance(light_snapshot_enable=True,
+                                              snapshot_index=2)
+        self.inst_dir = libvirt_utils.get_instance_path(self.instance)
+        self._make_files(self.inst_dir, ['disk', 'disk1', 'disk2'])
+        self.backing_files = {'disk': None, 'disk1': 'disk',
+                              'disk2': 'disk1'}
+        for patcher in (
+                mock.patch.object(self.drvr, '_get_light_snapshot_guest'),
+                mock.patch.object(libvirt_utils, 'find_disk'),
+                mock.patch.object(
+                    libvirt_utils, 'read_qcow2_header',
+                    side_effect=lambda path: {
+                        'backing_file': self.backing_files[
+                            os.path.basename(path)]})):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self._set_top('disk2')
+
+    def _set_top(self, name):
+        libvirt_utils.find_disk.return_value = (
+            os.path.join(self.inst_dir, name), 'qcow2')
+
+    def test_chain_matches(self):
+        self.assertEqual(
+            {}, self.drvr.check_light_snapshot_chain(self.instance))
+
+    def test_index_does_not_match(self):
+        self.instance.light_snapshot.snapshot_index = 5
+        self.instance.light_snapshot.snapshot_committed = True
+
+        self.assertEqual(
+            {'snapshot_index': 2, 'snapshot_committed': False},
+            self.drvr.check_light_snapshot_chain(self.instance))
+
+    def test_chain_committed(self):
+        self._set_top('disk')
+
+        self.assertEqual(
+            {'snapshot_committed': True},
+            self.drvr.check_light_snapshot_chain(self.instance))
+
+    def test_layer_missing(self):
+        os.unlink(os.path.join(self.inst_dir, 'disk1'))
+
+        self.assertRaises(exception.NovaException,
+                          self.drvr.check_light_snapshot_chain,
+                          self.instance)
+
+    def test_chain_not_ending_with_root_disk(self):
+        self.backing_files['disk1'] = '/var/lib/nova/instances/_base/image'
+
+        self.assertRaises(exception.NovaException,
+                          self.drvr.check_light_snapshot_chain,
+                          self.instance)
+
+    def test_instance_not_running(self):
+        self.drvr._get_light_snapshot_guest.side_effect = (
+            exception.InstanceNotFound(instance_id=self.instance.uuid))
+
+        self.assertEqual(
+            {}, self.drvr.check_light_snapshot_chain(self.instance))
+
+
+class LightSnapshotDeferredInitTestCase(LightSnapshotDriverTestCase):
+    def setUp(self):
+        super(LightSnapshotDeferredInitTestCase, self).setUp()
+        self.instance = self._create_instance(light_snapshot_enable=True,
+                                              snapshot_committed=True,
+                                              snapshot_store=True)
+        for patcher in (mock.patch.object(self.drvr, 'plug_vifs'),
+                        mock.patch.object(self.drvr, 'firewall_driver'),
+                        mock.patch.object(self.drvr, '_create_domain'),
+                        mock.patch.object(self.drvr, 'light_snapshot_init'),
+                        mock.patch.object(self.drvr, 'store_snapshot_init'),
+                        mock.patch.object(self.instance, 'save')):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def _create_domain_and_network(self):
+        self.drvr._create_domain_and_network(self.context, '<xml/>',
+                                             self.instance, [], {})
+
+    def test_init_committed_chain(self):
+        self._create_domain_and_network()
+
+        self.drvr.light_snapshot_init.assert_called_once_with(
+            self.context, self.instance)
+        self.drvr.store_snapshot_init.assert_called_once_with(
+            self.context, self.instance)
+        self.assertFalse(self.instance.snapshot_committed)
+
+    def test_init_deferred_while_host_initializes(self):
+        with self.drvr.deferred_light_snapshot_init():
+            self._create_domain_and_network()
+        self.assertFalse(self.drvr._light_snapshot_init_deferred)
+
+        self.assertFalse(self.drvr.light_snapshot_init.called)
+        self.assertFalse(self.drvr.store_snapshot_init.called)
+        self.assertTrue(self.instance.snapshot_committed)
+
+
+class LightSnapshotLockTestCase(LightSnapshotDriverTestCase):
+    def test_lock_reentrant(self):
+        with self.drvr._light_snapshot_lock('uuid'):
+            lock = self.drvr._light_snapshot_locks['uuid']
+            with self.drvr._light_snapshot_lock('uuid'):
+                self.assertIs(lock, self.drvr._light_snapshot_locks['uuid'])
+
+    def test_lock_per_name(self):
+        with self.drvr._light_snapshot_lock('uuid1'):
+            with self.drvr._light_snapshot_lock('uuid2'):
+                self.assertIsNot(self.drvr._light_snapshot_locks['uuid1'],
+                                 self.drvr._light_snapshot_locks['uuid2'])
+
+    def test_lock_dropped_when_released(self):
+        with self.drvr._light_snapshot_lock('uuid'):
+            pass
+        self.assertNotIn('uuid', self.drvr._light_snapshot_locks)
+
+    def test_store_lock(self):
+        instance = self._create_instance()
+        with self.drvr._light_snapshot_store_lock(instance):
+            self.assertIn(instance.uuid + '-snapshots',
+                          self.drvr._light_snapshot_locks)
+            self.assertNotIn(instance.uuid, self.drvr._light_snapshot_locks)
+
+    def test_locked_operation(self):
+        instance = self._create_instance()
+        held = []
+
+        @libvirt_driver.light_snapshot_locked
+        def operation(drvr, context, instance, arg, kwarg=None):
+            held.append(instance.uuid in drvr._light_snapshot_locks)
+            return arg, kwarg
+
+        self.assertEqual(('a', 'b'),
+                         operation(self.drvr, self.context, instance, 'a',
+                                   kwarg='b'))
+        self.assertEqual([True], held)
+        self.assertNotIn(instance.uuid, self.drvr._light_snapshot_locks)
+
+    @mock.patch.object(libvirt_utils, 'find_disk',
+                       return_value=('/path/disk', 'qcow2'))
+    def test_stage_chain_locked(self, mock_find_disk):
+        instance = self._create_instance()
+        held = []
+
+        def fake_get_guest(instance):
+            held.append(instance.uuid in self.drvr._light_snapshot_locks)
+            return mock.Mock()
+
+        with mock.patch.object(self.drvr, '_get_light_snapshot_guest',
+                               side_effect=fake_get_guest):
+            self.drvr.stage_light_snapshot_chain(self.context, instance,
+                                                 'dest')
+        self.assertEqual([True], held)
+
+
+class DomainPowerStatesTestCase(LightSnapshotDriverTestCase):
+    def _domain(self, uuid):
+        dom = mock.Mock()
+        dom.UUIDString.return_value = uuid
+        return dom
+
+    @mock.patch.object(host.Host, 'get_connection')
+    def test_all_domain_stats(self, mock_conn):
+        conn = mock.Mock(spec=['getAllDomainStats'])
+        conn.getAllDomainStats.return_value = [
+            (self._domain('uuid1'), {'state.state': 1}),
+            (self._domain('uuid2'), {'state.state': 3}),
+            (self._domain('uuid3'), {'state.state': 5})]
+        mock_conn.return_value = conn
+
+        self.assertEqual({'uuid1': power_state.RUNNING,
+                          'uuid2': power_state.PAUSED,
+                          'uuid3': power_state.SHUTDOWN},
+                         self.drvr._get_domain_power_states())
+        conn.getAllDomainStats.assert_called_once_with(
+            libvirt_driver.VIR_DOMAIN_STATS_STATE)
+
+    @mock.patch.object(host.Host, 'get_connection')
+    def test_list_all_domains(self, mock_conn):
+        conn = mock.Mock(spec=['listAllDomains'])
+        domains = {
+            fakelibvirt.VIR_CONNECT_LIST_DOMAINS_RUNNING: [
+                self._domain('uuid1')],
+            fakelibvirt.VIR_CONNECT_LIST_DOMAINS_PAUSED: [
+                self._domain('uuid2')],
+            fakelibvirt.VIR_CONNECT_LIST_DOMAINS_SHUTOFF: [
+                self._domain('uuid3')]}
+        conn.listAllDomains.side_effect = lambda flag: domains[flag]
+        mock_conn.return_value = conn
+
+        self.assertEqual({'uuid1': power_state.RUNNING,
+                          'uuid2': power_state.PAUSED,
+                          'uuid3': power_state.SHUTDOWN},
+                         self.drvr._get_domain_power_states())
+        self.assertEqual(['uuid1'], self.drvr.list_running_instance_uuids())
+        self.assertEqual(3, conn.listAllDomains.call_count)
+
+    @mock.patch('time.time')
+    @mock.patch.object(host.Host, 'get_connection')
+    def test_states_cached(self, mock_conn, mock_time):
+        self.flags(light_snapshot_state_cache_ttl=2, group='libvirt')
+        conn = mock.Mock(spec=['getAllDomainStats'])
+        conn.getAllDomainStats.return_value = [
+            (self._domain('uuid1'), {'state.state': 1})]
+        mock_conn.return_value = conn
+
+        mock_time.return_value = 100.0
+        self.drvr._get_domain_power_states()
+        mock_time.return_value = 101.5
+        self.drvr._get_domain_power_states()
+        self.assertEqual(1, conn.getAllDomainStats.call_count)
+
+        mock_time.return_value = 102.0
+        self.drvr._get_domain_power_states()
+        self.assertEqual(2, conn.getAllDomainStats.call_count)
+
+    def test_light_snapshot_power_state_not_cached(self):
+        instance = self._create_instance()
+        self.drvr._domain_power_states = (
+            time.time(), {instance.uuid: power_state.RUNNING})
+        guest = mock.Mock()
+        guest.get_power_state.return_value = power_state.SHUTDOWN
+
+        self.assertEqual(
+            power_state.SHUTDOWN,
+            self.drvr._get_light_snapshot_power_state(instance, guest))
+        guest.get_power_state.assert_called_once_with(self.drvr._host)
@@ -0,0 +1,290 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import os
+import struct
+import subprocess
+
+import fixtures
+import mock
+from oslo_concurrency import processutils
+import six
+
+from nova.compute.light_snapshot import profiler
+from nova import exception
+from nova import test
+from nova.virt.libvirt import utils as libvirt_utils
+
+
+class ExecuteWithProgressTestCase(test.NoDBTestCase):
+    def _fake_popen(self, output, exit_code=0):
+        proc = mock.Mock()
+        proc.stdout = six.StringIO(output)
+        proc.wait.return_value = exit_code
+        return proc
+
+    @mock.patch('subprocess.Popen')
+    def test_progress_parsed(self, mock_popen):
+        mock_popen.return_value = self._fake_popen(
+            '    (0.00/100%)\r    (42.50/100%)\r    (100.00/100%)\r\n'
+            'Image committed.\n')
+        callback = mock.Mock()
+
+        out, err = libvirt_utils.execute_with_progress(
+            'qemu-img', 'commit', '-p', 'disk1',
+            progress_callback=callback)
+
+        self.assertEqual('Image committed.', out)
+        self.assertEqual('', err)
+        callback.assert_has_calls([mock.call(0.0, 100),
+                                   mock.call(42.5, 100),
+                                   mock.call(100.0, 100)])
+        mock_popen.assert_called_once_with(
+            ['qemu-img', 'commit', '-p', 'disk1'], stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT, close_fds=True)
+
+    @mock.patch('nova.utils.get_root_helper', return_value='sudo')
+    @mock.patch('subprocess.Popen')
+    def test_run_as_root(self, mock_popen, mock_root_helper):
+        mock_popen.return_value = self._fake_popen('')
+        libvirt_utils.execute_with_progress('qemu-img', 'convert', '-p',
+                                            'a', 'b', run_as_root=True)
+        self.assertEqual(['sudo', 'qemu-img', 'convert', '-p', 'a', 'b'],
+                         mock_popen.call_args[0][0])
+
+    @mock.patch('subprocess.Popen')
+    def test_failure_counted_in_profile(self, mock_popen):
+        self.flags(light_snapshot_profile_execute=True)
+        mock_popen.return_value = self._fake_popen(
+            'qemu-img: Could not open disk1\n', exit_code=1)
+
+        with profiler.profile('uuid', 'commit') as prof:
+            exc = self.assertRaises(processutils.ProcessExecutionError,
+                                    libvirt_utils.execute_with_progress,
+                                    'qemu-img', 'commit', '-p', 'disk1')
+
+        self.assertEqual(1, exc.exit_code)
+        self.assertIn('Could not open disk1', exc.stdout)
+        self.assertEqual(1, prof.count)
+        self.assertEqual(1, prof.failed_count)
+
+
+class LightSnapshotFilesTestCase(test.NoDBTestCase):
+    def test_get_light_snapshot_index(self):
+        self.assertEqual(-1, libvirt_utils.get_light_snapshot_index('disk'))
+        self.assertEqual(12, libvirt_utils.get_light_snapshot_index(
+            '/instances/uuid/disk12'))
+        self.assertIsNone(libvirt_utils.get_light_snapshot_index(
+            'disk.local'))
+        self.assertIsNone(libvirt_utils.get_light_snapshot_index(
+            'disk.config'))
+
+    def test_list_light_snapshot_files(self):
+        tmpdir = self.useFixture(fixtures.TempDir()).path
+        for name in ('disk10', 'disk', 'disk2', 'disk.local', 'notes'):
+            open(os.path.join(tmpdir, name), 'w').close()
+        os.mkdir(os.path.join(tmpdir, 'disk3'))
+
+        self.assertEqual(['disk', 'disk2', 'disk10'],
+                         libvirt_utils.list_light_snapshot_files(tmpdir))
+
+    @mock.patch('os.path.exists')
+    @mock.patch.object(libvirt_utils, 'execute')
+    def test_copy_snapshot_files_local(self, mock_execute, mock_exists):
+        mock_exists.side_effect = lambda path: path == '/dest/disk1'
+
+        libvirt_utils.copy_snapshot_files('/src', '/dest',
+                                          ['disk1', 'disk2'])
+
+        mock_execute.assert_has_calls([
+            mock.call('mkdir', '-p', '/dest'),
+            mock.call('cp', '--sparse=always', '/src/disk2', '/dest/disk2')])
+        self.assertEqual(2, mock_execute.call_count)
+
+    @mock.patch('os.path.exists', return_value=True)
+    @mock.patch.object(libvirt_utils, 'execute')
+    def test_copy_snapshot_files_local_update(self, mock_execute,
+                                              mock_exists):
+        libvirt_utils.copy_snapshot_files('/src', '/dest', ['disk1'],
+                                          update=True)
+        mock_execute.assert_called_with('cp', '--sparse=always',
+                                        '/src/disk1', '/dest/disk1')
+
+    @mock.patch('nova.virt.libvirt.volume.remotefs.RemoteFilesystem')
+    @mock.patch.object(libvirt_utils, 'execute')
+    def test_copy_snapshot_files_remote(self, mock_execute, mock_remotefs):
+        on_execute = mock.Mock()
+        on_completion = mock.Mock()
+
+        libvirt_utils.copy_snapshot_files(
+            '/src', '/dest', ['disk', 'disk1', 'disk2'], host='dest-host',
+            streams=2, compression=True, on_execute=on_execute,
+            on_completion=on_completion)
+
+        mock_remotefs.return_value.create_dir.assert_called_once_with(
+            'dest-host', '/dest')
+        for name in ('disk', 'disk1', 'disk2'):
+            mock_execute.assert_any_call(
+                'rsync', '--sparse', '--perms', '--times',
+                '--ignore-existing', '--compress', '/src/' + name,
+                'dest-host:/dest/', on_execute=on_execute,
+                on_completion=on_completion)
+        self.assertEqual(3, mock_execute.call_count)
+
+    @mock.patch('nova.virt.libvirt.volume.remotefs.RemoteFilesystem')
+    @mock.patch.object(libvirt_utils, 'execute')
+    def test_copy_snapshot_files_remote_update(self, mock_execute,
+                                               mock_remotefs):
+        libvirt_utils.copy_snapshot_files('/src', '/dest', ['disk1'],
+                                          host='dest-host', update=True)
+        mock_execute.assert_called_once_with(
+            'rsync', '--sparse', '--perms', '--times', '/src/disk1',
+            'dest-host:/dest/', on_execute=None, on_completion=None)
+
+
+class CreateLightSnapshotOverlayTestCase(test.NoDBTestCase):
+    @mock.patch.object(libvirt_utils, 'execute')
+    def test_create_overlay(self, mock_execute):
+        libvirt_utils.create_light_snapshot_overlay(
+            '/inst/disk1', '/inst/disk2', cluster_size='64K',
+            lazy_refcounts=True, preallocation='metadata')
+        mock_execute.assert_called_once_with(
+            'qemu-img', 'create', '-f', 'qcow2', '-o',
+            'backing_file=/inst/disk1,backing_fmt=qcow2,cluster_size=64K,'
+            'compat=1.1,lazy_refcounts=on,preallocation=metadata',
+            '/inst/disk2')
+
+    @mock.patch('nova.virt.images.qemu_img_info')
+    @mock.patch.object(libvirt_utils, 'execute')
+    def test_create_overlay_inherits_cluster_size(self, mock_execute,
+                                                  mock_info):
+        mock_info.return_value = mock.Mock(cluster_size=2097152)
+        libvirt_utils.create_light_snapshot_overlay(
+            '/inst/disk1', '/inst/disk2', preallocation='off')
+        mock_info.assert_called_once_with('/inst/disk1')
+        mock_execute.assert_called_once_with(
+            'qemu-img', 'create', '-f', 'qcow2', '-o',
+            'backing_file=/inst/disk1,backing_fmt=qcow2,'
+            'cluster_size=2097152', '/inst/disk2')
+
+
+class Qcow2HeaderTestCase(test.NoDBTestCase):
+    def setUp(self):
+        super(Qcow2HeaderTestCase, self).setUp()
+        self.path = os.path.join(self.useFixture(fixtures.TempDir()).path,
+                                 'disk1')
+
+    def _write_image(self, backing_file=None, l1_entries=(0, 0),
+                     magic=libvirt_utils.QCOW2_MAGIC):
+        l1_table_offset = 0x30000
+        backing_file_offset = 0
+        backing_file_size = 0
+        if backing_file:
+            backing_file_offset = libvirt_utils.QCOW2_HEADER.size
+            backing_file_size = len(backing_file)
+        header = libvirt_utils.QCOW2_HEADER.pack(
+            magic, 3, backing_file_offset, backing_file_size, 16, 1 << 30,
+            0, len(l1_entries), l1_table_offset, 0x10000, 1, 0, 0)
+        with open(self.path, 'wb') as f:
+            f.write(header)
+            if backing_file:
+                f.write(backing_file.encode('utf-8'))
+            f.seek(l1_table_offset)
+            f.write(struct.pack('>%dQ' % len(l1_entries), *l1_entries))
+
+    def test_read_header(self):
+        self._write_image(backing_file='/inst/disk')
+        header = libvirt_utils.read_qcow2_header(self.path)
+        self.assertEqual(3, header['version'])
+        self.assertEqual(16, header['cluster_bits'])
+        self.assertEqual(1 << 30, header['size'])
+        self.assertEqual(2, header['l1_size'])
+        self.assertEqual('/inst/disk', header['backing_file'])
+
+    def test_read_header_no_backing_file(self):
+        self._write_image()
+        header = libvirt_utils.read_qcow2_header(self.path)
+        self.assertIsNone(header['backing_file'])
+
+    def test_read_header_not_qcow2(self):
+        self._write_image(magic=b'RAW\0')
+        self.assertIsNone(libvirt_utils.read_qcow2_header(self.path))
+
+    def test_read_header_short_file(self):
+        with open(self.path, 'wb') as f:
+            f.write(libvirt_utils.QCOW2_MAGIC)
+        self.assertIsNone(libvirt_utils.read_qcow2_header(self.path))
+
+    def test_has_data(self):
+        self._write_image(l1_entries=(0, 0x8000000000050000))
+        self.assertTrue(libvirt_utils.qcow2_has_data(self.path))
+
+    def test_has_no_data(self):
+        self._write_image(backing_file='/inst/disk')
+        self.assertFalse(libvirt_utils.qcow2_has_data(self.path))
+
+    def test_has_data_not_qcow2(self):
+        self._write_image(magic=b'RAW\0')
+        self.assertRaises(exception.NovaException,
+                          libvirt_utils.qcow2_has_data, self.path)
+
+
+class CommitImageTestCase(test.NoDBTestCase):
+    def setUp(self):
+        super(CommitImageTestCase, self).setUp()
+        self.addCleanup(setattr, libvirt_utils,
+                        '_qemu_img_commit_rate_limit', None)
+        libvirt_utils._qemu_img_commit_rate_limit = None
+
+    @mock.patch('nova.utils.execute')
+    def test_supports_rate_limit(self, mock_execute):
+        mock_execute.return_value = (
+            'Command syntax:\n'
+            '  check [-q] [-f fmt] filename\n'
+            '  commit [-q] [-f fmt] [-t cache] [-b base] [-r rate_limit] '
+            '[-d] [-p] filename\n', '')
+        self.assertTrue(libvirt_utils.qemu_img_commit_supports_rate_limit())
+        self.assertTrue(libvirt_utils.qemu_img_commit_supports_rate_limit())
+        mock_execute.assert_called_once_with('qemu-img', '--help',
+                                             check_exit_code=False)
+
+    @mock.patch('nova.utils.execute')
+    def test_does_not_support_rate_limit(self, mock_execute):
+        mock_execute.return_value = (
+            'Command syntax:\n'
+            '  commit [-q] [-f fmt] [-t cache] filename\n'
+            '  convert [-r rate_limit] filename\n', '')
+        self.assertFalse(libvirt_utils.qemu_img_commit_supports_rate_limit())
+
+    @mock.patch.object(libvirt_utils, 'execute_with_progress')
+    @mock.patch.object(libvirt_utils, 'qemu_img_commit_supports_rate_limit',
+                       return_value=True)
+    def test_commit_image(self, mock_supported, mock_execute):
+        callback = mock.Mock()
+        libvirt_utils.commit_image('/inst/disk3', '/inst/disk', cache='none',
+                                   rate_limit=1048576,
+                                   progress_callback=callback)
+        mock_execute.assert_called_once_with(
+            'qemu-img', 'commit', '-f', 'qcow2', '-p', '-t', 'none', '-r',
+            '1048576', '-b', '/inst/disk', '/inst/disk3',
+            progress_callback=callback, run_as_root=True)
+
+    @mock.patch.object(libvirt_utils, 'execute_with_progress')
+    @mock.patch.object(libvirt_utils, 'qemu_img_commit_supports_rate_limit',
+                       return_value=False)
+    def test_commit_image_without_rate_limit(self, mock_supported,
+                                             mock_execute):
+        libvirt_utils.commit_image('/inst/disk3', '/inst/disk',
+                                   rate_limit=1048576)
+        mock_execute.assert_called_once_with(
+            'qemu-img', 'commit', '-f', 'qcow2', '-p', '-b', '/inst/disk',
+            '/inst/disk3', progress_callback=None, run_as_root=True)
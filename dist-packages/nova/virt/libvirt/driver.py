@@ -36,8 +36,10 @@ import operator
 import os
 import shutil
 import tempfile
+import threading
 import time
 import uuid
+import weakref
 
 import eventlet
 from eventlet import greenthread
@@ -66,7 +68,11 @@ from nova.compute import power_state
 from nova.compute import task_states
 
 # Added by YuanruiFan. some task states for light_snapshot
+from nova.compute.light_snapshot import journal as light_journal
+from nova.compute.light_snapshot import native as light_native
+from nova.compute.light_snapshot import progress as light_progress
 from nova.compute.light_snapshot import snapshot_task_states
+from nova.compute.light_snapshot import unit_of_work as light_uow
 
 from nova.compute import utils as compute_utils
 from nova.compute import vm_mode
@@ -82,6 +88,7 @@ from nova import image
 from nova.network import model as network_model
 from nova import objects
 from nova.objects import fields
+from nova.objects import light_snapshot as light_snapshot_obj
 from nova.pci import manager as pci_manager
 from nova.pci import utils as pci_utils
 from nova import utils
@@ -275,7 +282,81 @@ libvirt_opts = [
                 default=[],
                 help='List of guid targets and ranges.'
                      'Syntax is guest-gid:host-gid:count'
-                     'Maximum of 5 allowed.')
+                     'Maximum of 5 allowed.'),
+    # Added by YuanruiFan. Options to transfer the light-snapshot store
+    # of an instance to another host.
+    cfg.IntOpt('light_snapshot_transfer_streams',
+               default=4,
+               help='Number of light-snapshot files transferred in parallel '
+                    'when the snapshots of an instance are copied to '
+                    'another host'),
+    cfg.BoolOpt('light_snapshot_transfer_compression',
+                default=False,
+                help='Compress the light-snapshot files transferred to '
+                     'another host'),
+    # Added by YuanruiFan. Options of the overlays created for light
+    # snapshots.
+    cfg.BoolOpt('light_snapshot_preprovision_overlay',
+                default=True,
+                help='Create the overlay of the next light snapshot of an '
+                     'instance ahead of time, and let libvirt reuse it, '
+                     'instead of having libvirt create it while the guest '
+                     'is paused'),
+    cfg.StrOpt('light_snapshot_overlay_cluster_size',
+               help='Cluster size of the light-snapshot overlays, e.g. '
+                    '"64K". The cluster size of the backing file is used '
+                    'if unset'),
+    cfg.BoolOpt('light_snapshot_overlay_lazy_refcounts',
+                default=False,
+                help='Create the light-snapshot overlays with lazy refcounts, '
+                     'which saves metadata writes. An overlay has to be '
+                     'repaired with "qemu-img check -r all" after a host '
+                     'crash'),
+    cfg.StrOpt('light_snapshot_overlay_preallocation',
+               default='off',
+               choices=('off', 'metadata'),
+               help='Preallocation mode of the light-snapshot overlays. '
+                    '"metadata" needs a QEMU which allows preallocation '
+                    'together with a backing file'),
+    # Added by YuanruiFan. Options to keep freed guest blocks out of the
+    # light-snapshot overlays.
+    cfg.BoolOpt('light_snapshot_fstrim',
+                default=False,
+                help='Trim the guest filesystems through the guest agent '
+                     'before taking a light snapshot, so that the blocks the '
+                     'guest has freed are not kept in the overlay that is '
+                     'committed or stored. Needs the guest agent'),
+    cfg.BoolOpt('light_snapshot_discard',
+                default=False,
+                help='Boot light-snapshot instances with discard="unmap" on '
+                     'the overlay of their root disk, so that the discards '
+                     'of the guest free clusters of the overlay'),
+    # Added by YuanruiFan. Options of the commits of the light snapshots of
+    # stopped instances, which are done with qemu-img.
+    cfg.StrOpt('light_snapshot_commit_cache',
+               default='writeback',
+               choices=('none', 'writeback', 'writethrough', 'directsync',
+                        'unsafe'),
+               help='Cache mode of qemu-img when it commits the light '
+                    'snapshots of a stopped instance. "none" keeps the '
+                    'merge out of the host page cache'),
+    cfg.IntOpt('light_snapshot_commit_workers',
+               default=2,
+               help='Maximum number of light-snapshot commits of stopped '
+                    'instances run at the same time on the host'),
+    cfg.IntOpt('light_snapshot_commit_bandwidth',
+               default=0,
+               help='I/O limit in MB/s of each light-snapshot commit of a '
+                    'stopped instance, applied when qemu-img supports it. '
+                    'The commits of the host use at most '
+                    'light_snapshot_commit_workers times this value. 0 '
+                    'means unlimited'),
+    cfg.FloatOpt('light_snapshot_state_cache_ttl',
+                 default=2.0,
+                 help='Number of seconds the power states of the domains '
+                      'read to list the running instances of a light-'
+                      'snapshot sweep are cached. They are read for all the '
+                      'domains of the host at once'),
     ]
 
 CONF = cfg.CONF
@@ -307,6 +388,7 @@ CONF.import_opt('iscsi_use_multipath', 'nova.virt.libvirt.volume.iscsi',
 # Added by YuanruiFan. We want to add this opt to tell the 
 # system whether we want to use light-snapshot system
 CONF.import_opt('light_snapshot_enabled', 'nova.compute.manager')
+CONF.import_opt('light_snapshot_migrate_mode', 'nova.compute.manager')
 
 DEFAULT_FIREWALL_DRIVER = "%s.%s" % (
     libvirt_firewall.__name__,
@@ -435,6 +517,38 @@ MIN_QEMU_S390_VERSION = (2, 3, 0)
 # Names of the types that do not get compressed during migration
 NO_COMPRESSION_TYPES = ('qcow2',)
 
+# Added by YuanruiFan. Suffix of the directory the lower layers of a
+# light-snapshot chain are staged in before a block live migration.
+LIGHT_SNAPSHOT_STAGED_SUFFIX = '_light_staged'
+
+# Added by YuanruiFan. System metadata key recording the top overlay of
+# the light-snapshot chain a resize or cold migration carried, or '' when
+# the snapshots were committed into the root disk first.
+LIGHT_SNAPSHOT_MIGRATED_TOP = 'light_snapshot_migrated_top'
+
+# Added by YuanruiFan. Name of the overlay pre-created for the next light
+# snapshot of an instance.
+LIGHT_SNAPSHOT_NEXT_OVERLAY = 'disk.next'
+
+# Added by YuanruiFan. Block job type of a commit of the active layer,
+# missing from older libvirt bindings.
+VIR_DOMAIN_BLOCK_JOB_TYPE_ACTIVE_COMMIT = 4
+
+# Added by YuanruiFan. Statistics group of getAllDomainStats holding the
+# state of the domains, missing from older libvirt bindings.
+VIR_DOMAIN_STATS_STATE = 1
+
+
+# Added by YuanruiFan. Run a light-snapshot operation of the driver under
+# the lock of its instance. Operations on different instances run in
+# parallel.
+def light_snapshot_locked(function):
+    @functools.wraps(function)
+    def decorated_function(self, context, instance, *args, **kwargs):
+        with self._light_snapshot_lock(instance.uuid):
+            return function(self, context, instance, *args, **kwargs)
+    return decorated_function
+
 
 class LibvirtDriver(driver.ComputeDriver):
     capabilities = {
@@ -508,6 +622,56 @@ class LibvirtDriver(driver.ComputeDriver):
         self.job_tracker = instancejobtracker.InstanceJobTracker()
         self._remotefs = remotefs.RemoteFilesystem()
 
+        # Added by YuanruiFan. Bounds the qemu-img commits of stopped
+        # instances running at the same time.
+        self._offline_commit_semaphore = eventlet.semaphore.Semaphore(
+            max(CONF.libvirt.light_snapshot_commit_workers, 1))
+
+        # Added by YuanruiFan. Locks of the light-snapshot operations, one
+        # per instance and one per snapshots directory.
+        self._light_snapshot_locks = weakref.WeakValueDictionary()
+
+        # Added by YuanruiFan. Time and power states of the last read of
+        # the states of all the domains, see _get_domain_power_states.
+        self._domain_power_states = None
+
+        # Added by YuanruiFan. Set while the host initializes, see
+        # deferred_light_snapshot_init.
+        self._light_snapshot_init_deferred = False
+
+    # Added by YuanruiFan. The locks are reentrant, since an operation
+    # calls other operations taking the same lock, and are dropped once
+    # nobody holds them.
+    @contextlib.contextmanager
+    def _light_snapshot_lock(self, name):
+        lock = self._light_snapshot_locks.get(name)
+        if lock is None:
+            lock = threading.RLock()
+            self._light_snapshot_locks[name] = lock
+        with lock:
+            yield
+
+    def _light_snapshot_store_lock(self, instance):
+        return self._light_snapshot_lock(instance.uuid + '-snapshots')
+
+    # Added by YuanruiFan. While the host initializes, the domains started
+    # again do not initialize their light-snapshot chain inline. The
+    # compute manager queues them and initializes them in the background
+    # afterwards, see ComputeManager._reconcile_light_snapshot_chains.
+    @contextlib.contextmanager
+    def deferred_light_snapshot_init(self):
+        self._light_snapshot_init_deferred = True
+        try:
+            yield
+        finally:
+            self._light_snapshot_init_deferred = False
+
+    # Added by YuanruiFan. Return the guest of an instance whose libvirt
+    # calls run in native threads, see nova.compute.light_snapshot.native.
+    def _get_light_snapshot_guest(self, instance):
+        guest = self._host.get_guest(instance)
+        return libvirt_guest.Guest(light_native.NativeProxy(guest._domain))
+
     def _get_volume_drivers(self):
         return libvirt_volume_drivers
 
@@ -669,6 +833,54 @@ class LibvirtDriver(driver.ComputeDriver):
 
         return uuids
 
+    # Added by YuanruiFan. List the running instances of the host from the
+    # power states of all its domains.
+    def list_running_instance_uuids(self):
+        return [uuid for uuid, state in
+                self._get_domain_power_states().items()
+                if state == power_state.RUNNING]
+
+    # Added by YuanruiFan. Read the power states of all the domains of the
+    # host with one getAllDomainStats call, or one listAllDomains call per
+    # state when the binding lacks it. They are cached for
+    # light_snapshot_state_cache_ttl seconds, so a sweep over many
+    # instances does not ask libvirt for each of them.
+    def _get_domain_power_states(self):
+        now = time.time()
+        if (self._domain_power_states is not None and
+                now - self._domain_power_states[0] <
+                CONF.libvirt.light_snapshot_state_cache_ttl):
+            return self._domain_power_states[1]
+
+        conn = self._host.get_connection()
+        states = {}
+        get_all_domain_stats = getattr(conn, 'getAllDomainStats', None)
+        if get_all_domain_stats is not None:
+            for dom, stats in get_all_domain_stats(VIR_DOMAIN_STATS_STATE):
+                states[dom.UUIDString()] = libvirt_guest.LIBVIRT_POWER_STATE[
+                    stats['state.state']]
+        else:
+            for flag, state in (
+                    (libvirt.VIR_CONNECT_LIST_DOMAINS_RUNNING,
+                     power_state.RUNNING),
+                    (libvirt.VIR_CONNECT_LIST_DOMAINS_PAUSED,
+                     power_state.PAUSED),
+                    (libvirt.VIR_CONNECT_LIST_DOMAINS_SHUTOFF,
+                     power_state.SHUTDOWN)):
+                for dom in conn.listAllDomains(flag):
+                    states[dom.UUIDString()] = state
+
+        self._domain_power_states = (now, states)
+        return states
+
+    # Added by YuanruiFan. Power state of an instance for the light-snapshot
+    # operations. It chooses between blockCommit and qemu-img commit, so it
+    # is read from the domain itself and never from the cached states of
+    # _get_domain_power_states, which miss a start or stop of the last
+    # light_snapshot_state_cache_ttl seconds.
+    def _get_light_snapshot_power_state(self, instance, guest):
+        return guest.get_power_state(self._host)
+
     def plug_vifs(self, instance, network_info):
         """Plug VIFs into networks."""
         for vif in network_info:
@@ -1650,43 +1862,46 @@ class LibvirtDriver(driver.ComputeDriver):
 
     # Added by YuanruiFan. When user has created an instance, we call this function
     # to create two external snapshot for initialization
+    @light_snapshot_locked
     def store_snapshot_init(self, context, instance):
         """Store snapshot initialization.
 
            :param instance: VM instance object reference.
         """
-        try:
-            # First, Get the instance path and make 'snapshots' directory.
-            # If 'snapshots' directory exists, ignore it.
-            instance_path = libvirt_utils.get_instance_path(instance)
+        with self._light_snapshot_store_lock(instance):
+            try:
+                # First, Get the instance path and make 'snapshots' directory.
+                # If 'snapshots' directory exists, ignore it.
+                instance_path = libvirt_utils.get_instance_path(instance)
 
-            snapdir_path = os.path.join(instance_path, 'snapshots')
-            disk_path = os.path.join(instance_path, 'disk')
-            snapdisk_path = os.path.join(snapdir_path, 'disk')
+                snapdir_path = os.path.join(instance_path, 'snapshots')
+                disk_path = os.path.join(instance_path, 'disk')
+                snapdisk_path = os.path.join(snapdir_path, 'disk')
            
-            fileutils.ensure_tree(snapdir_path) 
-            if instance.root_index == None:
-                libvirt_utils.copy_image(disk_path, snapdisk_path)
-                utils.execute('qemu-img', 'rebase', '-f', 'qcow2', '-u',snapdisk_path)
-            else:
-                root_index = instance.root_index
-                root_snap_name = 'disk' + str(root_index)
-                root_snap_path = os.path.join(snapdir_path, root_snap_name)
-                if not os.path.exists(root_snap_path):
-                    libvirt_utils.copy_image(disk_path, root_snap_path)
-                    utils.execute('qemu-img', 'rebase', '-f', 'qcow2', '-u', root_snap_path) 
+                fileutils.ensure_tree(snapdir_path) 
+                if instance.root_index == None:
+                    libvirt_utils.copy_image(disk_path, snapdisk_path)
+                    libvirt_utils.execute('qemu-img', 'rebase', '-f', 'qcow2', '-u',snapdisk_path)
+                else:
+                    root_index = instance.root_index
+                    root_snap_name = 'disk' + str(root_index)
+                    root_snap_path = os.path.join(snapdir_path, root_snap_name)
+                    if not os.path.exists(root_snap_path):
+                        libvirt_utils.copy_image(disk_path, root_snap_path)
+                        libvirt_utils.execute('qemu-img', 'rebase', '-f', 'qcow2', '-u', root_snap_path) 
                         
-        except Exception:
-            with excutils.save_and_reraise_exception():
-                LOG.exception(_LE('Error occurred during '
-                                  'initializaing storing snapshot for instance.'),
-                              instance=instance)
+            except Exception:
+                with excutils.save_and_reraise_exception():
+                    LOG.exception(_LE('Error occurred during '
+                                      'initializaing storing snapshot for instance.'),
+                                  instance=instance)
 
 
 
 
     # Added by YuanruiFan. When user has created an instance, we call this function
     # to create two external snapshot for initialization
+    @light_snapshot_locked
     def light_snapshot_init(self, context, instance):
         """Do initialization for light-snapshot instance.
 
@@ -1695,7 +1910,7 @@ class LibvirtDriver(driver.ComputeDriver):
         LOG.debug(" create two light snapshots for VM.", instance = instance)
 
         try:
-            guest = self._host.get_guest(instance)
+            guest = self._get_light_snapshot_guest(instance)
          
             # TODO(sahid): We are converting all calls from a
             # virDomain object to use nova.virt.libvirt.Guest.
@@ -1720,12 +1935,13 @@ class LibvirtDriver(driver.ComputeDriver):
     # Added by Yuanrui Fan. This function will commit the snapshots to the
     # root disk of the instance and disable the light-snapshot system for 
     # the instance
+    @light_snapshot_locked
     def disable_light_snapshot(self, context, instance):
         
         LOG.debug("disable_light_snapshot", instance=instance)
 
         try:
-            guest = self._host.get_guest(instance)
+            guest = self._get_light_snapshot_guest(instance)
 
             # TODO(sahid): We are converting all calls from a
             # virDomain object to use nova.virt.libvirt.Guest.
@@ -1751,6 +1967,7 @@ class LibvirtDriver(driver.ComputeDriver):
 
     # Added by Yuanrui Fan. This function is used to create a light-snapshot
     # for the instance.
+    @light_snapshot_locked
     def light_snapshot(self, context, instance, update_task_state):
         """ Create snapshot from a running VM instance.
             We want to add the function of create external snapshot for vm
@@ -1762,7 +1979,7 @@ class LibvirtDriver(driver.ComputeDriver):
         LOG.debug("light_snapshot_instance", instance=instance)
         
         try:
-            guest = self._host.get_guest(instance)
+            guest = self._get_light_snapshot_guest(instance)
 
             # TODO(sahid): We are converting all calls from a
             # virDomain object to use nova.virt.libvirt.Guest.
@@ -1772,6 +1989,11 @@ class LibvirtDriver(driver.ComputeDriver):
             raise exception.InstanceNotRunning(instance_id=instance.uuid)
         
 
+        # Added by YuanruiFan. The discards land in the active overlay,
+        # which becomes read-only with this snapshot.
+        if CONF.libvirt.light_snapshot_fstrim:
+            self._trim_light_snapshot_guest(instance, guest)
+
         try:
             self._create_external_snapshot(context, instance, virt_dom)
         
@@ -1793,8 +2015,118 @@ class LibvirtDriver(driver.ComputeDriver):
 
 
 
+    # Added by YuanruiFan. Trim the filesystems of a light-snapshot guest.
+    # A guest without agent only keeps its freed blocks.
+    def _trim_light_snapshot_guest(self, instance, guest):
+        try:
+            guest.trim_filesystems()
+        except NotImplementedError:
+            LOG.warning(_LW('The libvirt binding does not support fsTrim, '
+                            'the guest filesystems are not trimmed'),
+                        instance=instance)
+        except libvirt.libvirtError as e:
+            LOG.warning(_LW('Failed to trim the guest filesystems: %s'), e,
+                        instance=instance)
+
+    # Added by YuanruiFan. Tell whether nothing has been written to the
+    # top overlay of an instance since its last light snapshot, so that
+    # taking another one would only add an identical layer.
+    def light_snapshot_is_empty(self, instance):
+        try:
+            guest = self._get_light_snapshot_guest(instance)
+        except exception.InstanceNotFound:
+            raise exception.InstanceNotRunning(instance_id=instance.uuid)
+
+        disk_path, source_format = libvirt_utils.find_disk(guest._domain)
+        index = libvirt_utils.get_light_snapshot_index(disk_path)
+        if index is None or index < 0:
+            return False
+        # A preallocated overlay always looks written.
+        if CONF.libvirt.light_snapshot_overlay_preallocation != 'off':
+            return False
+        return not libvirt_utils.qcow2_has_data(disk_path)
+
+    # Added by YuanruiFan. Compare the light-snapshot chain of an instance
+    # with the database when the compute service starts. Only the headers
+    # of the images are read, so that the check stays cheap.
+    def check_light_snapshot_chain(self, instance):
+        """Check the light-snapshot chain of an instance.
+
+           :returns: dict of the instance fields which do not match the
+                     chain, with the values found on disk
+           :raises: NovaException if a layer of the chain is missing
+        """
+        try:
+            guest = self._get_light_snapshot_guest(instance)
+            disk_path, source_format = libvirt_utils.find_disk(guest._domain)
+        except exception.InstanceNotFound:
+            disk_path = (self._find_light_snapshot_top(instance) or
+                         os.path.join(libvirt_utils.get_instance_path(instance),
+                                      'disk'))
+
+        top_index = libvirt_utils.get_light_snapshot_index(disk_path)
+        if top_index is None:
+            return {}
+
+        path = disk_path
+        index = top_index
+        while index is not None and index >= 0:
+            header = None
+            if os.path.exists(path):
+                header = libvirt_utils.read_qcow2_header(path)
+            if header is None or not header['backing_file']:
+                msg = (_('The light-snapshot layer %s is missing or has no '
+                         'backing file.') % path)
+                raise exception.NovaException(msg)
+            path = os.path.join(os.path.dirname(path),
+                                header['backing_file'])
+            index = libvirt_utils.get_light_snapshot_index(path)
+
+        if index is None or not os.path.exists(path):
+            msg = (_('The light-snapshot chain of %s does not end with the '
+                     'root disk.') % disk_path)
+            raise exception.NovaException(msg)
+
+        if instance.snapshot_store and instance.root_index is not None:
+            root_snap_path = os.path.join(os.path.dirname(disk_path),
+                                          'snapshots',
+                                          'disk%d' % instance.root_index)
+            if not os.path.exists(root_snap_path):
+                LOG.warning(_LW('The stored snapshot %s is missing'),
+                            root_snap_path, instance=instance)
+
+        updates = {}
+        if top_index < 0:
+            if not instance.snapshot_committed:
+                updates['snapshot_committed'] = True
+        else:
+            if instance.snapshot_committed:
+                updates['snapshot_committed'] = False
+            if instance.snapshot_index != top_index:
+                updates['snapshot_index'] = top_index
+        return updates
+
+    # Added by YuanruiFan. Sample the writes of an instance to its root disk
+    # and the size of its current light-snapshot overlay.
+    def get_light_snapshot_write_stats(self, instance):
+        """Return the bytes written by the instance since its domain
+           started, and the bytes allocated by its top overlay.
+        """
+        try:
+            guest = self._get_light_snapshot_guest(instance)
+        except exception.InstanceNotFound:
+            raise exception.InstanceNotRunning(instance_id=instance.uuid)
+
+        domain = guest._domain
+        disk_path, source_format = libvirt_utils.find_disk(domain)
+        stats = domain.blockStats(disk_path)
+        capacity, allocation, physical = domain.blockInfo(disk_path, 0)
+        return {'wr_bytes': stats[3],
+                'allocation': allocation}
+
     # Added by YuanruiFan. This function will call the libvirt api for 
     # creating external snapshot for an instance
+    @light_snapshot_locked
     def _create_external_snapshot(self, context, instance, domain, write_log=True):
         """
            Create an external snapshot for an instance.
@@ -1815,13 +2147,6 @@ class LibvirtDriver(driver.ComputeDriver):
 
         disks_to_snap = []          # to be snapshotted by libvirt
 
-        # Get the snapshot index from database
-        snapshot_index = instance.snapshot_index
-        if (snapshot_index is None):
-            snapshot_index = 0
-        else:
-            snapshot_index += 1
-
         for guest_disk in device_info.devices:
             if (guest_disk.root_name != 'disk'):
                 continue
@@ -1846,9 +2171,7 @@ class LibvirtDriver(driver.ComputeDriver):
 
             if len(current_filename) >= 4 and current_filename[0:4] == 'disk' \
                 and ((current_filename[4:].isdigit()) or current_filename[4:] == ''):
-                new_filename = 'disk' + str(snapshot_index)
-                new_file_path = os.path.join(os.path.dirname(current_file), new_filename)
-                disks_to_snap.append((current_file, new_file_path))
+                disks_to_snap.append(current_file)
             else:
                 msg = _('Unknown disk name for instance. Cannot light snapshot this disk.')
                 raise exception.NovaException(msg)
@@ -1857,6 +2180,31 @@ class LibvirtDriver(driver.ComputeDriver):
             msg = _('Found no disk to create external snapshot.')
             raise exception.NovaException(msg)
 
+        # Added by YuanruiFan. Reserve the snapshot index in the database,
+        # so that no other operation can take the same disk file. It is
+        # given back if the snapshot fails, unless another index has been
+        # reserved since.
+        previous_index = instance.snapshot_index
+        first_index, snapshot_index = instance.allocate_snapshot_indexes()
+        new_filename = 'disk' + str(snapshot_index)
+        disks_to_snap = [(path,
+                          os.path.join(os.path.dirname(path), new_filename))
+                         for path in disks_to_snap]
+
+        # Added by YuanruiFan. Put the overlays in place before the guest
+        # is paused, so that libvirt only has to open them.
+        reuse_overlay = CONF.libvirt.light_snapshot_preprovision_overlay
+        if reuse_overlay:
+            try:
+                for current_name, new_filename in disks_to_snap:
+                    self._provide_light_snapshot_overlay(instance,
+                                                         current_name,
+                                                         new_filename)
+            except Exception:
+                with excutils.save_and_reraise_exception():
+                    instance.release_snapshot_index(snapshot_index,
+                                                    previous_index)
+
         snapshot = vconfig.LibvirtConfigGuestSnapshot()
 
         for current_name, new_filename in disks_to_snap:
@@ -1880,6 +2228,8 @@ class LibvirtDriver(driver.ComputeDriver):
 
         snap_flags = (libvirt.VIR_DOMAIN_SNAPSHOT_CREATE_DISK_ONLY |
                       libvirt.VIR_DOMAIN_SNAPSHOT_CREATE_NO_METADATA)
+        if reuse_overlay:
+            snap_flags |= libvirt.VIR_DOMAIN_SNAPSHOT_CREATE_REUSE_EXT
 
         try:
             domain.snapshotCreateXML(snapshot_xml, snap_flags)
@@ -1887,7 +2237,11 @@ class LibvirtDriver(driver.ComputeDriver):
             LOG.exception(_LE('Unable to create VM snapshot, '
                               'failing creating external snapshot for instance.'),
                           instance=instance)
+            if reuse_overlay:
+                for current_name, new_filename in disks_to_snap:
+                    fileutils.delete_if_exists(new_filename)
 
+            instance.release_snapshot_index(snapshot_index, previous_index)
             raise
 
         if write_log:
@@ -1902,14 +2256,78 @@ class LibvirtDriver(driver.ComputeDriver):
                 fp.write('\n')
                 fp.close()
 
-        instance.snapshot_index = snapshot_index
-        instance.save()
         for current_name, new_filename in disks_to_snap:
-            utils.execute('chmod', '644', new_filename, run_as_root=True)
+            libvirt_utils.execute('chmod', '644', new_filename, run_as_root=True)
+
+        # Added by YuanruiFan. Record the snapshot in the history of the
+        # instance, under the index of the disk file it froze.
+        current_name = disks_to_snap[0][0]
+        try:
+            objects.LightSnapshot(
+                context, instance_uuid=instance.uuid,
+                snapshot_index=libvirt_utils.get_light_snapshot_index(
+                    current_name),
+                status=light_snapshot_obj.ACTIVE).create()
+        except Exception:
+            LOG.exception(_LE('Failed to record the light snapshot of '
+                              'instance.'), instance=instance)
+        instance.light_snapshot.snapshot_at = timeutils.utcnow()
+        light_uow.save(instance)
+
+        if reuse_overlay:
+            for current_name, new_filename in disks_to_snap:
+                self._preprovision_light_snapshot_overlay(instance,
+                                                          new_filename)
+
+    # Added by YuanruiFan. Create a light-snapshot overlay with the
+    # configured qcow2 options.
+    def _create_light_snapshot_overlay(self, backing_file, path):
+        libvirt_utils.create_light_snapshot_overlay(
+            backing_file, path,
+            cluster_size=CONF.libvirt.light_snapshot_overlay_cluster_size,
+            lazy_refcounts=CONF.libvirt.light_snapshot_overlay_lazy_refcounts,
+            preallocation=CONF.libvirt.light_snapshot_overlay_preallocation)
+
+    # Added by YuanruiFan. Pre-create the overlay of the next light snapshot
+    # of an instance on top of its current top overlay. A failure only
+    # means the next snapshot creates its overlay itself.
+    def _preprovision_light_snapshot_overlay(self, instance, top_path):
+        next_path = os.path.join(os.path.dirname(top_path),
+                                 LIGHT_SNAPSHOT_NEXT_OVERLAY)
+        tmp_path = next_path + '.tmp'
+        try:
+            fileutils.delete_if_exists(next_path)
+            self._create_light_snapshot_overlay(top_path, tmp_path)
+            os.rename(tmp_path, next_path)
+        except Exception as e:
+            LOG.warning(_LW('Failed to pre-create the next light-snapshot '
+                            'overlay: %s'), e, instance=instance)
+            fileutils.delete_if_exists(tmp_path)
+
+    # Added by YuanruiFan. Put the overlay of a light snapshot of
+    # current_path in place at new_path. The pre-created overlay is used
+    # when it is still based on current_path, since a commit or a recover
+    # may have changed the top of the chain since it was made.
+    def _provide_light_snapshot_overlay(self, instance, current_path,
+                                        new_path):
+        next_path = os.path.join(os.path.dirname(current_path),
+                                 LIGHT_SNAPSHOT_NEXT_OVERLAY)
+        if os.path.exists(next_path):
+            backing_file = libvirt_utils.get_disk_backing_file(
+                next_path, basename=False)
+            if backing_file == current_path:
+                os.rename(next_path, new_path)
+                return
+            LOG.debug('Discarding the pre-created overlay based on %s',
+                      backing_file, instance=instance)
+            fileutils.delete_if_exists(next_path)
+
+        self._create_light_snapshot_overlay(current_path, new_path)
 
 
     # Added by Yuanrui Fan. This function is used to recover the instance from
     # its snapshot.
+    @light_snapshot_locked
     def recover_instance_from_snapshot(self, context, instance, network_info, block_device_info, 
                                        use_root=False, snap_index=None):
         """recover the instance from its last snapshot
@@ -1919,7 +2337,7 @@ class LibvirtDriver(driver.ComputeDriver):
         LOG.debug("light_snapshot_instance", instance=instance)
 
         try:
-            guest = self._host.get_guest(instance)
+            guest = self._get_light_snapshot_guest(instance)
 
             # TODO(sahid): We are converting all calls from a
             # virDomain object to use nova.virt.libvirt.Guest.
@@ -1971,9 +2389,6 @@ class LibvirtDriver(driver.ComputeDriver):
 
         if snap_index is not None:
             self.recover_from_snap_index(context, instance, snap_index)
-            instance.snapshot_committed = True 
-            instance.root_index = snap_index
-            instance.save()
             disk_path_del = [disk_path, src_back_path]
             self.post_commit(context, instance, disk_path_del, True)
             self._hard_reboot(context, instance, network_info, 
@@ -1987,23 +2402,23 @@ class LibvirtDriver(driver.ComputeDriver):
         if not use_root:
 
             if not instance.snapshot_store:
-                utils.execute('rm', '-rf', disk_path)
+                libvirt_utils.execute('rm', '-rf', disk_path)
             else:
                 snapdir_path = os.path.join(os.path.dirname(disk_path), 'snapshots')
                 back_filename = src_back_path.split('/')[-1]
                 snap_back_path = os.path.join(snapdir_path, back_filename)
                 if not os.path.exists(snap_back_path):
-                    utils.execute('cp', src_back_path, snap_back_path)
-                utils.execute('qemu-img', 'rebase', '-f', 'qcow2', '-u',
-                              '-b', snap_back_path, disk_path, run_as_root=True)
-                utils.execute('mv', disk_path, snapdir_path)
+                    libvirt_utils.execute('cp', src_back_path, snap_back_path)
+                libvirt_utils.execute('qemu-img', 'rebase', '-f', 'qcow2', '-u',
+                                      '-b', snap_back_path, disk_path, run_as_root=True)
+                libvirt_utils.execute('mv', disk_path, snapdir_path)
 
             # Finally launch the instance.
             self._create_domain(xml=xml) 
 
             # Create a new external snapshot for the instance
             try:
-                guest = self._host.get_guest(instance)
+                guest = self._get_light_snapshot_guest(instance)
                 virt_dom = guest._domain
             except exception.InstanceNotFound:
                 raise exception.InstanceNotRunning(instance_id=instance.uuid)
@@ -2025,6 +2440,7 @@ class LibvirtDriver(driver.ComputeDriver):
             self._hard_reboot(context, instance, network_info, 
                               block_device_info=block_device_info)
 
+    @light_snapshot_locked
     def recover_from_snap_index(self, context, instance, snap_index):
         instance_path = libvirt_utils.get_instance_path(instance)
 
@@ -2040,15 +2456,15 @@ class LibvirtDriver(driver.ComputeDriver):
             msg = _('cannot recover from a non-exist snapshot.')
             raise exception.NovaException(msg)
 
-        
-        utils.execute('qemu-img', 'convert', '-f', 'qcow2', '-O', 'qcow2', 
-                      recover_disk_path, out_path)       
 
-        utils.execute('qemu-img', 'rebase', '-f', 'qcow2', '-u',
-                      '-b', src_back_path, out_path)
-        
+        # Added by YuanruiFan. The steps are recorded in the journal of
+        # the instance before they run. Until the root disk is replaced,
+        # an interrupted recover is rolled back.
+        steps = [['convert', recover_disk_path, out_path],
+                 ['rebase', src_back_path, out_path],
+                 ['power_off']]
+        commit_point = len(steps)
 
-        self.power_off(instance)
         if instance.snapshot_store:
             root_index = instance.root_index
             if root_index is None:
@@ -2057,21 +2473,28 @@ class LibvirtDriver(driver.ComputeDriver):
                 root_filename = 'disk' + str(root_index)
             root_path = os.path.join(snapdir_path, root_filename)
             if not os.path.exists(root_path):
-                utils.execute('mv', disk_path, root_path)
-        utils.execute('mv', out_path, disk_path)
+                steps.append(['mv', disk_path, root_path])
+        steps.append(['mv', out_path, disk_path])
+        steps.append(['update', {'snapshot_committed': True,
+                                 'root_index': snap_index}])
+
+        self._run_light_snapshot_journal(instance, 'recover', steps,
+                                         commit_point=commit_point,
+                                         rollback=[['rm', out_path]])
 
             
 
     # Added by YuanruiFan. This function is used to commit the snapshot of
     # the instance and then create another external snapshot so that the 
     # 3-images chain for vm can be maintained
+    @light_snapshot_locked
     def commit_light_snapshot(self, context, instance):
         """commit the last snapshot to the root disk.
            then create another external snapshot.
         """
         
         try:
-            guest = self._host.get_guest(instance)
+            guest = self._get_light_snapshot_guest(instance)
 
             # TODO(sahid): We are converting all calls from a
             # virDomain object to use nova.virt.libvirt.Guest.
@@ -2083,7 +2506,7 @@ class LibvirtDriver(driver.ComputeDriver):
         # first commit the last snapshot
         self._commit_light_snapshot(context, instance, guest, virt_dom)
         
-        state = guest.get_power_state(self._host)
+        state = self._get_light_snapshot_power_state(instance, guest)
 
         # then create another external snapshot for the instance  
         if state == power_state.RUNNING or state == power_state.PAUSED:
@@ -2101,12 +2524,13 @@ class LibvirtDriver(driver.ComputeDriver):
     # to the root disk. This function will be called before
     # the instance is resized/migrated/live_migrated if the
     # instance is using our light-snapshot
+    @light_snapshot_locked
     def commit_all_snapshots(self, context, instance):
         """commit the all snapshots to the root disk.
         """
 
         try:
-            guest = self._host.get_guest(instance)
+            guest = self._get_light_snapshot_guest(instance)
 
             # TODO(sahid): We are converting all calls from a
             # virDomain object to use nova.virt.libvirt.Guest.
@@ -2157,7 +2581,7 @@ class LibvirtDriver(driver.ComputeDriver):
         disk_path_del.append(disk_path)
 
         # Get the top block device path to commit
-        state = guest.get_power_state(self._host)
+        state = self._get_light_snapshot_power_state(instance, guest)
         commit_top = disk_path
         if commit_all or (state != power_state.RUNNING and state != power_state.PAUSED):
             commit_top = current_disk_path
@@ -2216,10 +2640,13 @@ class LibvirtDriver(driver.ComputeDriver):
                     LOG.debug('blockCommit started successfully',
                                instance=instance)
 
-                while dev.wait_for_job(abort_on_error=True):
+                progress = light_progress.InstanceProgress(instance)
+                while dev.wait_for_job(abort_on_error=True,
+                                       progress_callback=progress.update):
                     LOG.debug('waiting for blockCommit job completion',
                               instance=instance)
                     time.sleep(0.5)
+                progress.finish()
 
 
                 if commit_all == False:
@@ -2241,13 +2668,12 @@ class LibvirtDriver(driver.ComputeDriver):
                             time.sleep(0.5)
 
                 # After commit, delete or move original snapshot. 
-                self.post_commit(context, instance, disk_path_del, commit_all)
-
-                instance.root_index = root_index
+                updates = {'root_index': root_index}
                 if commit_all:
-                    instance.snapshot_index += 1 
-                    instance.root_index = instance.snapshot_index 
-                instance.save()
+                    _first, next_index = instance.allocate_snapshot_indexes()
+                    updates = {'root_index': next_index}
+                self.post_commit(context, instance, disk_path_del, commit_all,
+                                 updates=updates)
 
         else:
             LOG.info(_LI("commit snapshot for instance that is not active."),
@@ -2257,25 +2683,33 @@ class LibvirtDriver(driver.ComputeDriver):
             # the contents of snapshot to the root disk but the files must have 'w'
             # mode for other users.
 
-            self._disk_commit(commit_top, commit_base)
-
-            self.post_commit(context, instance, disk_path_del, True)
-            instance.root_index = root_index + 1
-            instance.snapshot_index += 1
+            progress = light_progress.InstanceProgress(instance)
+            self._disk_commit(commit_top, commit_base,
+                              progress_callback=progress.update)
+            progress.finish()
 
             # After all snapshots committed, update the snaphsot state
-            instance.snapshot_committed = True
-            instance.save()
+            instance.allocate_snapshot_indexes()
+            self.post_commit(context, instance, disk_path_del, True,
+                             updates={'root_index': root_index + 1,
+                                      'snapshot_committed': True})
 
             LOG.info(_LI("commit snapshot successfully for instance that is not active."),
                          instance=instance)
 
     # Added by YuanruiFan. When commit ends, do post_commit
-    def post_commit(self, context, instance, disk_path_del, commit_all):
-        
+    @light_snapshot_locked
+    def post_commit(self, context, instance, disk_path_del, commit_all,
+                    updates=None):
+        """Delete or store the committed snapshots.
+
+           The steps are recorded in the journal of the instance before
+           they run, and updates are written to the instance at the end.
+        """
+        steps = []
         if not instance.snapshot_store:
             for path in disk_path_del:
-                utils.execute('rm', '-rf', path)
+                steps.append(['rm', path])
         else:
             # Get snapshots dir for instance.
             instance_path = libvirt_utils.get_instance_path(instance)
@@ -2294,17 +2728,15 @@ class LibvirtDriver(driver.ComputeDriver):
                         if not os.path.exists(disk_path):
                             msg = _("The base path of snapshot does not exist.")
                             raise exception.NovaException(msg)
-                        utils.execute('qemu-img', 'rebase', '-f', 'qcow2','-u',
-                                      '-b', disk_path, path, run_as_root=True) 
-                        utils.execute('mv', path, snap_disk_path)
+                        steps.append(['rebase', disk_path, path])
+                        steps.append(['mv', path, snap_disk_path])
                     else:
                         root_snap_path = os.path.join(snapdir_path, 'disk'+str(instance.root_index))
                         if not os.path.exists(root_snap_path):
                             msg = _("The base path of snapshot does not exist.") 
                             raise exception.NovaException(msg)
-                        utils.execute('qemu-img', 'rebase', '-f', 'qcow2', '-u',
-                                      '-b', root_snap_path, path, run_as_root=True)
-                        utils.execute('mv', path, snap_disk_path)
+                        steps.append(['rebase', root_snap_path, path])
+                        steps.append(['mv', path, snap_disk_path])
            
                     if commit_all:
                         i = disk_path_del.__len__() - 1 
@@ -2313,11 +2745,214 @@ class LibvirtDriver(driver.ComputeDriver):
                             filename = path.split('/')[-1]
                             base_path = snap_disk_path
                             snap_disk_path = os.path.join(snapdir_path, filename)
-                            utils.execute('qemu-img', 'rebase', '-f', 'qcow2', '-u',
-                                          '-b', base_path, path, run_as_root=True)
-                            utils.execute('mv', path, snap_disk_path)                            
+                            steps.append(['rebase', base_path, path])
+                            steps.append(['mv', path, snap_disk_path])
                             i -= 1
+
+        if updates:
+            steps.append(['update', updates])
+        self._run_light_snapshot_journal(instance, 'post_commit', steps)
+
+    # Added by YuanruiFan. Record the steps of a light-snapshot operation
+    # in the journal of the instance, then run them. An operation left
+    # unfinished by an earlier failure is replayed first.
+    def _run_light_snapshot_journal(self, instance, operation, steps,
+                                    commit_point=0, rollback=None):
+        instance_path = libvirt_utils.get_instance_path(instance)
+        handlers = self._get_light_snapshot_journal_handlers(instance)
+        with self._light_snapshot_store_lock(instance):
+            unfinished = light_journal.Journal.load(instance_path)
+            if unfinished is not None:
+                unfinished.recover(handlers)
+            journal = light_journal.Journal.begin(instance_path, operation,
+                                                  steps,
+                                                  commit_point=commit_point,
+                                                  rollback=rollback)
+            journal.run(handlers)
+
+    # Added by YuanruiFan. The steps of a journal may run again when it is
+    # replayed, so each of them checks whether it has already been done.
+    def _get_light_snapshot_journal_handlers(self, instance):
+        def _rm(path):
+            libvirt_utils.execute('rm', '-rf', path)
+
+        def _rebase(base, path):
+            if os.path.exists(path):
+                libvirt_utils.execute('qemu-img', 'rebase', '-f', 'qcow2',
+                                      '-u', '-b', base, path,
+                                      run_as_root=True)
+
+        def _mv(src, dest):
+            if os.path.exists(src):
+                libvirt_utils.execute('mv', src, dest)
+            elif not os.path.exists(dest):
+                msg = (_('Cannot move %(src)s to %(dest)s, neither of them '
+                         'exists.') % {'src': src, 'dest': dest})
+                raise exception.NovaException(msg)
+
+        def _convert(src, dest):
+            # Added by YuanruiFan. Report the progress of the convert to
+            # the instance.
+            progress = light_progress.InstanceProgress(instance)
+            libvirt_utils.execute_with_progress(
+                'qemu-img', 'convert', '-p', '-f', 'qcow2', '-O', 'qcow2',
+                src, dest, progress_callback=progress.update)
+            progress.finish()
+
+        def _power_off():
+            self.power_off(instance)
+            self._domain_power_states = None
+
+        def _update(updates):
+            for field, value in updates.items():
+                setattr(instance, field, value)
+            instance.save()
+            if updates.get('root_index') is not None:
+                objects.LightSnapshotList.mark_committed(
+                    nova_context.get_admin_context(), instance.uuid,
+                    updates['root_index'], stored=instance.snapshot_store)
+
+        return {'rm': _rm,
+                'rebase': _rebase,
+                'mv': _mv,
+                'convert': _convert,
+                'power_off': _power_off,
+                'update': _update}
+
+    # Added by YuanruiFan. Roll back or finish the light-snapshot operation
+    # of an instance interrupted by a restart of the compute service.
+    @light_snapshot_locked
+    def recover_light_snapshot_journal(self, context, instance):
+        """:returns: True if an interrupted operation was found"""
+        instance_path = libvirt_utils.get_instance_path(instance)
+        journal = light_journal.Journal.load(instance_path)
+        if journal is None:
+            return False
+
+        with self._light_snapshot_store_lock(instance):
+            journal.recover(
+                self._get_light_snapshot_journal_handlers(instance))
+        return True
  
+    # Added by YuanruiFan. A blockCommit keeps running in QEMU when
+    # nova-compute restarts in the middle of _commit_light_snapshot. Attach
+    # to the job again, pivot it if needed and finish the post_commit.
+    @light_snapshot_locked
+    def resume_light_snapshot_commit(self, context, instance):
+        """Finish a light-snapshot commit interrupted by a restart.
+
+           :returns: True if a commit was finished, False if there was
+                     nothing left to do
+        """
+        try:
+            guest = self._get_light_snapshot_guest(instance)
+        except exception.InstanceNotFound:
+            raise exception.InstanceNotRunning(instance_id=instance.uuid)
+
+        state = self._get_light_snapshot_power_state(instance, guest)
+        if state != power_state.RUNNING and state != power_state.PAUSED:
+            # qemu-img commit did not survive the restart. The chain is
+            # still valid, the commit only has to be requested again.
+            LOG.info(_LI("No block job to resume for instance that is "
+                         "not active."), instance=instance)
+            return False
+
+        disk_path, source_format = libvirt_utils.find_disk(guest._domain)
+
+        xml = guest.get_xml_desc()
+        xml_doc = etree.fromstring(xml)
+        device_info = vconfig.LibvirtConfigGuest()
+        device_info.parse_dom(xml_doc)
+
+        dev = None
+        for guest_disk in device_info.devices:
+            if (guest_disk.root_name != 'disk' or
+                    guest_disk.target_dev is None or
+                    guest_disk.serial is not None or
+                    guest_disk.source_path != disk_path):
+                continue
+            dev = guest.get_block_device(guest_disk.target_dev)
+            break
+
+        if dev is None:
+            msg = _('Unable to find the root disk of the instance.')
+            raise exception.NovaException(msg)
+
+        commit_all = False
+        status = dev.get_job_info()
+        if status and status.job in (libvirt.VIR_DOMAIN_BLOCK_JOB_TYPE_COMMIT,
+                                     VIR_DOMAIN_BLOCK_JOB_TYPE_ACTIVE_COMMIT):
+            commit_all = (status.job ==
+                          VIR_DOMAIN_BLOCK_JOB_TYPE_ACTIVE_COMMIT)
+            LOG.info(_LI("Resuming blockCommit job of instance."),
+                     instance=instance)
+
+            progress = light_progress.InstanceProgress(instance)
+            while dev.wait_for_job(abort_on_error=True,
+                                   progress_callback=progress.update):
+                LOG.debug('waiting for blockCommit job completion',
+                          instance=instance)
+                time.sleep(0.5)
+            progress.finish()
+
+            # A commit of the active layer has to be pivoted, the others
+            # end by themselves and the abort is then a no-op.
+            count = 0
+            while count < 5:
+                try:
+                    dev.abort_job(pivot=True)
+                    break
+                except Exception:
+                    if not commit_all:
+                        break
+                    count += 1
+                    time.sleep(0.5)
+
+            disk_path, source_format = libvirt_utils.find_disk(
+                guest._domain)
+
+        # The layers left in the instance directory which the domain no
+        # longer uses have been committed but not post-processed.
+        inst_base = os.path.dirname(disk_path)
+        top_name = os.path.basename(disk_path)
+        top_index = libvirt_utils.get_light_snapshot_index(top_name)
+        if top_index is None:
+            return False
+        if top_index < 0:
+            commit_all = True
+            top_index = None
+        chain = self._get_light_snapshot_chain(inst_base, top_name)
+        disk_path_del = []
+        for name in reversed(libvirt_utils.list_light_snapshot_files(
+                inst_base)):
+            index = libvirt_utils.get_light_snapshot_index(name)
+            if name in chain or index < 0:
+                continue
+            if top_index is not None and index > top_index:
+                continue
+            disk_path_del.append(os.path.join(inst_base, name))
+
+        if not disk_path_del:
+            return False
+
+        LOG.info(_LI("Finishing the commit of %(count)d light-snapshot "
+                     "layers of instance."), {'count': len(disk_path_del)},
+                 instance=instance)
+        root_index = libvirt_utils.get_light_snapshot_index(disk_path_del[0])
+        if not commit_all:
+            # Only the lowest overlay is committed by a partial commit.
+            disk_path_del = disk_path_del[-1:]
+            root_index = libvirt_utils.get_light_snapshot_index(
+                disk_path_del[0])
+
+        updates = {'root_index': root_index}
+        if commit_all:
+            _first, next_index = instance.allocate_snapshot_indexes()
+            updates = {'snapshot_committed': True,
+                       'root_index': next_index}
+        self.post_commit(context, instance, disk_path_del, commit_all,
+                         updates=updates)
+        return True
 
 
     # Added by Yuanrui Fan. This function is used to commonly commit from top 
@@ -2329,7 +2964,7 @@ class LibvirtDriver(driver.ComputeDriver):
            :param domain: VM that we want to commit the snapshot
         """
         try:
-            guest = self._host.get_guest(instance)
+            guest = self._get_light_snapshot_guest(instance)
 
             # TODO(sahid): We are converting all calls from a
             # virDomain object to use nova.virt.libvirt.Guest.
@@ -5165,6 +5800,12 @@ class LibvirtDriver(driver.ComputeDriver):
                                       disk_info, rescue, block_device_info,
                                       context)
 
+        discard = (CONF.libvirt.light_snapshot_discard and
+                   self._host.has_min_version(MIN_LIBVIRT_DISCARD_VERSION,
+                                              MIN_QEMU_DISCARD_VERSION,
+                                              host.HV_DRIVER_QEMU))
+
+        instance_dir = libvirt_utils.get_instance_path(instance)
         for guest_disk in conf.devices:
             if (guest_disk.root_name != 'disk'):
                 continue
@@ -5172,7 +5813,15 @@ class LibvirtDriver(driver.ComputeDriver):
             if (guest_disk.target_dev is None):
                 continue
 
+            # Only the root disk runs from the light-snapshot chain, the
+            # config drive, ephemeral, swap and volumes keep their source
+            # and their discard setting.
+            if not self._is_light_snapshot_root_disk(guest_disk,
+                                                     instance_dir):
+                continue
             guest_disk.source_path = disk_path
+            if discard:
+                guest_disk.driver_discard = 'unmap'
 
         xml = conf.to_xml()
 
@@ -5187,6 +5836,17 @@ class LibvirtDriver(driver.ComputeDriver):
 
         
 
+    # Added by YuanruiFan. Whether a guest disk is the root disk of the
+    # instance, i.e. runs from its 'disk' or 'disk<N>' file.
+    @staticmethod
+    def _is_light_snapshot_root_disk(guest_disk, instance_dir):
+        if guest_disk.source_type != 'file' or not guest_disk.source_path:
+            return False
+        path = os.path.normpath(guest_disk.source_path)
+        return (os.path.dirname(path) == os.path.normpath(instance_dir) and
+                libvirt_utils.get_light_snapshot_index(
+                    os.path.basename(path)) is not None)
+
     def _get_guest_xml(self, context, instance, network_info, disk_info,
                        image_meta, rescue=None,
                        block_device_info=None, write_to_disk=False):
@@ -5431,7 +6091,9 @@ class LibvirtDriver(driver.ComputeDriver):
         # Added by YuanruiFan. When using light-snapshot, but snapshots are
         # committed by users or during resize/migration/live_migration, we must
         # create initial two external snapshot for instance.
-        if (CONF.light_snapshot_enabled and instance.light_snapshot_enable and instance.snapshot_committed):
+        # This is left to the compute manager while the host initializes.
+        if (CONF.light_snapshot_enabled and instance.light_snapshot_enable and instance.snapshot_committed and
+                not self._light_snapshot_init_deferred):
             self.light_snapshot_init(context, instance)
             instance.snapshot_committed = False
             instance.save()
@@ -7085,6 +7747,14 @@ class LibvirtDriver(driver.ComputeDriver):
                       instance=instance)
             os.mkdir(instance_dir)
 
+            # Added by YuanruiFan. Move in the light-snapshot layers staged
+            # by the source host, if the root disk is still on its chain.
+            top_name = None
+            if disk_info:
+                top_name = self._get_light_snapshot_top_name(disk_info)
+            self._adopt_staged_light_snapshot_chain(instance, instance_dir,
+                                                    top_name)
+
             if not is_shared_block_storage:
                 # Ensure images and backing files are present.
                 LOG.debug('Checking to make sure images and backing files are '
@@ -7223,6 +7893,15 @@ class LibvirtDriver(driver.ComputeDriver):
                 # Creating backing file follows same way as spawning instances.
                 cache_name = os.path.basename(info['backing_file'])
 
+                # Added by YuanruiFan. The disk is the top overlay of a
+                # light-snapshot chain, its backing file has been staged.
+                if libvirt_utils.get_light_snapshot_index(cache_name) is not None:
+                    self._create_light_snapshot_top(context, instance,
+                                                    instance_dir, instance_disk,
+                                                    cache_name, info,
+                                                    fallback_from_host)
+                    continue
+
                 image = self.image_backend.image(instance,
                                                  instance_disk,
                                                  CONF.libvirt.images_type)
@@ -7254,6 +7933,33 @@ class LibvirtDriver(driver.ComputeDriver):
         self._fetch_instance_kernel_ramdisk(
             context, instance, fallback_from_host=fallback_from_host)
 
+    # Added by YuanruiFan. Create the top overlay of a light-snapshot chain
+    # whose lower layers have been staged in instance_dir. Only the image
+    # the root 'disk' is based on has to be fetched.
+    def _create_light_snapshot_top(self, context, instance, instance_dir,
+                                   instance_disk, backing_name, info,
+                                   fallback_from_host=None):
+        backing_path = os.path.join(instance_dir, backing_name)
+        if not os.path.exists(backing_path):
+            raise exception.NovaException(
+                _('Light-snapshot layer %s has not been staged on this '
+                  'host') % backing_name)
+        self._prune_light_snapshot_layers(instance_dir, backing_name)
+
+        root_disk = os.path.join(instance_dir, 'disk')
+        root_backing = libvirt_utils.get_disk_backing_file(root_disk)
+        if root_backing:
+            image = self.image_backend.image(instance, root_disk,
+                                             CONF.libvirt.images_type)
+            self._try_fetch_image_cache(image, libvirt_utils.fetch_image,
+                                        context, root_backing,
+                                        instance.image_ref, instance,
+                                        info['virt_disk_size'],
+                                        fallback_from_host)
+
+        if not os.path.exists(instance_disk):
+            libvirt_utils.create_cow_image(backing_path, instance_disk)
+
     def post_live_migration(self, context, instance, block_device_info,
                             migrate_data=None):
         # Disconnect from volume server
@@ -7316,11 +8022,9 @@ class LibvirtDriver(driver.ComputeDriver):
         disk_info = blockinfo.get_disk_info(
             CONF.libvirt.virt_type, instance,
             image_meta, block_device_info)
-        xml = self._get_guest_xml(context, instance,
-                                  network_info, disk_info,
-                                  image_meta,
-                                  block_device_info=block_device_info,
-                                  write_to_disk=True)
+        xml = self._get_light_snapshot_guest_xml(
+            context, instance, network_info, disk_info, image_meta,
+            block_device_info=block_device_info, write_to_disk=True)
         self._host.write_instance_config(xml)
 
     def _get_instance_disk_info(self, instance_name, xml,
@@ -7630,18 +8334,27 @@ class LibvirtDriver(driver.ComputeDriver):
                                              on_completion=on_completion,
                                              compression=compression)
 
-            # Added by YuanruiFan. copy the light-snapshots directory if it exists.
-            snapshots_dir = os.path.join(inst_base_resize, 'snapshots')
-            if os.path.exists(snapshots_dir):
-                from_path = snapshots_dir
-                img_path = inst_base
-                libvirt_utils.copy_dir(from_path, img_path, host=dest)
+            # Added by YuanruiFan. When the light-snapshot chain has been
+            # kept, the root disk is its top overlay. Copy the layers it
+            # is based on too. On another host they go to the staging
+            # directory, where a pre-stage may already have copied most of
+            # them, and finish_migration moves them in.
+            light_base = inst_base
+            if dest:
+                light_base = inst_base + LIGHT_SNAPSHOT_STAGED_SUFFIX
+            top_name = self._get_light_snapshot_top_name(disk_info)
+            instance.system_metadata[LIGHT_SNAPSHOT_MIGRATED_TOP] = (
+                top_name or '')
+            if top_name:
+                lower_names = self._get_light_snapshot_chain(
+                    inst_base_resize, top_name)[:-1]
+                self._copy_light_snapshot_layers(instance, inst_base_resize,
+                                                 light_base, lower_names,
+                                                 dest, update=True)
 
-            snapshot_log_path = os.path.join(inst_base_resize, 'snapshot.log')
-            if os.path.exists(snapshot_log_path):
-                from_path = snapshot_log_path
-                img_path = inst_base
-                libvirt_utils.copy_dir(from_path, img_path, host=dest) 
+            # Added by YuanruiFan. copy the light-snapshots directory if it exists.
+            self._copy_light_snapshot_store(instance, inst_base_resize,
+                                            light_base, dest)
              
         except Exception:
             with excutils.save_and_reraise_exception():
@@ -7651,6 +8364,198 @@ class LibvirtDriver(driver.ComputeDriver):
 
         return disk_info_text
 
+    # Added by YuanruiFan. Return the name of the top overlay of the
+    # light-snapshot chain in disk_info, or None if the root disk of the
+    # instance is 'disk' itself.
+    @staticmethod
+    def _get_light_snapshot_top_name(disk_info):
+        for info in disk_info:
+            fname = os.path.basename(info['path'])
+            index = libvirt_utils.get_light_snapshot_index(fname)
+            if index is not None and index >= 0:
+                return fname
+        return None
+
+    # Added by YuanruiFan. Return the names of the files of the light-snapshot
+    # chain ending at top_name in inst_base, root 'disk' first.
+    @staticmethod
+    def _get_light_snapshot_chain(inst_base, top_name):
+        chain = [top_name]
+        name = top_name
+        while name != 'disk':
+            name = libvirt_utils.get_disk_backing_file(
+                os.path.join(inst_base, name))
+            if (not name or
+                    libvirt_utils.get_light_snapshot_index(name) is None):
+                break
+            chain.insert(0, name)
+        return chain
+
+    # Added by YuanruiFan. Return the path of the top overlay of the kept
+    # light-snapshot chain of an instance, or None if the instance runs
+    # from 'disk'.
+    def _find_light_snapshot_top(self, instance):
+        if not (CONF.light_snapshot_enabled and
+                instance.light_snapshot_enable and
+                not instance.snapshot_committed and
+                instance.snapshot_index is not None):
+            return None
+
+        inst_base = libvirt_utils.get_instance_path(instance)
+        top_path = os.path.join(inst_base, 'disk%d' % instance.snapshot_index)
+        if not os.path.exists(top_path):
+            return None
+        return top_path
+
+    # Added by YuanruiFan. Build the guest xml of an instance, booting it
+    # from the top of its light-snapshot chain when the chain is kept.
+    def _get_light_snapshot_guest_xml(self, context, instance, network_info,
+                                      disk_info, image_meta,
+                                      block_device_info=None,
+                                      write_to_disk=False):
+        top_path = self._find_light_snapshot_top(instance)
+        if top_path:
+            return self._get_guest_xml_disk(
+                context, instance, network_info, disk_info, image_meta,
+                top_path, block_device_info=block_device_info,
+                write_to_disk=write_to_disk)
+        return self._get_guest_xml(context, instance, network_info,
+                                   disk_info, image_meta,
+                                   block_device_info=block_device_info,
+                                   write_to_disk=write_to_disk)
+
+    # Added by YuanruiFan. Copy light-snapshot layers of an instance from
+    # src_base to dest_base on host.
+    def _copy_light_snapshot_layers(self, instance, src_base, dest_base,
+                                    filenames, host, update=False):
+        on_execute = lambda process: self.job_tracker.add_job(
+            instance, process.pid)
+        on_completion = lambda process: self.job_tracker.\
+            remove_job(instance, process.pid)
+
+        libvirt_utils.copy_snapshot_files(
+            src_base, dest_base, filenames, host=host,
+            streams=CONF.libvirt.light_snapshot_transfer_streams,
+            compression=CONF.libvirt.light_snapshot_transfer_compression,
+            update=update, on_execute=on_execute,
+            on_completion=on_completion)
+
+    # Added by YuanruiFan. Stage the read-only lower layers of the
+    # light-snapshot chain of a running instance, and its stored snapshots,
+    # on dest. This is done before a block live migration, and ahead of a
+    # scheduled migration to pre-stage the chain while the instance keeps
+    # running; the layers already staged are only brought up to date.
+    # pre_live_migration or finish_migration on dest moves them into the
+    # instance directory, so only the top overlay is left to migrate. The
+    # lock keeps a commit from changing the chain during the copy.
+    @light_snapshot_locked
+    def stage_light_snapshot_chain(self, context, instance, dest):
+        guest = self._get_light_snapshot_guest(instance)
+        top_path, _format = libvirt_utils.find_disk(guest._domain)
+        top_name = os.path.basename(top_path)
+        index = libvirt_utils.get_light_snapshot_index(top_name)
+        if index is None or index < 0:
+            return
+
+        inst_base = libvirt_utils.get_instance_path(instance)
+        staged_base = inst_base + LIGHT_SNAPSHOT_STAGED_SUFFIX
+        lower_names = self._get_light_snapshot_chain(inst_base, top_name)[:-1]
+
+        LOG.debug('Staging light-snapshot layers %(names)s on %(dest)s',
+                  {'names': lower_names, 'dest': dest}, instance=instance)
+        # NOTE: rsync writes to a temporary file and renames it when done,
+        # so an interrupted copy never leaves a partial layer behind.
+        self._copy_light_snapshot_layers(instance, inst_base, staged_base,
+                                         lower_names, dest, update=True)
+        self._copy_light_snapshot_store(instance, inst_base, staged_base,
+                                        dest)
+
+    # Added by YuanruiFan. Remove the light-snapshot layers staged on dest.
+    def unstage_light_snapshot_chain(self, instance, dest):
+        inst_base = libvirt_utils.get_instance_path(instance)
+        self._remotefs.remove_dir(dest,
+                                  inst_base + LIGHT_SNAPSHOT_STAGED_SUFFIX)
+
+    # Added by YuanruiFan. Remove the light-snapshot layers of instance_dir
+    # which are not part of the chain ending at top_name. A layer staged
+    # long before the migration may have been committed since.
+    @staticmethod
+    def _prune_light_snapshot_layers(instance_dir, top_name):
+        chain = LibvirtDriver._get_light_snapshot_chain(instance_dir,
+                                                        top_name)
+        for name in libvirt_utils.list_light_snapshot_files(instance_dir):
+            if name not in chain:
+                os.unlink(os.path.join(instance_dir, name))
+
+    # Added by YuanruiFan. Move the light-snapshot layers staged by
+    # stage_light_snapshot_chain into instance_dir, then drop the staging
+    # directory. top_name is the top overlay the migration carried; the
+    # staged layers below it have just been synced. Without it the chain
+    # was committed and the staged layers are stale, so only the snapshot
+    # store is taken. A file already in instance_dir is never replaced.
+    def _adopt_staged_light_snapshot_chain(self, instance, instance_dir,
+                                           top_name):
+        staged_base = instance_dir + LIGHT_SNAPSHOT_STAGED_SUFFIX
+        if not os.path.exists(staged_base):
+            return
+
+        top_index = None
+        if top_name:
+            top_index = libvirt_utils.get_light_snapshot_index(top_name)
+
+        LOG.debug('Adopting staged light-snapshot layers from %s',
+                  staged_base, instance=instance)
+        for name in os.listdir(staged_base):
+            index = libvirt_utils.get_light_snapshot_index(name)
+            if index is not None and (top_index is None or
+                                      index >= top_index):
+                continue
+            dest_path = os.path.join(instance_dir, name)
+            if os.path.lexists(dest_path):
+                LOG.debug('Not replacing %s with its staged copy',
+                          dest_path, instance=instance)
+                continue
+            os.rename(os.path.join(staged_base, name), dest_path)
+        shutil.rmtree(staged_base)
+
+    # Added by YuanruiFan. Copy the stored snapshots and the snapshot log
+    # of an instance to dest_base on host.
+    def _copy_light_snapshot_store(self, instance, src_base, dest_base, host):
+        on_execute = lambda process: self.job_tracker.add_job(
+            instance, process.pid)
+        on_completion = lambda process: self.job_tracker.\
+            remove_job(instance, process.pid)
+
+        snapshots_dir = os.path.join(src_base, 'snapshots')
+        with self._light_snapshot_store_lock(instance):
+            if os.path.exists(snapshots_dir):
+                dest_snapshots_dir = os.path.join(dest_base, 'snapshots')
+                # The snapshot files go first along the chain, followed by
+                # any other file of the store, which copy_dir copied too.
+                filenames = libvirt_utils.list_light_snapshot_files(
+                    snapshots_dir)
+                subdirs = []
+                for name in sorted(os.listdir(snapshots_dir)):
+                    if name in filenames:
+                        continue
+                    if os.path.isdir(os.path.join(snapshots_dir, name)):
+                        subdirs.append(name)
+                    else:
+                        filenames.append(name)
+                self._copy_light_snapshot_layers(
+                    instance, snapshots_dir, dest_snapshots_dir, filenames,
+                    host)
+                for name in subdirs:
+                    libvirt_utils.copy_dir(os.path.join(snapshots_dir, name),
+                                           dest_snapshots_dir, host=host)
+
+            # The snapshot log is appended to, so it is always sent again.
+            snapshot_log_path = os.path.join(src_base, 'snapshot.log')
+            if os.path.exists(snapshot_log_path):
+                libvirt_utils.copy_image(snapshot_log_path, dest_base,
+                                         host=host, on_execute=on_execute,
+                                         on_completion=on_completion)
+
     def _wait_for_running(self, instance):
         state = self.get_info(instance).state
 
@@ -7697,10 +8602,18 @@ class LibvirtDriver(driver.ComputeDriver):
     # suspending or shutdown, we must use qemu-img commit
     # to do the same thing of blockCommit.
     # The format of image must be qcow2.
-    @staticmethod
-    def _disk_commit(top_path, base_path):
-        utils.execute('qemu-img', 'commit', '-f', 'qcow2',
-                      '-b', base_path, top_path,run_as_root=True)
+    # At most light_snapshot_commit_workers commits run at once, each
+    # limited to light_snapshot_commit_bandwidth. The limit of qemu-img is
+    # fixed when it starts, so it is not shared out among the commits
+    # running.
+    def _disk_commit(self, top_path, base_path, progress_callback=None):
+        rate_limit = CONF.libvirt.light_snapshot_commit_bandwidth * units.Mi
+        with self._offline_commit_semaphore:
+            libvirt_utils.commit_image(
+                top_path, base_path,
+                cache=CONF.libvirt.light_snapshot_commit_cache,
+                rate_limit=rate_limit,
+                progress_callback=progress_callback)
 
     def _disk_resize(self, image, size):
         """Attempts to resize a disk to size
@@ -7755,6 +8668,16 @@ class LibvirtDriver(driver.ComputeDriver):
             if info['type'] == 'raw' and CONF.use_cow_images:
                 self._disk_raw_to_qcow2(info['path'])
 
+        # Added by YuanruiFan. Move in the light-snapshot layers copied
+        # to the staging directory by migrate_disk_and_power_off.
+        inst_base = libvirt_utils.get_instance_path(instance)
+        self._adopt_staged_light_snapshot_chain(
+            instance, inst_base, self._get_light_snapshot_top_name(disk_info))
+        top_path = self._find_light_snapshot_top(instance)
+        if top_path:
+            self._prune_light_snapshot_layers(inst_base,
+                                              os.path.basename(top_path))
+
         disk_info = blockinfo.get_disk_info(CONF.libvirt.virt_type,
                                             instance,
                                             image_meta,
@@ -7764,10 +8687,11 @@ class LibvirtDriver(driver.ComputeDriver):
                            network_info=network_info,
                            block_device_info=None, inject_files=False,
                            fallback_from_host=migration.source_compute)
-        xml = self._get_guest_xml(context, instance, network_info, disk_info,
-                                  image_meta,
-                                  block_device_info=block_device_info,
-                                  write_to_disk=True)
+        # Added by YuanruiFan. Boot from the top of the light-snapshot chain
+        # if it has been carried.
+        xml = self._get_light_snapshot_guest_xml(
+            context, instance, network_info, disk_info, image_meta,
+            block_device_info=block_device_info, write_to_disk=True)
         # NOTE(mriedem): vifs_already_plugged=True here, regardless of whether
         # or not we've migrated to another host, because we unplug VIFs locally
         # and the status change in the port might go undetected by the neutron
@@ -7801,10 +8725,25 @@ class LibvirtDriver(driver.ComputeDriver):
         LOG.debug("Starting finish_revert_migration",
                   instance=instance)
 
-        # Added by YuanruiFan. If the user revert, but the snapshots are
-        # committed. So update the committed.
-        instance.snapshot_committed = True
-        instance.save()        
+        # Added by YuanruiFan. Go back to what the migration did with the
+        # light-snapshot chain here: the chain it carried is still on this
+        # host, otherwise the snapshots were committed into the root disk.
+        # Snapshots taken on the destination meanwhile are gone with it.
+        if CONF.light_snapshot_enabled and instance.light_snapshot_enable:
+            top_name = instance.system_metadata.pop(
+                LIGHT_SNAPSHOT_MIGRATED_TOP, None)
+            if top_name is None:
+                # Migrated before the carried chain was recorded.
+                kept = CONF.light_snapshot_migrate_mode == 'chain'
+            else:
+                kept = bool(top_name)
+            if not kept:
+                instance.snapshot_committed = True
+            elif top_name:
+                instance.snapshot_committed = False
+                instance.snapshot_index = (
+                    libvirt_utils.get_light_snapshot_index(top_name))
+            instance.save()
 
         inst_base = libvirt_utils.get_instance_path(instance)
         inst_base_resize = inst_base + "_resize"
@@ -7842,9 +8781,9 @@ class LibvirtDriver(driver.ComputeDriver):
                                             instance,
                                             image_meta,
                                             block_device_info)
-        xml = self._get_guest_xml(context, instance, network_info, disk_info,
-                                  image_meta,
-                                  block_device_info=block_device_info)
+        xml = self._get_light_snapshot_guest_xml(
+            context, instance, network_info, disk_info, image_meta,
+            block_device_info=block_device_info)
         self._create_domain_and_network(context, xml, instance, network_info,
                                         disk_info,
                                         block_device_info=block_device_info,
@@ -7863,6 +8802,11 @@ class LibvirtDriver(driver.ComputeDriver):
     def confirm_migration(self, migration, instance, network_info):
         """Confirms a resize, destroying the source VM."""
         self._cleanup_resize(instance, network_info)
+        # Added by YuanruiFan. The carried chain top only matters to a
+        # revert, so drop it once the resize is confirmed.
+        if instance.system_metadata.pop(LIGHT_SNAPSHOT_MIGRATED_TOP,
+                                        None) is not None:
+            instance.save()
 
     @staticmethod
     def _get_io_devices(xml_doc):
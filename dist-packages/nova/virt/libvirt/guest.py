@@ -370,6 +370,20 @@ class Guest(object):
         """Configures a new user password."""
         self._domain.setUserPassword(user, new_pass, 0)
 
+    # Added by YuanruiFan.
+    def trim_filesystems(self, minimum=0):
+        """Discards the unused blocks of the guest filesystems.
+
+        Requires the guest agent to be running in the guest.
+
+        raises: libvirtError, NotImplementedError when the libvirt
+                binding does not provide fsTrim
+        """
+        fs_trim = getattr(self._domain, 'fsTrim', None)
+        if fs_trim is None:
+            raise NotImplementedError()
+        fs_trim(None, minimum, 0)
+
     def _get_domain_info(self, host):
         """Returns information on Guest
 
@@ -494,7 +508,8 @@ class BlockDevice(object):
         """Resizes block device to Kib size."""
         self._guest._domain.blockResize(self._disk, size_kb)
 
-    def wait_for_job(self, abort_on_error=False, wait_for_job_clean=False):
+    def wait_for_job(self, abort_on_error=False, wait_for_job_clean=False,
+                     progress_callback=None):
         """Wait for libvirt block job to complete.
 
         Libvirt may return either cur==end or an empty dict when
@@ -505,6 +520,8 @@ class BlockDevice(object):
                                on error (default: False)
         :param wait_for_job_clean: Whether to force wait to ensure job is
                                    finished (see bug: LP#1119173)
+        :param progress_callback: Called with the 'cur' and 'end' positions
+                                  of the job
 
         :returns: True if still in progress
                   False if completed
@@ -514,6 +531,10 @@ class BlockDevice(object):
             msg = _('libvirt error while requesting blockjob info.')
             raise exception.NovaException(msg)
 
+        # Added by YuanruiFan. Report the progress of the job.
+        if status and progress_callback:
+            progress_callback(status.cur, status.end)
+
         if wait_for_job_clean:
             job_ended = status.job == 0
         else:
@@ -21,13 +21,19 @@
 import errno
 import os
 import re
+import shlex
+import struct
 
+import eventlet
+from eventlet.green import subprocess
 from lxml import etree
 from oslo_concurrency import processutils
 from oslo_config import cfg
 from oslo_log import log as logging
 
 from nova.compute import arch
+from nova.compute.light_snapshot import profiler as light_profiler
+from nova import exception
 from nova.i18n import _
 from nova.i18n import _LI
 from nova import utils
@@ -50,9 +56,133 @@ LOG = logging.getLogger(__name__)
 
 RESIZE_SNAPSHOT_NAME = 'nova-resize'
 
+# Added by YuanruiFan. qemu-img -p prints its progress as "(xx.xx/100%)".
+QEMU_IMG_PROGRESS_RE = re.compile(r'\((\d+(?:\.\d+)?)/100%\)')
+
+# Added by YuanruiFan. The files of a light-snapshot chain are named 'disk'
+# followed by their snapshot index.
+LIGHT_SNAPSHOT_FILE_RE = re.compile(r'^disk(\d*)$')
+
+# Added by YuanruiFan. Layout of the qcow2 header, common to versions 2
+# and 3.
+QCOW2_MAGIC = b'QFI\xfb'
+QCOW2_HEADER = struct.Struct('>4sIQIIQIIQQIIQ')
+QCOW2_HEADER_FIELDS = ('magic', 'version', 'backing_file_offset',
+                       'backing_file_size', 'cluster_bits', 'size',
+                       'crypt_method', 'l1_size', 'l1_table_offset',
+                       'refcount_table_offset', 'refcount_table_clusters',
+                       'nb_snapshots', 'snapshots_offset')
+
 
 def execute(*args, **kwargs):
-    return utils.execute(*args, **kwargs)
+    # Added by YuanruiFan. Commands run during a light-snapshot operation
+    # are accounted to its execute profile.
+    with light_profiler.timed(args, as_root=kwargs.get('run_as_root', False)):
+        return utils.execute(*args, **kwargs)
+
+
+# Added by YuanruiFan. Run a qemu-img command that reports its progress
+# with -p, so that long converts and commits can update the instance.
+def execute_with_progress(*cmd, **kwargs):
+    """Execute a qemu-img command and parse the progress it prints.
+
+    :param cmd: Passed to subprocess.Popen, must include '-p'
+    :param progress_callback: Called with (percent, 100) for every
+                              progress update printed by the command
+    :param run_as_root: True | False. Defaults to False.
+    :returns: (stdout, stderr) with the progress output stripped, stderr
+              is merged into stdout
+    """
+    progress_callback = kwargs.pop('progress_callback', None)
+    run_as_root = kwargs.pop('run_as_root', False)
+
+    cmd = [str(c) for c in cmd]
+    full_cmd = cmd
+    if run_as_root:
+        full_cmd = shlex.split(utils.get_root_helper()) + cmd
+
+    with light_profiler.timed(cmd, as_root=run_as_root):
+        LOG.debug('Running cmd (subprocess): %s', ' '.join(full_cmd))
+        # stderr goes to the same pipe, a separate one read only at the
+        # end could fill up and block the command.
+        proc = subprocess.Popen(full_cmd, stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT, close_fds=True)
+
+        output = []
+        line = ''
+        while True:
+            # qemu-img ends its progress lines with '\r', so read the
+            # output char by char instead of line by line.
+            char = proc.stdout.read(1)
+            if not char:
+                break
+            if char not in ('\r', '\n'):
+                line += char
+                continue
+            match = QEMU_IMG_PROGRESS_RE.search(line)
+            if match:
+                if progress_callback:
+                    progress_callback(float(match.group(1)), 100)
+            elif line.strip():
+                output.append(line)
+            line = ''
+        if line.strip():
+            output.append(line)
+
+        exit_code = proc.wait()
+        stdout = '\n'.join(output)
+        # Raised inside timed() so that the profile counts the failure.
+        if exit_code != 0:
+            raise processutils.ProcessExecutionError(exit_code=exit_code,
+                                                     stdout=stdout,
+                                                     stderr='',
+                                                     cmd=' '.join(full_cmd))
+    return stdout, ''
+
+
+# Added by YuanruiFan. Whether qemu-img commit accepts a rate limit, which
+# is only known once qemu-img has been asked.
+_qemu_img_commit_rate_limit = None
+
+
+def qemu_img_commit_supports_rate_limit():
+    """Tell whether the qemu-img of this host supports commit -r."""
+    global _qemu_img_commit_rate_limit
+    if _qemu_img_commit_rate_limit is None:
+        try:
+            out, err = utils.execute('qemu-img', '--help',
+                                     check_exit_code=False)
+        except processutils.ProcessExecutionError:
+            out = ''
+        _qemu_img_commit_rate_limit = any(
+            line.strip().startswith('commit') and '-r rate_limit' in line
+            for line in out.splitlines())
+    return _qemu_img_commit_rate_limit
+
+
+# Added by YuanruiFan. Commit an overlay of a stopped instance.
+def commit_image(top_path, base_path, cache=None, rate_limit=None,
+                 progress_callback=None):
+    """Commit top_path, and the images between, into base_path.
+
+    :param cache: qemu-img cache mode of the images, e.g. 'none'
+    :param rate_limit: Bytes per second the commit may write, ignored
+                       when qemu-img does not support it
+    :param progress_callback: Called with (percent, 100) as the commit
+                              progresses
+    """
+    cmd = ['qemu-img', 'commit', '-f', 'qcow2', '-p']
+    if cache:
+        cmd += ['-t', cache]
+    if rate_limit:
+        if qemu_img_commit_supports_rate_limit():
+            cmd += ['-r', str(rate_limit)]
+        else:
+            LOG.debug('qemu-img commit does not support a rate limit, '
+                      'committing %s at full speed', top_path)
+    cmd += ['-b', base_path, top_path]
+    execute_with_progress(*cmd, progress_callback=progress_callback,
+                          run_as_root=True)
 
 
 def get_iscsi_initiator():
@@ -106,6 +236,31 @@ def create_cow_image(backing_file, path, size=None):
     execute(*cmd)
 
 
+# Added by YuanruiFan. Create an overlay to be reused by a light snapshot.
+def create_light_snapshot_overlay(backing_file, path, cluster_size=None,
+                                  lazy_refcounts=False, preallocation=None):
+    """Create a qcow2 overlay of backing_file with tuned options
+
+    :param backing_file: Absolute path of the image the overlay is based on
+    :param path: Desired location of the overlay
+    :param cluster_size: Cluster size of the overlay, inherited from the
+                         backing file if None
+    :param lazy_refcounts: Defer the refcount updates of the overlay
+    :param preallocation: qcow2 preallocation mode of the overlay
+    """
+    opts = ['backing_file=%s' % backing_file, 'backing_fmt=qcow2']
+    if not cluster_size:
+        with light_profiler.timed(('qemu-img', 'info')):
+            cluster_size = images.qemu_img_info(backing_file).cluster_size
+    if cluster_size:
+        opts.append('cluster_size=%s' % cluster_size)
+    if lazy_refcounts:
+        opts += ['compat=1.1', 'lazy_refcounts=on']
+    if preallocation and preallocation != 'off':
+        opts.append('preallocation=%s' % preallocation)
+    execute('qemu-img', 'create', '-f', 'qcow2', '-o', ','.join(opts), path)
+
+
 def pick_disk_driver_name(hypervisor_version, is_block_dev=False):
     """Pick the libvirt primary backend driver name
 
@@ -170,7 +325,8 @@ def get_disk_size(path, format=None):
     :returns: Size (in bytes) of the given disk image as it would be seen
               by a virtual machine.
     """
-    size = images.qemu_img_info(path, format).virtual_size
+    with light_profiler.timed(('qemu-img', 'info')):
+        size = images.qemu_img_info(path, format).virtual_size
     return int(size)
 
 
@@ -180,7 +336,8 @@ def get_disk_backing_file(path, basename=True, format=None):
     :param path: Path to the disk image
     :returns: a path to the image's backing store
     """
-    backing_file = images.qemu_img_info(path, format).backing_file
+    with light_profiler.timed(('qemu-img', 'info')):
+        backing_file = images.qemu_img_info(path, format).backing_file
     if backing_file and basename:
         backing_file = os.path.basename(backing_file)
 
@@ -201,6 +358,121 @@ def copy_dir(src, dest, host=None, receive=False):
         execute('scp', '-r', src, dest) 
 
 
+# Added by YuanruiFan. Get the snapshot index of a light-snapshot file.
+def get_light_snapshot_index(filename):
+    """Return the snapshot index of a light-snapshot file.
+
+    :returns: -1 for the root 'disk', None if filename is not a
+              light-snapshot file
+    """
+    match = LIGHT_SNAPSHOT_FILE_RE.match(os.path.basename(filename))
+    if not match:
+        return None
+    if not match.group(1):
+        return -1
+    return int(match.group(1))
+
+
+# Added by YuanruiFan. Read the header of a qcow2 image.
+def read_qcow2_header(path):
+    """Read the header of a qcow2 image without running qemu-img.
+
+    :returns: dict of the header fields and 'backing_file', or None if
+              path is not a qcow2 image
+    """
+    with open(path, 'rb') as f:
+        data = f.read(QCOW2_HEADER.size)
+        if len(data) < QCOW2_HEADER.size:
+            return None
+        header = dict(zip(QCOW2_HEADER_FIELDS, QCOW2_HEADER.unpack(data)))
+        if header['magic'] != QCOW2_MAGIC:
+            return None
+
+        header['backing_file'] = None
+        if header['backing_file_offset']:
+            f.seek(header['backing_file_offset'])
+            header['backing_file'] = f.read(
+                header['backing_file_size']).decode('utf-8')
+    return header
+
+
+# Added by YuanruiFan. Tell whether a qcow2 overlay holds data of its own.
+def qcow2_has_data(path):
+    """Tell whether any cluster has been written to a qcow2 image.
+
+    qemu writes an L1 entry to the image as soon as the first cluster it
+    covers is written, so an image whose L1 table is all zeros has no
+    data of its own. Images created with preallocation always have data.
+    """
+    header = read_qcow2_header(path)
+    if header is None:
+        raise exception.NovaException(_('%s is not a qcow2 image') % path)
+
+    with open(path, 'rb') as f:
+        f.seek(header['l1_table_offset'])
+        l1_table = f.read(header['l1_size'] * 8)
+    return l1_table.count(b'\0') != len(l1_table)
+
+
+# Added by YuanruiFan. List the light-snapshot files of a directory.
+def list_light_snapshot_files(path):
+    """List the light-snapshot files of path, ordered along the chain.
+
+    The root 'disk' comes first and each snapshot follows the snapshot
+    it is based on.
+    """
+    filenames = [name for name in os.listdir(path)
+                 if get_light_snapshot_index(name) is not None and
+                 os.path.isfile(os.path.join(path, name))]
+    return sorted(filenames, key=get_light_snapshot_index)
+
+
+# Added by YuanruiFan. Copy the files of a light-snapshot store.
+def copy_snapshot_files(src_dir, dest_dir, filenames, host=None,
+                        streams=1, compression=False, update=False,
+                        on_execute=None, on_completion=None):
+    """Copy files of a light-snapshot store in parallel streams.
+
+    Holes are kept sparse and files which already exist on the
+    destination are skipped, since a stored snapshot never changes.
+
+    :param src_dir: Local directory holding the files
+    :param dest_dir: Destination directory, created if needed
+    :param filenames: Names of the files to copy
+    :param host: Remote host, or None for a local copy
+    :param streams: Number of files copied at the same time
+    :param compression: Compress the data sent to a remote host
+    :param update: Bring the files which already exist on the destination
+                   up to date instead of skipping them. rsync only sends
+                   the blocks that changed.
+    """
+    if host:
+        remote_filesystem_driver = remotefs.RemoteFilesystem()
+        remote_filesystem_driver.create_dir(host, dest_dir)
+        target = "%s:%s/" % (utils.safe_ip_format(host), dest_dir)
+    else:
+        execute('mkdir', '-p', dest_dir)
+
+    def _copy(filename):
+        src = os.path.join(src_dir, filename)
+        if not host:
+            dest = os.path.join(dest_dir, filename)
+            if update or not os.path.exists(dest):
+                execute('cp', '--sparse=always', src, dest)
+            return
+
+        args = ['rsync', '--sparse', '--perms', '--times']
+        if not update:
+            args.append('--ignore-existing')
+        if compression:
+            args.append('--compress')
+        args += [src, target]
+        execute(*args, on_execute=on_execute, on_completion=on_completion)
+
+    pool = eventlet.GreenPool(max(streams, 1))
+    list(pool.imap(_copy, filenames))
+
+
 def copy_image(src, dest, host=None, receive=False,
                on_execute=None, on_completion=None,
                compression=True):
@@ -1138,6 +1138,37 @@ class ServerManager(base.BootingManagerWithFind):
         body={'daily':daily}
         self._action('snapshotAll', None, body)
 
+    def light_commit_stopped(self):
+        """ Commit the light snapshots of all the stopped servers.
+        """
+        self._action('commitStopped', None, None)
+
+    def light_snapshot_bulk(self, action, servers, **options):
+        """ Run a light-snapshot action on a list of servers.
+        : param action: createSnapshot, commitSnapshot, recoverInstance,
+                        enableSnapshot, dailySnapshot or storeSnapshot
+        : param servers: The list of :class: `Server` (or their IDs)
+        : param options: The options of the action, such as skip_empty,
+                         use_root, snap_index or enable
+        : returns: a list of dicts with the id of each server, whether it
+                   has been accepted and the reason if not
+        """
+        body = {'lightSnapshotBulk': {
+            'action': action,
+            'servers': [base.getid(server) for server in servers],
+            'options': options}}
+        resp, body = self.api.client.post('/servers/light_snapshot_bulk',
+                                          body=body)
+        return body['servers']
+
+    def prestage_light_snapshot(self, server, host=None):
+        """ Pre-stage the light snapshots of a server on a host.
+        : param server: The :class: `Server` (or its ID) to share onto
+        : param host: The destination host, None to cancel the pre-stage
+        """
+        body = {'host': host}
+        self._action('prestageSnapshot', server, body)
+
     def backup(self, server, backup_name, backup_type, rotation):
         """
         Backup a server instance.
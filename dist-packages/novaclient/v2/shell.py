@@ -1328,6 +1328,33 @@ def do_image_delete(cs, args):
     action="store_true",
     default=False,
     help=_('Only display servers that enable light snapshot.'))
+@cliutils.arg(
+    '--snapshot-daily',
+    dest='snapshot_daily',
+    action="store_true",
+    default=False,
+    help=_('Only display servers that are light snapshotted daily.'))
+@cliutils.arg(
+    '--snapshot-store',
+    dest='snapshot_store',
+    action="store_true",
+    default=False,
+    help=_('Only display servers that store their light snapshots.'))
+@cliutils.arg(
+    '--snapshot-committed',
+    dest='snapshot_committed',
+    action="store_true",
+    default=False,
+    help=_('Only display servers whose light snapshots are all '
+           'committed.'))
+@cliutils.arg(
+    '--snapshot-older-than',
+    dest='snapshot_older_than',
+    metavar='<timestamp>',
+    default=None,
+    help=_('Only display servers whose last light snapshot is older than '
+           '<timestamp> (ISO 8601), or that have never been light '
+           'snapshotted.'))
 
 @cliutils.arg(
     '--fields',
@@ -1390,6 +1417,10 @@ def do_list(cs, args):
         'host': args.host,
         'deleted': args.deleted,
         'light_snapshot_enable': args.light_snapshot_enable,
+        'snapshot_daily': args.snapshot_daily,
+        'snapshot_store': args.snapshot_store,
+        'snapshot_committed': args.snapshot_committed,
+        'snapshot_older_than': args.snapshot_older_than,
         'instance_name': args.instance_name}
 
     filters = {'flavor': lambda f: f['id'],
@@ -1876,6 +1907,80 @@ def do_light_snapshot_all(cs, args):
     cs.servers.light_snapshot_all(daily)
 
 
+# Added by YuanruiFan. We commit the light snapshots of all the stopped
+# instances that enable light-snapshot system.
+def do_light_commit_stopped(cs, args):
+    """Commit the light snapshots of all the stopped servers."""
+    cs.servers.light_commit_stopped()
+
+
+# Added by YuanruiFan. Run a light-snapshot action on a list of instances
+# with a single request.
+@cliutils.arg(
+    'action', metavar='<action>',
+    choices=['createSnapshot', 'commitSnapshot', 'recoverInstance',
+             'enableSnapshot', 'dailySnapshot', 'storeSnapshot'],
+    help=_('light-snapshot action: createSnapshot, commitSnapshot, '
+           'recoverInstance, enableSnapshot, dailySnapshot or '
+           'storeSnapshot.'))
+@cliutils.arg(
+    'server', metavar='<server>', nargs='+',
+    help=_('Name or ID of server(s).'))
+@cliutils.arg(
+    '--skip-empty',
+    dest='skip_empty',
+    action="store_true",
+    default=False,
+    help=_('createSnapshot: skip the servers not written to since their '
+           'last snapshot.'))
+@cliutils.arg(
+    '--use-root',
+    dest='use_root',
+    action="store_true",
+    default=False,
+    help=_('recoverInstance: use the root disk of instance to recover.'))
+@cliutils.arg(
+    '--snapshot-index', dest='index', metavar='<integer>', default=None,
+    help=_('recoverInstance: snapshot index that want to recover from.'))
+@cliutils.arg(
+    '--disable',
+    dest='disable',
+    action="store_true",
+    default=False,
+    help=_('dailySnapshot, storeSnapshot: disable instead of enable.'))
+def do_light_snapshot_bulk(cs, args):
+    """Run a light-snapshot action on several servers."""
+    servers = [server if uuidutils.is_uuid_like(server)
+               else _find_server(cs, server).id
+               for server in args.server]
+    options = {}
+    if args.action == 'createSnapshot':
+        options['skip_empty'] = args.skip_empty
+    elif args.action == 'recoverInstance':
+        options['use_root'] = args.use_root
+        if args.index is not None:
+            options['snap_index'] = int(args.index)
+    elif args.action in ('dailySnapshot', 'storeSnapshot'):
+        options['enable'] = not args.disable
+    results = cs.servers.light_snapshot_bulk(args.action, servers,
+                                             **options)
+    utils.print_list(results, ['ID', 'Accepted', 'Reason'],
+                     formatters={'ID': lambda r: r['id'],
+                                 'Accepted': lambda r: r['accepted'],
+                                 'Reason': lambda r: r.get('reason', '')})
+
+
+# Added by YuanruiFan. Add a command line for pre-staging the light
+# snapshots of the instance on the host it will be migrated to.
+@cliutils.arg('server', metavar='<server>', help=_('Name or ID of server.'))
+@cliutils.arg(
+    'host', metavar='<host>', nargs='?', default=None,
+    help=_('destination host. Cancel the pre-stage if omitted.'))
+def do_prestage_light_snapshot(cs, args):
+    server = _find_server(cs, args.server)
+    cs.servers.prestage_light_snapshot(server, args.host)
+
+
 @cliutils.arg('server', metavar='<server>', help=_('Name or ID of server.'))
 @cliutils.arg('name', metavar='<name>', help=_('Name of snapshot.'))
 @cliutils.arg(
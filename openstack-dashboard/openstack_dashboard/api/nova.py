@@ -658,6 +658,10 @@ def server_light_snapshot(request, instance_id):
 def server_recover(request, instance_id):
     novaclient(request).servers.light_recover(instance_id, None)
 
+def server_light_snapshot_bulk(request, action, instance_ids, **options):
+    return novaclient(request).servers.light_snapshot_bulk(
+        action, instance_ids, **options)
+
 def server_suspend(request, instance_id):
     novaclient(request).servers.suspend(instance_id)
 
@@ -245,9 +245,41 @@ class ToggleEnableLightSnapshot(tables.BatchAction):
             api.nova.server_enable_light_snapshot(request, obj_id)
             self.current_past_action = ENABLE_LIGHT_SNAPSHOT
 
+# Added by YuanruiFan. Send the instances selected for a light-snapshot
+# action to nova in one request, instead of one request per instance.
+class LightSnapshotBulkMixin(object):
+    bulk_action = None
+
+    def handle(self, table, request, obj_ids):
+        allowed_ids = [obj_id for obj_id in obj_ids
+                       if table._filter_action(
+                           self, request, table.get_object_by_id(obj_id))]
+        self.bulk_results = {}
+        if allowed_ids:
+            try:
+                results = api.nova.server_light_snapshot_bulk(
+                    request, self.bulk_action, allowed_ids)
+                self.bulk_results = dict((result['id'], result)
+                                         for result in results)
+            except Exception:
+                # Every instance is then reported as failed by action().
+                LOG.exception("Light-snapshot bulk action %s failed.",
+                              self.bulk_action)
+        return super(LightSnapshotBulkMixin, self).handle(table, request,
+                                                          obj_ids)
+
+    def action(self, request, obj_id):
+        result = self.bulk_results.get(obj_id)
+        if result is None or not result['accepted']:
+            reason = result.get('reason') if result else None
+            raise exceptions.Conflict(reason or obj_id)
+
+
 # Added by YuanruiFan. Add a button to recover instance
-class RecoverInstance(policy.PolicyTargetMixin, tables.BatchAction):
+class RecoverInstance(LightSnapshotBulkMixin, policy.PolicyTargetMixin,
+                      tables.BatchAction):
     name = "recover_snapshot"
+    bulk_action = "recoverInstance"
     classes = ('btn-danger', 'btn-recover')
     policy_rules = (("compute", "compute:recover"),)
     help_text = _("Recover Instance will reboot from the last snapshot.")
@@ -275,13 +307,12 @@ class RecoverInstance(policy.PolicyTargetMixin, tables.BatchAction):
         else:
             return False
 
-    def action(self, request, obj_id):
-        api.nova.server_recover(request, obj_id)
-
 
 # Added by YuanruiFan. Add a button for light-snapshot
-class LightSnapshotInstance(policy.PolicyTargetMixin, tables.BatchAction):
+class LightSnapshotInstance(LightSnapshotBulkMixin, policy.PolicyTargetMixin,
+                            tables.BatchAction):
     name = "light_snapshot"
+    bulk_action = "createSnapshot"
     
     policy_rules = (("compute", "compute:light_snapshot"),)
     help_text = _("light-snapshot will save your data as snapshot.")
@@ -310,9 +341,6 @@ class LightSnapshotInstance(policy.PolicyTargetMixin, tables.BatchAction):
         else:
             return False
 
-    def action(self, request, obj_id):
-        api.nova.server_light_snapshot(request, obj_id)
-
 
 class TogglePause(tables.BatchAction):
     name = "pause"